@@ -0,0 +1,242 @@
+"""
+Values derived purely from settings: the encoded LNURL, its QR code, the
+payRequest metadata (with its image, if any) and the rendered tip page.
+
+They are computed once per process and shared by every request, and can also
+be precomputed into a file at build time so that workers start faster:
+
+    python -m app.artifacts --output artifacts.json
+    ARTIFACTS_FILE=artifacts.json ./run.sh
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    PrivateAttr,
+)
+
+from .comments import COMMENTS_SLOT
+from .fiat_rates import (
+    FIAT_SLOT,
+    Currency,
+    LnurlPayResponseCurrencies,
+)
+from .metadata_image import (
+    image_key,
+    load_metadata_image,
+)
+from .payer_data import PayerDataOptions
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+    qr_svg,
+)
+
+# Bump when what's derived, or how, changes so old artifact files are ignored
+ARTIFACTS_VERSION = 2
+TEMPLATES_DIRECTORY = Path("app/templates")
+TIP_PAGE_TEMPLATE = "lnurl-splash.html"
+
+
+@functools.cache
+def get_templates():
+    # NOTE Jinja2 is only needed for the tip page, so is imported on first use
+    from fastapi.templating import Jinja2Templates
+
+    return Jinja2Templates(directory=str(TEMPLATES_DIRECTORY))
+
+
+def settings_fingerprint(settings: PhoenixdLNURLSettings) -> str:
+    """
+    Identifies the settings (and template) that artifacts were derived from
+    """
+    template = (TEMPLATES_DIRECTORY / TIP_PAGE_TEMPLATE).read_bytes()
+    inputs = settings.json(
+        include={
+            "username",
+            "lnurl_hostname",
+            "user_profile_image_url",
+            "user_nostr_address",
+            "min_sats_receivable",
+            "max_sats_receivable",
+            "comment_allowed",
+            "payer_data",
+            "tip_page_comments",
+            "fiat_currencies",
+        }
+    )
+    image = image_key(settings)
+    return hashlib.sha256(
+        f"{ARTIFACTS_VERSION}:{inputs}:{image}:".encode() + template
+    ).hexdigest()
+
+
+class LnurlArtifacts(BaseModel):
+    fingerprint: str
+    username: str
+    lnurl_address: str
+    lnurl_address_encoded: str
+    callback_url: str
+    min_sendable: int
+    max_sendable: int
+    metadata: str
+    metadata_hash: str
+    comment_allowed: int = 0
+    payer_data: bool = False
+    # Expensive, so filled in on first use unless precomputed
+    lnurl_qr: str | None = None
+    tip_page_html: str | None = None
+
+    _pay_request_body: bytes | None = PrivateAttr(default=None)
+
+    @classmethod
+    def build(
+        cls, settings: PhoenixdLNURLSettings, *, eager: bool = False
+    ) -> "LnurlArtifacts":
+        image = load_metadata_image(settings)
+        image_entry = image.metadata_entry() if image is not None else None
+        artifacts = cls(
+            fingerprint=settings_fingerprint(settings),
+            username=settings.username,
+            lnurl_address=settings.lnurl_address(),
+            lnurl_address_encoded=settings.lnurl_address_encoded(),
+            callback_url=str(
+                settings.base_url() / f"lnurlp/{settings.username}/callback"
+            ),
+            min_sendable=settings.min_sats_receivable * 1000,
+            max_sendable=settings.max_sats_receivable * 1000,
+            metadata=settings.metadata_for_payrequest(image_entry),
+            metadata_hash=settings.metadata_hash(image_entry),
+            comment_allowed=settings.comment_allowed,
+            payer_data=settings.payer_data,
+        )
+        if eager:
+            artifacts.tip_page(settings)
+        return artifacts
+
+    def qr(self) -> str:
+        if self.lnurl_qr is None:
+            self.lnurl_qr = qr_svg(self.lnurl_address_encoded)
+        return self.lnurl_qr
+
+    def tip_page(self, settings: PhoenixdLNURLSettings) -> str:
+        if self.tip_page_html is None:
+            template = get_templates().get_template(TIP_PAGE_TEMPLATE)
+            self.tip_page_html = template.render(
+                username=settings.username,
+                lnurl_address=self.lnurl_address,
+                nostr_address=settings.user_nostr_address,
+                profile_image_url=settings.user_profile_image_url,
+                meta_description=settings.lnurl_hostname,
+                meta_author=self.lnurl_address,
+                encoded_lnurl=self.lnurl_address_encoded,
+                lnurl_qr=self.qr(),
+                smaller_heading=settings.is_long_username(),
+                # Filled in per request, see `CommentStore.tip_page`
+                comments_slot=COMMENTS_SLOT if settings.tip_page_comments else None,
+                # Likewise, see `FiatRates.tip_page`
+                fiat_slot=FIAT_SLOT if settings.fiat_currencies else None,
+            )
+        return self.tip_page_html
+
+    def pay_request(
+        self, currencies: list[Currency] | None = None
+    ) -> LnurlPayResponseCurrencies:
+        return LnurlPayResponseCurrencies.parse_obj(
+            dict(
+                callback=self.callback_url,
+                minSendable=self.min_sendable,
+                maxSendable=self.max_sendable,
+                metadata=self.metadata,
+                commentAllowed=self.comment_allowed or None,
+                payerData=PayerDataOptions.optional() if self.payer_data else None,
+                currencies=currencies,
+            )
+        )
+
+    def pay_request_body(self, currencies: list[Currency] | None = None) -> bytes:
+        """
+        The payRequest response, serialized the way FastAPI would. Kept unless
+        it has `currencies`, which change with exchange rates
+        """
+        if currencies is not None:
+            return self._serialize(self.pay_request(currencies))
+        if self._pay_request_body is None:
+            self._pay_request_body = self._serialize(self.pay_request())
+        return self._pay_request_body
+
+    @staticmethod
+    def _serialize(response: LnurlPayResponseCurrencies) -> bytes:
+        return JSONResponse(
+            jsonable_encoder(response, by_alias=True, exclude_none=True)
+        ).body
+
+    def save(self, path: Path):
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.json())
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path, settings: PhoenixdLNURLSettings) -> "LnurlArtifacts":
+        """
+        Load precomputed artifacts if they match `settings`, building them
+        otherwise
+        """
+        try:
+            artifacts = cls.parse_raw(path.read_text())
+        except (OSError, ValueError) as exc:
+            logger.warning(
+                "Could not load artifacts from '{path}', building instead: {exc}",
+                path=path,
+                exc=exc,
+            )
+            return cls.build(settings)
+        if artifacts.fingerprint != settings_fingerprint(settings):
+            logger.warning(
+                "Artifacts in '{path}' are for different settings, building instead",
+                path=path,
+            )
+            return cls.build(settings)
+        return artifacts
+
+
+def load_artifacts(settings: PhoenixdLNURLSettings) -> LnurlArtifacts:
+    if settings.artifacts_file is not None:
+        return LnurlArtifacts.load(settings.artifacts_file, settings)
+    return LnurlArtifacts.build(settings)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.artifacts",
+        description="Precompute settings-derived artifacts for faster startup",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Where to write the artifacts, defaults to ARTIFACTS_FILE",
+    )
+    args = parser.parse_args(argv)
+    settings = load_settings()
+    output = args.output or settings.artifacts_file
+    if output is None:
+        parser.error("either --output or ARTIFACTS_FILE must be set")
+    LnurlArtifacts.build(settings, eager=True).save(output)
+    print(
+        json.dumps(
+            {"output": str(output), "fingerprint": settings_fingerprint(settings)}
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
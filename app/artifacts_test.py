@@ -0,0 +1,48 @@
+from .artifacts import (
+    LnurlArtifacts,
+    load_artifacts,
+)
+from .settings import PhoenixdLNURLSettings
+
+
+def test_artifacts_match_settings():
+    settings = PhoenixdLNURLSettings(_env_file="test.env")
+    artifacts = LnurlArtifacts.build(settings)
+    assert artifacts.lnurl_address == settings.lnurl_address()
+    assert artifacts.lnurl_address_encoded == settings.lnurl_address_encoded()
+    assert artifacts.callback_url == "https://127.0.0.1/lnurlp/satoshi/callback"
+    assert artifacts.metadata == settings.metadata_for_payrequest()
+    assert artifacts.metadata_hash == settings.metadata_hash()
+    # The expensive bits are only made on first use
+    assert artifacts.lnurl_qr is None
+    assert artifacts.tip_page_html is None
+    assert artifacts.qr() == settings.lnurl_qr()
+    assert artifacts.tip_page(settings).startswith("<!DOCTYPE html>")
+
+
+def test_artifacts_file_roundtrip(tmp_path):
+    settings = PhoenixdLNURLSettings(_env_file="test.env")
+    path = tmp_path / "artifacts.json"
+    built = LnurlArtifacts.build(settings, eager=True)
+    built.save(path)
+    settings.artifacts_file = path
+    loaded = load_artifacts(settings)
+    assert loaded == built
+    assert loaded.tip_page_html is not None
+
+
+def test_artifacts_file_for_other_settings_is_ignored(tmp_path):
+    settings = PhoenixdLNURLSettings(_env_file="test.env")
+    path = tmp_path / "artifacts.json"
+    LnurlArtifacts.build(settings, eager=True).save(path)
+    settings.username = "hal"
+    settings.artifacts_file = path
+    loaded = load_artifacts(settings)
+    assert loaded.lnurl_address == "hal@127.0.0.1"
+    assert loaded.tip_page_html is None
+
+
+def test_artifacts_file_missing(tmp_path):
+    settings = PhoenixdLNURLSettings(_env_file="test.env")
+    settings.artifacts_file = tmp_path / "nope.json"
+    assert load_artifacts(settings) == LnurlArtifacts.build(settings)
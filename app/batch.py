@@ -0,0 +1,372 @@
+"""
+Bulk invoice generation, e.g. for printing sheets of fixed-amount vouchers,
+from the admin endpoint:
+
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" -H "Content-Type: application/json" \\
+        -d '{"amounts": [{"amount_sat": 1000, "count": 500}], "qr": true}' \\
+        https://example.com/admin/invoices/batch
+
+or from the command line, talking to phoenixd directly:
+
+    python -m app.batch 1000x500 2100x100 --qr --output vouchers.ndjson
+
+Results are streamed back as NDJSON as invoices are made, one line per
+invoice, with a progress line every `PROGRESS_EVERY` and a summary at the end.
+Only requests that never reached phoenixd (it couldn't be connected to) are
+retried. An invoice whose request failed otherwise, e.g. timed out or was cut
+off, is reported as "unknown", as phoenixd may have made it anyway; look for it
+by its externalId.
+At most `BATCH_CONCURRENCY` invoices are requested from phoenixd at once,
+across every batch in the process, so batches run at a steady rate phoenixd
+can sustain while live LNURL callbacks, which don't wait on the limit, are
+still answered. Production stops while whoever is reading the results falls
+behind, so a batch only uses memory for a window of results however large it
+is.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import uuid
+from collections.abc import (
+    AsyncIterator,
+    Iterator,
+)
+from concurrent.futures import ProcessPoolExecutor
+from typing import Annotated
+
+import aiohttp
+from fastapi import (
+    APIRouter,
+    Header,
+    status,
+)
+from fastapi.requests import Request
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from lnurl import LnurlErrorResponse
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    Field,
+    ValidationError,
+    validator,
+)
+
+from .export import check_admin
+from .phoenixd_client import (
+    PhoenixdClientBase,
+    phoenixd_client_for,
+)
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+    qr_svg,
+)
+
+PROGRESS_EVERY = 100
+# Attempts per invoice, backing off between them, before it's reported failed
+ATTEMPTS = 4
+RETRY_DELAY = 0.5
+# NOTE only errors connecting, after anything else (timeouts, dropped
+# connections, bad responses) the invoice may have been made
+RETRYABLE_ERRORS = (aiohttp.ClientConnectorError,)
+
+batch_router = APIRouter()
+
+
+class BatchAmount(BaseModel):
+    amount_sat: int = Field(gt=0)
+    count: int = Field(default=1, gt=0)
+
+
+class BatchRequest(BaseModel):
+    amounts: list[BatchAmount] = Field(min_items=1)
+    description: str = Field(default="Voucher", max_length=639)
+    # Shared by every invoice in the batch, so they can be found in exports
+    # later. Defaults to a new "batch-..." id
+    external_id: str | None = Field(default=None, max_length=64)
+    # Include each invoice's QR code as an SVG
+    qr: bool = False
+
+    @validator("external_id", always=True)
+    def default_external_id(cls, external_id: str | None) -> str:
+        return external_id or f"batch-{uuid.uuid4().hex[:16]}"
+
+    def total(self) -> int:
+        return sum(amount.count for amount in self.amounts)
+
+    def amounts_sat(self) -> Iterator[int]:
+        for amount in self.amounts:
+            for _ in range(amount.count):
+                yield amount.amount_sat
+
+
+@functools.cache
+def qr_pool() -> ProcessPoolExecutor:
+    # QR codes are CPU bound and slow in pure Python, so are rendered off the
+    # event loop, in other processes so the GIL isn't held either. Half the
+    # CPUs at most, leaving the rest for answering requests. Spawned rather
+    # than forked, as forking copies the event loop, open connections and
+    # (with threads running) possibly held locks
+    return ProcessPoolExecutor(
+        max_workers=max(1, (os.cpu_count() or 2) // 2),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def shutdown_qr_pool():
+    if qr_pool.cache_info().currsize:
+        qr_pool().shutdown(cancel_futures=True)
+        qr_pool.cache_clear()
+
+
+def invoice_qr_svg(invoice: str) -> str:
+    # Upper case encodes in QR alphanumeric mode, for a smaller code
+    return qr_svg(f"lightning:{invoice}".upper())
+
+
+async def _create(
+    client: PhoenixdClientBase,
+    semaphore: asyncio.Semaphore,
+    batch: BatchRequest,
+    index: int,
+    amount_sat: int,
+) -> dict:
+    record: dict = {"type": "invoice", "index": index, "amount_sat": amount_sat}
+    for attempt in range(ATTEMPTS):
+        try:
+            async with semaphore:
+                invoice = await client.createinvoice(
+                    amount_sat=amount_sat,
+                    description=batch.description,
+                    external_id=batch.external_id,
+                )
+        except RETRYABLE_ERRORS as exc:
+            if attempt == ATTEMPTS - 1:
+                logger.warning(
+                    "Batch invoice {index} failed: {exc!r}", index=index, exc=exc
+                )
+                return {**record, "type": "error", "reason": repr(exc)}
+            await asyncio.sleep(RETRY_DELAY * 2**attempt)
+            continue
+        except (TimeoutError, aiohttp.ClientError, ValidationError) as exc:
+            logger.warning(
+                "Batch invoice {index} failed, it may have been made: {exc!r}",
+                index=index,
+                exc=exc,
+            )
+            return {**record, "type": "unknown", "reason": repr(exc)}
+        record.update(payment_hash=invoice.payment_hash, invoice=invoice.serialized)
+        if batch.qr:
+            record["qr_svg"] = await asyncio.get_running_loop().run_in_executor(
+                qr_pool(), invoice_qr_svg, invoice.serialized
+            )
+        return record
+    raise AssertionError("unreachable")
+
+
+async def create_batch(
+    client: PhoenixdClientBase,
+    batch: BatchRequest,
+    *,
+    semaphore: asyncio.Semaphore,
+    concurrency: int,
+) -> AsyncIterator[dict]:
+    """
+    Records for each invoice in `batch`, in the order they're made, then a
+    summary. `semaphore` limits requests to phoenixd, and is shared by
+    concurrent batches
+    """
+    amounts = enumerate(batch.amounts_sat())
+    total = batch.total()
+    # Bounded, so producers wait on a slow reader
+    results: asyncio.Queue[dict] = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        # NOTE the iterator is shared, each worker takes the next invoice
+        for index, amount_sat in amounts:
+            try:
+                record = await _create(client, semaphore, batch, index, amount_sat)
+            except Exception as exc:
+                # Not worth retrying, but not worth losing the rest of the batch over
+                logger.exception("Batch invoice {index} failed", index=index)
+                record = {
+                    "type": "error",
+                    "index": index,
+                    "amount_sat": amount_sat,
+                    "reason": repr(exc),
+                }
+            await results.put(record)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, total))]
+    done = failed = unknown = 0
+    try:
+        while done < total:
+            record = await results.get()
+            done += 1
+            failed += record["type"] == "error"
+            unknown += record["type"] == "unknown"
+            yield record
+            if done % PROGRESS_EVERY == 0 and done < total:
+                yield {"type": "progress", "done": done, "total": total}
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    yield {
+        "type": "summary",
+        "external_id": batch.external_id,
+        "total": total,
+        "created": total - failed - unknown,
+        "failed": failed,
+        "unknown": unknown,
+    }
+
+
+async def batch_lines(records: AsyncIterator[dict]) -> AsyncIterator[str]:
+    async for record in records:
+        yield json.dumps(record) + "\n"
+
+
+@batch_router.post(
+    path="/admin/invoices/batch",
+    summary="Create invoices in bulk",
+    description="Creates invoices for the given amounts, streaming them back as NDJSON",
+    operation_id="admin-invoices-batch",
+    response_class=StreamingResponse,
+)
+async def batch_invoices(
+    request: Request,
+    batch: BatchRequest,
+    authorization: Annotated[str | None, Header()] = None,
+) -> Response:
+    if (denied := check_admin(request, authorization)) is not None:
+        return denied
+    settings: PhoenixdLNURLSettings = request.app.state.settings
+    if batch.total() > settings.batch_max_invoices:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content=LnurlErrorResponse(
+                reason=f"Too many invoices, maximum is {settings.batch_max_invoices}"
+            ).dict(),
+        )
+    logger.info(
+        "Creating a batch of {total} invoices, externalId '{external_id}'",
+        total=batch.total(),
+        external_id=batch.external_id,
+    )
+    records = create_batch(
+        request.app.state.phoenixd_client,
+        batch,
+        semaphore=request.app.state.batch_semaphore,
+        concurrency=settings.batch_concurrency,
+    )
+    return StreamingResponse(batch_lines(records), media_type="application/x-ndjson")
+
+
+def parse_amount(spec: str) -> BatchAmount:
+    """
+    "1000" or "1000x50", 50 invoices of 1000 sats
+    """
+    amount_sat, _, count = spec.partition("x")
+    try:
+        return BatchAmount(amount_sat=int(amount_sat), count=int(count or 1))
+    except (ValueError, ValidationError) as exc:
+        raise argparse.ArgumentTypeError(f"invalid amount '{spec}'") from exc
+
+
+async def run_batch(
+    settings: PhoenixdLNURLSettings,
+    batch: BatchRequest,
+    output,
+    *,
+    concurrency: int,
+):
+    total = batch.total()
+    async with aiohttp.ClientSession() as session:
+        client = phoenixd_client_for(settings, session)
+        records = create_batch(
+            client,
+            batch,
+            semaphore=asyncio.Semaphore(concurrency),
+            concurrency=concurrency,
+        )
+        async for record in records:
+            if record["type"] == "progress":
+                print(f"{record['done']}/{total}", file=sys.stderr)
+                continue
+            output.write(json.dumps(record) + "\n")
+            if record["type"] == "summary":
+                print(
+                    f"Created {record['created']}/{total} invoices, externalId "
+                    f"'{record['external_id']}'",
+                    file=sys.stderr,
+                )
+                if record["unknown"]:
+                    print(
+                        f"{record['unknown']} failed and may have been created",
+                        file=sys.stderr,
+                    )
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.batch",
+        description="Create invoices in bulk, e.g. for printed vouchers, as NDJSON",
+    )
+    parser.add_argument(
+        "amounts",
+        nargs="+",
+        type=parse_amount,
+        metavar="SATS[xCOUNT]",
+        help="e.g. 1000x500 for 500 invoices of 1000 sats",
+    )
+    parser.add_argument("--description", default="Voucher")
+    parser.add_argument(
+        "--external-id",
+        help="Shared by the batch's invoices, defaults to a new 'batch-...' id",
+    )
+    parser.add_argument("--qr", action="store_true", help="Include QR code SVGs")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Invoices requested at once, defaults to BATCH_CONCURRENCY",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w", encoding="utf-8"),
+        default=sys.stdout,
+        help="Defaults to stdout",
+    )
+    args = parser.parse_args(argv)
+    settings = load_settings()
+    batch = BatchRequest(
+        amounts=args.amounts,
+        description=args.description,
+        external_id=args.external_id,
+        qr=args.qr,
+    )
+    try:
+        asyncio.run(
+            run_batch(
+                settings,
+                batch,
+                args.output,
+                concurrency=args.concurrency or settings.batch_concurrency,
+            )
+        )
+    finally:
+        shutdown_qr_pool()
+
+
+if __name__ == "__main__":
+    main()
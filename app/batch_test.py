@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import SecretStr
+
+from . import batch as batch_module
+from .batch import (
+    BatchAmount,
+    BatchRequest,
+    create_batch,
+    parse_amount,
+    qr_pool,
+)
+from .main import app_factory
+from .phoenixd_client import (
+    CreateInvoiceResponse,
+    PhoenixdMockClient,
+)
+
+
+class CountingClient(PhoenixdMockClient):
+    def __init__(self, failures: int = 0, timeouts: int = 0, disconnects: int = 0):
+        super().__init__(phoenixd_url="http://127.0.0.1:9740")
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failures = failures
+        self.timeouts = timeouts
+        self.disconnects = disconnects
+
+    async def createinvoice(self, *, amount_sat, description, external_id=None):
+        self.calls += 1
+        call = self.calls
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.001)
+            if self.failures:
+                self.failures -= 1
+                raise aiohttp.ClientConnectorError(
+                    aiohttp.client_reqrep.ConnectionKey(
+                        "127.0.0.1", 9740, False, True, None, None, None
+                    ),
+                    ConnectionRefusedError("overloaded"),
+                )
+            if self.timeouts:
+                self.timeouts -= 1
+                raise aiohttp.ServerTimeoutError("slow")
+            if self.disconnects:
+                self.disconnects -= 1
+                raise aiohttp.ServerDisconnectedError("dropped")
+        finally:
+            self.in_flight -= 1
+        return CreateInvoiceResponse.parse_obj(
+            {
+                "amountSat": amount_sat,
+                "paymentHash": f"{call:064x}",
+                "serialized": f"lntb{amount_sat}n1{call}",
+            }
+        )
+
+
+async def collect(client, batch, concurrency=3) -> list[dict]:
+    return [
+        record
+        async for record in create_batch(
+            client,
+            batch,
+            semaphore=asyncio.Semaphore(concurrency),
+            concurrency=concurrency,
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_create_batch():
+    client = CountingClient()
+    batch = BatchRequest(
+        amounts=[
+            BatchAmount(amount_sat=1000, count=200),
+            BatchAmount(amount_sat=2100, count=50),
+        ]
+    )
+    records = await collect(client, batch)
+    assert client.max_in_flight == 3
+
+    invoices = [r for r in records if r["type"] == "invoice"]
+    assert sorted(r["index"] for r in invoices) == list(range(250))
+    assert sum(r["amount_sat"] for r in invoices) == 200 * 1000 + 50 * 2100
+    assert len({r["payment_hash"] for r in invoices}) == 250
+    progress = [r["done"] for r in records if r["type"] == "progress"]
+    assert progress == [100, 200]
+    assert records[-1] == {
+        "type": "summary",
+        "external_id": batch.external_id,
+        "total": 250,
+        "created": 250,
+        "failed": 0,
+        "unknown": 0,
+    }
+    assert batch.external_id.startswith("batch-")
+
+
+@pytest.mark.asyncio
+async def test_create_batch_retries(monkeypatch):
+    monkeypatch.setattr(batch_module, "RETRY_DELAY", 0)
+    # Enough failures for one invoice to run out of attempts
+    client = CountingClient(failures=batch_module.ATTEMPTS + 2)
+    records = await collect(
+        client, BatchRequest(amounts=[BatchAmount(amount_sat=1, count=5)]), 1
+    )
+    errors = [r for r in records if r["type"] == "error"]
+    assert len(errors) == 1
+    assert "overloaded" in errors[0]["reason"]
+    assert records[-1]["created"] == 4
+    assert records[-1]["failed"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "failure,reason",
+    [("timeouts", "slow"), ("disconnects", "dropped")],
+)
+async def test_create_batch_unknown_not_retried(monkeypatch, failure, reason):
+    monkeypatch.setattr(batch_module, "RETRY_DELAY", 0)
+    client = CountingClient(**{failure: 1})
+    records = await collect(
+        client, BatchRequest(amounts=[BatchAmount(amount_sat=1, count=5)]), 1
+    )
+    # phoenixd may have made it, so asking again could make two
+    assert client.calls == 5
+    (unknown,) = (r for r in records if r["type"] == "unknown")
+    assert reason in unknown["reason"]
+    assert records[-1]["created"] == 4
+    assert records[-1]["unknown"] == 1
+
+
+def test_parse_amount():
+    assert parse_amount("1000x50") == BatchAmount(amount_sat=1000, count=50)
+    assert parse_amount("21") == BatchAmount(amount_sat=21, count=1)
+    for spec in ["x5", "0x5", "1000x0", "abc"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_amount(spec)
+
+
+def test_batch_endpoint():
+    app = app_factory()
+    url = "/admin/invoices/batch"
+    body = {"amounts": [{"amount_sat": 1000, "count": 2}], "qr": True}
+    with TestClient(app) as client:
+        app.state.phoenixd_client = CountingClient()
+        assert client.post(url, json=body).status_code == 404
+
+        app.state.settings = app.state.settings.copy(
+            update={"admin_token": SecretStr("hunter2"), "batch_max_invoices": 2}
+        )
+        assert client.post(url, json=body).status_code == 401
+        headers = {"Authorization": "Bearer hunter2"}
+        too_many = {"amounts": [{"amount_sat": 1000, "count": 3}]}
+        response = client.post(url, json=too_many, headers=headers)
+        assert response.status_code == 400
+        assert response.json()["reason"] == "Too many invoices, maximum is 2"
+
+        response = client.post(url, json=body, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+    *invoices, summary = records
+    assert [r["type"] for r in invoices] == ["invoice", "invoice"]
+    assert all(r["qr_svg"].startswith("<svg") for r in invoices)
+    assert summary["created"] == 2
+    # Shut down with the app
+    assert qr_pool.cache_info().currsize == 0
@@ -0,0 +1,226 @@
+"""
+Microbenchmarks for the request-path hot spots, using `pytest-benchmark`.
+
+Not collected by a plain `pytest` run, use `just bench-baseline` to save a
+baseline and `just bench` to compare against it, failing on regressions.
+"""
+
+import asyncio
+import json
+import subprocess
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+from lnurl import (
+    LnurlPayActionResponse,
+    LnurlPayResponse,
+)
+
+from .artifacts import (
+    LnurlArtifacts,
+    get_templates,
+)
+from .main import app_factory
+from .phoenixd_client import (
+    CreateInvoiceResponse,
+    PhoenixdMockClient,
+)
+from .settings import PhoenixdLNURLSettings
+
+INVOICE_JSON = json.dumps(
+    {
+        "amountSat": 1337,
+        "paymentHash": (
+            "30cf1dfc68ab7c5cd1c79c060d26d001e361e42b19f8cc109178d49833259e92"
+        ),
+        "serialized": (
+            "lntb1u1pnquurmpp5xr83mlrg4d79e5w8nsrq6fksq83kreptr8uvcyy3"
+            "0r2fsve9n6fqcqpjsp5ut3l5lvwpwyjcqf508nzdtze65zl2yycm45uee"
+            "elktu3phzv2fsq9q7sqqqqqqqqqqqqqqqqqqqsqqqqqysgqdrytddjyar"
+            "90p69ctmsd3skjm3z9s395ctsypekzar0wd5xjgja93djyar90p69ctmf"
+            "v3jkuarfve5k2u3z9s38xct5daeks6fzt4wsmqz9grzjqwfn3p9278ttz"
+            "zpe0e00uhyxhned3j5d9acqak5emwfpflp8z2cnflcdkeu6euv7gsqqqq"
+            "lgqqqqqeqqjqvyrulmkm8x58s9vahdm3z7jlj00pgl04xhfd0gjlm0e5e"
+            "z7llfg49ra6pl96808deh95ysvmxajhfse4033k2deh58mrgdjj8kz8s6"
+            "gpd82r8j"
+        ),
+    }
+)
+
+# Upper bounds in seconds for a fresh interpreter, whatever the saved baseline
+IMPORT_TIME_BUDGET = 2.0
+STARTUP_TIME_BUDGET = 2.5
+
+
+@pytest.fixture(scope="module")
+def settings() -> PhoenixdLNURLSettings:
+    return PhoenixdLNURLSettings(_env_file="test.env")  # type: ignore
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app_factory()) as test_client:
+        yield test_client
+
+
+def test_bench_lnurl_qr(benchmark, settings):
+    assert benchmark(settings.lnurl_qr).startswith("<svg")
+
+
+def test_bench_lnurl_address_encoded(benchmark, settings):
+    assert benchmark(settings.lnurl_address_encoded).startswith("LNURL1")
+
+
+def test_bench_metadata_for_payrequest(benchmark, settings):
+    assert benchmark(settings.metadata_for_payrequest).startswith("[[")
+
+
+def test_bench_metadata_hash(benchmark, settings):
+    assert len(benchmark(settings.metadata_hash)) == 64
+
+
+def test_bench_pay_response_model(benchmark, settings):
+    def build() -> LnurlPayResponse:
+        return LnurlPayResponse.parse_obj(
+            dict(
+                callback=str(settings.base_url() / "lnurlp/satoshi/callback"),
+                minSendable=settings.min_sats_receivable * 1000,
+                maxSendable=settings.max_sats_receivable * 1000,
+                metadata=settings.metadata_for_payrequest(),
+            )
+        )
+
+    assert benchmark(build).tag == "payRequest"
+
+
+def test_bench_pay_action_response_model(benchmark):
+    invoice = CreateInvoiceResponse.parse_raw(INVOICE_JSON)
+
+    def build() -> LnurlPayActionResponse:
+        return LnurlPayActionResponse.parse_obj(
+            dict(
+                pr=invoice.serialized,
+                success_action={"tag": "message", "message": "Thanks"},
+                routes=[],
+            )
+        )
+
+    assert benchmark(build).pr == invoice.serialized
+
+
+def test_bench_createinvoice_response_parse(benchmark):
+    invoice = benchmark(CreateInvoiceResponse.parse_obj, json.loads(INVOICE_JSON))
+    assert invoice.amount_sat == 1337
+
+
+def test_bench_tip_page_render(benchmark, settings):
+    template = get_templates().get_template("lnurl-splash.html")
+    context = {
+        "username": settings.username,
+        "lnurl_address": settings.lnurl_address(),
+        "nostr_address": settings.user_nostr_address,
+        "profile_image_url": settings.user_profile_image_url,
+        "meta_description": settings.lnurl_hostname,
+        "meta_author": settings.lnurl_address(),
+        "encoded_lnurl": settings.lnurl_address_encoded(),
+        "lnurl_qr": settings.lnurl_qr(),
+        "smaller_heading": settings.is_long_username(),
+    }
+    assert benchmark(template.render, context).startswith("<!DOCTYPE html>")
+
+
+def test_bench_route_pay_request(benchmark, client):
+    response = benchmark(client.get, "/.well-known/lnurlp/satoshi")
+    assert response.status_code == 200
+
+
+def test_bench_route_callback(benchmark, client):
+    response = benchmark(
+        client.get, "/lnurlp/satoshi/callback", params={"amount": 1337000}
+    )
+    assert response.status_code == 200
+
+
+def test_bench_route_tip_page(benchmark, client):
+    response = benchmark(client.get, "/lnurl")
+    assert response.status_code == 200
+
+
+def test_bench_artifacts_build(benchmark, settings):
+    artifacts = benchmark(LnurlArtifacts.build, settings, eager=True)
+    assert artifacts.tip_page_html is not None
+
+
+def _python(code: str):
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_bench_cold_import(benchmark):
+    benchmark.pedantic(_python, args=("import app.main",), rounds=5)
+    # No stats with --benchmark-disable, which runs it once
+    if benchmark.enabled:
+        assert benchmark.stats.stats.median < IMPORT_TIME_BUDGET
+
+
+def test_bench_cold_app_factory(benchmark):
+    benchmark.pedantic(
+        _python,
+        args=("from app.main import app_factory; app_factory()",),
+        rounds=5,
+    )
+    if benchmark.enabled:
+        assert benchmark.stats.stats.median < STARTUP_TIME_BUDGET
+
+
+@pytest.fixture(scope="module", params=["fast_path", "fastapi"])
+def asgi_app(request):
+    """
+    The app called directly over ASGI, without a test client's overhead, with
+    and without the fast path in `fast_path.py` for comparison
+    """
+    app = app_factory()
+    app.state.settings.fast_path = request.param == "fast_path"
+    app.state.phoenixd_client = PhoenixdMockClient(phoenixd_url="http://127.0.0.1")
+    loop = asyncio.new_event_loop()
+
+    def get(path: str, query_string: bytes = b"") -> int:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "https",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query_string,
+            "headers": [(b"host", b"127.0.0.1"), (b"origin", b"https://example.com")],
+            "client": ("127.0.0.1", 50000),
+            "server": ("127.0.0.1", 443),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        loop.run_until_complete(app(scope, receive, send))
+        return messages[0]["status"]
+
+    yield get
+    loop.close()
+
+
+def test_bench_asgi_pay_request(benchmark, asgi_app):
+    assert benchmark(asgi_app, "/.well-known/lnurlp/satoshi") == 200
+
+
+def test_bench_asgi_callback(benchmark, asgi_app):
+    assert benchmark(asgi_app, "/lnurlp/satoshi/callback", b"amount=1337000") == 200
+
+
+def test_bench_asgi_unknown_user(benchmark, asgi_app):
+    assert benchmark(asgi_app, "/.well-known/lnurlp/notsatoshi") == 404
@@ -0,0 +1,217 @@
+"""
+Opt-in capture of the shape of production traffic, for replaying against a
+build with `python -m app.replay` to compare performance on real traffic
+patterns, e.g. the bursts of payRequests then callbacks from Nostr clients.
+
+With `CAPTURE_FILE` set, each request is recorded as a line of JSON:
+
+    {"t": 1718000000123, "m": "GET", "p": "/lnurlp/{user}/callback",
+     "q": {"amount": 21000000, "comment": 12}, "s": 200, "d": 3.1}
+
+that is, when it arrived (milliseconds since the epoch), the method, path,
+query, response status and milliseconds taken to answer. Records are
+sanitized so a capture can be shared: usernames are replaced by `{user}`
+(this LNURL's) or `{other}`, paths the app doesn't serve are just `other`, and
+query values are replaced by their length, except `amount`, which is kept to
+two significant figures as it decides the response.
+
+Requests only append to an in-memory buffer, written out by a background
+task; the file is rolled over to `CAPTURE_FILE.1` at `CAPTURE_MAX_BYTES`, so
+there's at most twice that on disk.
+"""
+
+import asyncio
+import json
+import math
+import random
+import re
+import time
+from collections import deque
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+from loguru import logger
+from starlette.types import (
+    ASGIApp,
+    Message,
+    Receive,
+    Scope,
+    Send,
+)
+
+from .settings import PhoenixdLNURLSettings
+
+# Path shapes captured, by the `{user}` part's position
+PATH_SHAPES = [
+    (re.compile(r"^/lnurlp/([^/]+)$"), "/lnurlp/{}"),
+    (re.compile(r"^/\.well-known/lnurlp/([^/]+)$"), "/.well-known/lnurlp/{}"),
+    (re.compile(r"^/lnurlp/([^/]+)/callback$"), "/lnurlp/{}/callback"),
+]
+OTHER_PATH = "other"
+STATIC_PATHS = frozenset({"/lnurl", "/admin/payments/export", "/admin/invoices/batch"})
+
+
+def round_amount(amount: str) -> int | None:
+    try:
+        value = int(amount)
+    except ValueError:
+        return None
+    if value <= 0:
+        return value
+    # Two significant figures
+    scale = 10 ** max(int(math.log10(value)) - 1, 0)
+    return round(value / scale) * scale
+
+
+def sanitize_path(path: str, username: str) -> str:
+    if path in STATIC_PATHS:
+        return path
+    for pattern, shape in PATH_SHAPES:
+        if match := pattern.match(path):
+            return shape.format("{user}" if match[1] == username else "{other}")
+    return OTHER_PATH
+
+
+def sanitize_query(query_string: bytes) -> dict[str, int | None]:
+    query: dict[str, int | None] = {}
+    for key, value in parse_qsl(query_string.decode("latin-1"), keep_blank_values=True):
+        query[key] = round_amount(value) if key == "amount" else len(value)
+    return query
+
+
+class TrafficCapture:
+    def __init__(
+        self,
+        path: Path,
+        *,
+        max_bytes: int = 64 * 1024 * 1024,
+        sample_rate: float = 1.0,
+        buffer_size: int = 10_000,
+        flush_interval: float = 1.0,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        # Records that couldn't be buffered as writing had fallen behind
+        self.dropped = 0
+        # Raw, sanitized when written, so requests do as little as possible
+        self._buffer: deque[tuple] = deque()
+        self._task: asyncio.Task | None = None
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def record(
+        self,
+        *,
+        arrived: float,
+        method: str,
+        path: str,
+        query_string: bytes,
+        status_code: int,
+        duration: float,
+        username: str,
+    ):
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append(
+            (arrived, method, path, query_string, status_code, duration, username)
+        )
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception("Could not write traffic to '{path}'", path=self.path)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records = list(self._buffer)
+        self._buffer.clear()
+        await asyncio.to_thread(self._write, records)
+
+    @staticmethod
+    def sanitized(raw: tuple) -> dict:
+        arrived, method, path, query_string, status_code, duration, username = raw
+        return {
+            "t": int(arrived * 1000),
+            "m": method,
+            "p": sanitize_path(path, username),
+            "q": sanitize_query(query_string),
+            "s": status_code,
+            "d": round(duration * 1000, 3),
+        }
+
+    def _write(self, records: list[tuple]):
+        data = "".join(
+            json.dumps(self.sanitized(record), separators=(",", ":")) + "\n"
+            for record in records
+        ).encode("UTF-8")
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if size and size + len(data) > self.max_bytes:
+            self.path.replace(self.path.with_name(self.path.name + ".1"))
+        with open(self.path, "ab") as file:
+            file.write(data)
+
+
+class TrafficCaptureMiddleware:
+    def __init__(self, app: ASGIApp, capture: TrafficCapture):
+        self.app = app
+        self.capture = capture
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.capture.sampled():
+            await self.app(scope, receive, send)
+            return
+        arrived = time.time()
+        started = time.perf_counter()
+        status_code = 500
+
+        async def capturing_send(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capturing_send)
+        finally:
+            settings: PhoenixdLNURLSettings = scope["app"].state.settings
+            self.capture.record(
+                arrived=arrived,
+                method=scope["method"],
+                path=scope["path"],
+                query_string=scope["query_string"],
+                status_code=status_code,
+                duration=time.perf_counter() - started,
+                username=settings.username,
+            )
+
+
+def traffic_capture_for(settings: PhoenixdLNURLSettings) -> TrafficCapture | None:
+    if settings.capture_file is None:
+        return None
+    return TrafficCapture(
+        settings.capture_file,
+        max_bytes=settings.capture_max_bytes,
+        sample_rate=settings.capture_sample_rate,
+    )
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from .capture import (
+    TrafficCapture,
+    round_amount,
+    sanitize_path,
+)
+from .main import app_factory
+from .replay import (
+    load_trace,
+    replay_in_process,
+    request_for,
+)
+
+
+def test_sanitize():
+    assert sanitize_path("/lnurlp/satoshi", "satoshi") == "/lnurlp/{user}"
+    assert (
+        sanitize_path("/.well-known/lnurlp/hal", "satoshi")
+        == "/.well-known/lnurlp/{other}"
+    )
+    assert (
+        sanitize_path("/lnurlp/hal/callback", "satoshi") == "/lnurlp/{other}/callback"
+    )
+    assert sanitize_path("/wp-login.php", "satoshi") == "other"
+    assert round_amount("1337000") == 1300000
+    assert round_amount("21") == 21
+    assert round_amount("-5") == -5
+    assert round_amount("1.5") is None
+
+
+@pytest.mark.asyncio
+async def test_capture_rolls_over(tmp_path):
+    capture = TrafficCapture(tmp_path / "capture.ndjson", max_bytes=4096)
+    for i in range(200):
+        capture.record(
+            arrived=1_700_000_000 + i,
+            method="GET",
+            path="/lnurlp/satoshi/callback",
+            query_string=b"amount=1337000&comment=hello",
+            status_code=200,
+            duration=0.001,
+            username="satoshi",
+        )
+        if i % 10 == 0:
+            await capture.flush()
+    await capture.flush()
+    files = sorted(tmp_path.iterdir())
+    assert [file.name for file in files] == ["capture.ndjson", "capture.ndjson.1"]
+    assert all(file.stat().st_size <= 4096 for file in files)
+    record = json.loads(files[0].read_text().splitlines()[-1])
+    assert record == {
+        "t": 1_700_000_199_000,
+        "m": "GET",
+        "p": "/lnurlp/{user}/callback",
+        "q": {"amount": 1300000, "comment": 5},
+        "s": 200,
+        "d": 1.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_capture_and_replay(tmp_path, monkeypatch):
+    capture_file = tmp_path / "capture.ndjson"
+    monkeypatch.setenv("CAPTURE_FILE", str(capture_file))
+    app = app_factory()
+    with TestClient(app) as client:
+        client.get("/.well-known/lnurlp/satoshi")
+        client.get("/lnurlp/satoshi/callback", params={"amount": 1337000})
+        client.get("/lnurlp/satoshi/callback", params={"amount": 1000})
+        client.get("/lnurlp/hal")
+        client.get("/.env")
+    records = load_trace([capture_file])
+    assert [(r["p"], r["s"]) for r in records] == [
+        ("/.well-known/lnurlp/{user}", 200),
+        ("/lnurlp/{user}/callback", 200),
+        ("/lnurlp/{user}/callback", 400),
+        ("/lnurlp/{other}", 404),
+        ("other", 400),
+    ]
+    assert request_for(records[1], "satoshi") == (
+        "GET",
+        "/lnurlp/satoshi/callback",
+        {"amount": "1300000"},
+    )
+
+    # Replayed with the test settings, whatever's configured
+    monkeypatch.setenv("CALLBACK_RATE_LIMIT", "1")
+    monkeypatch.setenv("SHARED_STATE_URL", "redis://127.0.0.1:1/0")
+    captured = capture_file.read_bytes()
+    report = await replay_in_process(records, speed=100)
+    assert report["status_mismatches"] == {}
+    assert capture_file.read_bytes() == captured
+    assert report["routes"]["GET /lnurlp/{user}/callback"]["count"] == 2
+    assert set(report["routes"]["GET other"]) == {
+        "count",
+        "mean",
+        "p50",
+        "p90",
+        "p99",
+        "max",
+    }
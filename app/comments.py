@@ -0,0 +1,406 @@
+"""
+Comments (LUD-12) and payer data (LUD-18) sent with payments.
+
+They're kept in an append-only log in `COMMENTS_DIR`, one JSON object per line,
+split into segments of up to `COMMENTS_SEGMENT_BYTES`. Each worker writes its
+own segments (named by creation time and process id), and beyond
+`COMMENTS_MAX_SEGMENTS` in the directory the oldest are deleted, whichever
+worker (running or not) wrote them, so disk use is bounded too. A worker whose
+segment was deleted from under it starts a new one.
+The callback only appends to an in-memory buffer, which a background task
+writes out in batches; if writing falls behind the buffer is capped and
+further entries are dropped (and counted) rather than using more memory.
+
+With `TIP_PAGE_COMMENTS` set, the most recent entries are also indexed in
+memory, and marked paid as phoenixd reports payments, for showing the latest
+paid comments on the tip page. On startup the index is read back from the
+newest segments, off the event loop, and from then on other workers' entries
+are read as they're written, every `refresh_interval` seconds, so every worker
+shows the same comments, give or take that long.
+"""
+
+import asyncio
+import html
+import json
+import os
+import time
+from collections import (
+    OrderedDict,
+    deque,
+)
+from collections.abc import Callable
+from pathlib import Path
+from typing import IO
+
+from loguru import logger
+from pydantic import BaseModel
+
+# Marks where recent comments go in the (otherwise static) tip page
+COMMENTS_SLOT = "<!-- recent-comments -->"
+SEGMENT_SUFFIX = ".ndjson"
+
+
+class PaymentNote(BaseModel):
+    # Milliseconds since the epoch, when the invoice was made
+    time: int
+    payment_hash: str
+    amount_sat: int
+    comment: str | None = None
+    payer_data: dict[str, str] | None = None
+    paid: bool = False
+
+
+class CommentStore:
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        segment_bytes: int = 16 * 1024 * 1024,
+        max_segments: int = 8,
+        recent: int = 100,
+        buffer_size: int = 10_000,
+        flush_interval: float = 0.5,
+        follow: bool = False,
+        refresh_interval: float = 2.0,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.recent_size = recent
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        # Index what's on disk, including other workers' entries, as well as
+        # what's added here
+        self.follow = follow
+        self.refresh_interval = refresh_interval
+        # Entries that couldn't be buffered as writing had fallen behind
+        self.dropped = 0
+        # payment hash -> note, oldest first
+        self.recent: OrderedDict[str, PaymentNote] = OrderedDict()
+        self._buffer: deque[str] = deque()
+        self._file: IO[bytes] | None = None
+        self._file_size = 0
+        self._version = 0
+        self._page_cache: tuple[tuple[str, int, int], str] | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._writer: asyncio.Task | None = None
+        self._follower: asyncio.Task | None = None
+        self._lock: asyncio.Lock | None = None
+        # Bytes of each segment read into the index so far
+        self._offsets: dict[Path, int] = {}
+
+    # Writing
+
+    def add(self, note: PaymentNote):
+        """
+        Record a note. Constant time, never waits on disk
+        """
+        self._index(note)
+        self._append({"type": "note", **note.dict(exclude={"paid"})})
+
+    def mark_paid(self, payment_hash: str):
+        note = self.recent.get(payment_hash)
+        if note is None or note.paid:
+            return
+        note.paid = True
+        self._version += 1
+        self._append(
+            {
+                "type": "paid",
+                "time": int(time.time() * 1000),
+                "payment_hash": payment_hash,
+            }
+        )
+
+    def _index(self, note: PaymentNote):
+        self.recent[note.payment_hash] = note
+        self.recent.move_to_end(note.payment_hash)
+        while len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+        if note.paid:
+            self._version += 1
+
+    def _append(self, entry: dict):
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append(json.dumps(entry) + "\n")
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        if self._buffer:
+            self._wakeup.set()
+        self._writer = asyncio.create_task(self._run())
+        if self.follow:
+            self._follower = asyncio.create_task(self._follow())
+
+    async def stop(self):
+        for task in (self._writer, self._follower):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._writer = self._follower = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _run(self):
+        assert self._wakeup is not None
+        while True:
+            await self._wakeup.wait()
+            # Let a batch build up, for fewer, larger writes
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception(
+                    "Could not write comments to '{dir}'", dir=self.directory
+                )
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        lines = list(self._buffer)
+        self._buffer.clear()
+        if self._lock is None:
+            self._write(lines)
+            return
+        async with self._lock:
+            await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines: list[str]):
+        data = "".join(lines).encode("UTF-8")
+        if (
+            self._file is None
+            or (self._file_size and self._file_size + len(data) > self.segment_bytes)
+            # Deleted by another worker rotating
+            or os.fstat(self._file.fileno()).st_nlink == 0
+        ):
+            self._rotate()
+        assert self._file is not None
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+
+    def _segments(self) -> list[Path]:
+        # Named by creation time and then the writer's process id, so sorting
+        # by name is oldest first
+        return sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # NOTE the process id when writing, not when made, as with `PRELOAD`
+        # stores are made before workers are forked
+        writer = str(os.getpid())
+        path = self.directory / f"{time.time_ns():020d}-{writer}{SEGMENT_SUFFIX}"
+        self._file = open(path, "ab")  # noqa: SIM115, kept open across writes
+        self._file_size = 0
+        for old in self._segments()[: -self.max_segments]:
+            old.unlink(missing_ok=True)
+
+    # Indexing what's on disk
+
+    async def load(self):
+        """
+        Index the newest notes on disk, e.g. on startup
+        """
+        self._merge(*await asyncio.to_thread(self._read_newest))
+
+    async def _follow(self):
+        try:
+            await self.load()
+        except OSError:
+            logger.exception("Could not read comments in '{dir}'", dir=self.directory)
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                self._merge(*await asyncio.to_thread(self._read_new))
+            except OSError:
+                logger.exception(
+                    "Could not read comments in '{dir}'", dir=self.directory
+                )
+
+    def _read_from(
+        self, segment: Path, notes: list[PaymentNote], paid: set[str]
+    ) -> None:
+        """
+        Parse what's been written to `segment` since last read, up to its last
+        complete line
+        """
+        offset = self._offsets.get(segment, 0)
+        try:
+            with open(segment, "rb") as file:
+                file.seek(offset)
+                data = file.read()
+        except FileNotFoundError:
+            return
+        data = data[: data.rfind(b"\n") + 1]
+        self._offsets[segment] = offset + len(data)
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+                if entry.pop("type") == "note":
+                    notes.append(PaymentNote.parse_obj(entry))
+                else:
+                    paid.add(entry["payment_hash"])
+            except (ValueError, KeyError):
+                continue
+
+    def _read_newest(self) -> tuple[list[PaymentNote], set[str]]:
+        """
+        The newest `recent` notes across every segment, and payments, reading
+        segments last written to first until older ones can't hold newer notes
+        """
+        notes: list[PaymentNote] = []
+        paid: set[str] = set()
+        if not self.directory.is_dir():
+            return notes, paid
+        segments = []
+        for segment in self._segments():
+            try:
+                stat = segment.stat()
+            except FileNotFoundError:
+                continue
+            segments.append((stat.st_mtime_ns // 1_000_000, stat.st_size, segment))
+        segments.sort(reverse=True)
+        for i, (_, _, segment) in enumerate(segments):
+            self._read_from(segment, notes, paid)
+            notes = sorted(notes, key=lambda note: note.time)[-self.recent_size :]
+            # NOTE notes are written after they're made, so none in a segment
+            # are newer than when it was last written to
+            if (
+                len(notes) >= self.recent_size
+                and i + 1 < len(segments)
+                and notes[0].time > segments[i + 1][0]
+            ):
+                for _, size, older in segments[i + 1 :]:
+                    self._offsets[older] = size
+                break
+        return notes, paid
+
+    def _read_new(self) -> tuple[list[PaymentNote], set[str]]:
+        """
+        Notes and payments other workers have written since last read
+        """
+        notes: list[PaymentNote] = []
+        paid: set[str] = set()
+        segments = self._segments() if self.directory.is_dir() else []
+        present = set(segments)
+        own = f"-{os.getpid()}{SEGMENT_SUFFIX}"
+        for segment in segments:
+            if not segment.name.endswith(own):
+                self._read_from(segment, notes, paid)
+        # Forget deleted segments
+        self._offsets = {
+            segment: offset
+            for segment, offset in self._offsets.items()
+            if segment in present
+        }
+        return notes, paid
+
+    def _merge(self, notes: list[PaymentNote], paid: set[str]) -> None:
+        if not notes and not paid:
+            return
+        for note in notes:
+            if note.payment_hash not in self.recent:
+                self.recent[note.payment_hash] = note
+        for payment_hash in paid:
+            if payment_hash in self.recent:
+                self.recent[payment_hash].paid = True
+        # Workers' notes interleaved, oldest first
+        ordered = sorted(self.recent.values(), key=lambda note: note.time)
+        self.recent = OrderedDict(
+            (note.payment_hash, note) for note in ordered[-self.recent_size :]
+        )
+        self._version += 1
+
+    # Reading
+
+    def recent_paid(self, limit: int) -> list[PaymentNote]:
+        """
+        The latest paid notes with a comment, newest first
+        """
+        notes = []
+        for note in reversed(self.recent.values()):
+            if note.paid and note.comment:
+                notes.append(note)
+                if len(notes) >= limit:
+                    break
+        return notes
+
+    def render_recent(self, limit: int) -> str:
+        notes = self.recent_paid(limit)
+        if not notes:
+            return ""
+        items = "".join(
+            "<li><strong>⚡️ {amount} sats</strong>{name}<br>{comment}</li>".format(
+                amount=f"{note.amount_sat:,}",
+                name=(
+                    f" from {html.escape(note.payer_data['name'])}"
+                    if note.payer_data and note.payer_data.get("name")
+                    else ""
+                ),
+                comment=html.escape(note.comment or ""),
+            )
+            for note in notes
+        )
+        return (
+            '<div class="card comments"><div class="content">'
+            f"<h2>Recent zaps</h2><ul>{items}</ul></div></div>"
+        )
+
+    def tip_page(self, page: str, limit: int) -> str:
+        """
+        `page` with recent comments filled in, only re-rendered when they change
+        """
+        key = (page, self._version, limit)
+        if self._page_cache is None or self._page_cache[0] != key:
+            self._page_cache = (
+                key,
+                page.replace(COMMENTS_SLOT, self.render_recent(limit)),
+            )
+        return self._page_cache[1]
+
+
+async def watch_payments(
+    store: CommentStore,
+    client_of,
+    retry_after: float = 5.0,
+    on_paid: Callable[[str], None] | None = None,
+):
+    """
+    Mark notes paid as phoenixd reports payments, also passing each payment
+    hash to `on_paid`. `client_of` gives the current phoenixd client, which
+    can change when settings are reloaded
+    """
+    while True:
+        try:
+            async for event in client_of().payments_websocket():
+                store.mark_paid(event.payment_hash)
+                if on_paid is not None:
+                    on_paid(event.payment_hash)
+        except NotImplementedError:
+            logger.debug("phoenixd client has no payment events, not watching")
+            return
+        except Exception as exc:
+            logger.warning(
+                "Lost payment events from phoenixd, retrying: {exc!r}", exc=exc
+            )
+        await asyncio.sleep(retry_after)
+
+
+def comment_store_for(settings) -> CommentStore:
+    return CommentStore(
+        settings.comments_dir,
+        segment_bytes=settings.comments_segment_bytes,
+        max_segments=settings.comments_max_segments,
+        # Only needed to show comments on the tip page
+        follow=bool(settings.tip_page_comments),
+    )
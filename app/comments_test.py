@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from . import comments
+from .artifacts import LnurlArtifacts
+from .comments import (
+    CommentStore,
+    PaymentNote,
+)
+from .main import app_factory
+from .payer_data import (
+    parse_payer_data,
+    payer_data_description_hash,
+)
+
+
+def note(i: int, **kwargs) -> PaymentNote:
+    return PaymentNote(
+        time=1_704_067_200_000 + i,
+        payment_hash=f"{i:064x}",
+        amount_sat=1000 + i,
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_comment_store(tmp_path):
+    store = CommentStore(tmp_path, recent=3, flush_interval=0)
+    store.start()
+    for i in range(5):
+        store.add(note(i, comment=f"<b>zap {i}</b>"))
+    store.mark_paid(f"{4:064x}")
+    store.mark_paid(f"{2:064x}")
+    # Too old to still be indexed
+    store.mark_paid(f"{0:064x}")
+    assert [n.comment for n in store.recent_paid(10)] == [
+        "<b>zap 4</b>",
+        "<b>zap 2</b>",
+    ]
+    html = store.render_recent(1)
+    assert "&lt;b&gt;zap 4&lt;/b&gt;" in html
+    assert "zap 2" not in html
+    await store.stop()
+
+    lines = [
+        json.loads(line)
+        for segment in sorted(tmp_path.glob("*.ndjson"))
+        for line in segment.read_text().splitlines()
+    ]
+    assert [line["type"] for line in lines] == ["note"] * 5 + ["paid"] * 2
+
+    # The index is rebuilt from disk, e.g. on restart
+    reloaded = CommentStore(tmp_path, recent=3, follow=True)
+    assert not reloaded.recent
+    await reloaded.load()
+    assert list(reloaded.recent) == list(store.recent)
+    assert reloaded.recent_paid(10) == store.recent_paid(10)
+
+
+@pytest.mark.asyncio
+async def test_comment_store_is_bounded(tmp_path):
+    # Left by a worker that has since exited
+    exited = tmp_path / f"{0:020d}-99999.ndjson"
+    exited.write_text("")
+    store = CommentStore(tmp_path, segment_bytes=4096, max_segments=2, buffer_size=50)
+    for i in range(60):
+        store.add(note(i, comment="x" * 200))
+    # Writing hadn't caught up, so some were dropped rather than buffered
+    assert store.dropped == 10
+    await store.stop()
+    for i in range(60, 200):
+        store.add(note(i, comment="x" * 200))
+        await store.flush()
+    segments = list(tmp_path.glob("*.ndjson"))
+    assert len(segments) == 2
+    assert not exited.exists()
+    assert all(segment.stat().st_size <= 4096 for segment in segments)
+
+
+@pytest.mark.asyncio
+async def test_comment_stores_share_a_directory(tmp_path, monkeypatch):
+    first, second = (
+        CommentStore(tmp_path, segment_bytes=4096, max_segments=4, recent=5)
+        for _ in range(2)
+    )
+    for i in range(100):
+        # Workers, e.g. gunicorn's, each with their own process id
+        store, pid = (first, 1001) if i % 2 else (second, 1002)
+        monkeypatch.setattr(comments.os, "getpid", lambda pid=pid: pid)
+        store.add(note(i, comment="x" * 200))
+        await store.flush()
+    first.mark_paid(f"{99:064x}")
+    await first.flush()
+
+    # The newest segments are kept, whichever worker wrote them
+    assert len(list(tmp_path.glob("*.ndjson"))) == 4
+
+    # Rebuilt from both, in the order the notes were made
+    reloaded = CommentStore(tmp_path, recent=5, follow=True)
+    await reloaded.load()
+    assert list(reloaded.recent) == [f"{i:064x}" for i in range(95, 100)]
+    assert [n.payment_hash for n in reloaded.recent_paid(10)] == [f"{99:064x}"]
+
+    # A worker whose segment was deleted by another's rotating starts a new one
+    assert second._file is not None
+    (tmp_path / second._file.name).unlink(missing_ok=True)
+    monkeypatch.setattr(comments.os, "getpid", lambda: 1002)
+    second.add(note(100))
+    await second.flush()
+    assert f"{100:064x}" in (tmp_path / second._file.name).read_text()
+
+    # And then followed by the others
+    monkeypatch.setattr(comments.os, "getpid", lambda: 1003)
+    reloaded._merge(*reloaded._read_new())
+    assert list(reloaded.recent) == [f"{i:064x}" for i in range(96, 101)]
+    for store in (first, second):
+        await store.stop()
+
+
+@pytest.mark.asyncio
+async def test_comment_store_reads_only_newest(tmp_path, monkeypatch):
+    # Last written to before any of the newer notes were made
+    old = tmp_path / f"{0:020d}-99999.ndjson"
+    old.write_text(json.dumps({"type": "note", **note(0).dict()}) + "\n")
+    os.utime(old, ns=(0, 0))
+    store = CommentStore(tmp_path, recent=2, flush_interval=0)
+    for i in range(1, 4):
+        store.add(note(i))
+    await store.flush()
+
+    reloaded = CommentStore(tmp_path, recent=2, follow=True, refresh_interval=0)
+    monkeypatch.setattr(comments.os, "getpid", lambda: 1003)
+    reloaded.start()
+    while len(reloaded.recent) < 2:
+        await asyncio.sleep(0.01)
+    assert list(reloaded.recent) == [f"{i:064x}" for i in (2, 3)]
+    # Never read
+    assert reloaded._offsets[old] == old.stat().st_size
+
+    # Then followed
+    store.add(note(4))
+    await store.flush()
+    while f"{4:064x}" not in reloaded.recent:
+        await asyncio.sleep(0.01)
+    assert list(reloaded.recent) == [f"{i:064x}" for i in (3, 4)]
+    await reloaded.stop()
+
+
+def test_tip_page_comments(tmp_path):
+    store = CommentStore(tmp_path)
+    page = "<p>before</p><!-- recent-comments --><p>after</p>"
+    assert store.tip_page(page, 5) == "<p>before</p><p>after</p>"
+    store.add(note(1, comment="gm", payer_data={"name": "Hal"}))
+    store.mark_paid(f"{1:064x}")
+    assert "⚡️ 1,001 sats</strong> from Hal<br>gm" in store.tip_page(page, 5)
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        "[]",
+        "{",
+        '{"auth": {"key": "02"}}',
+        '{"name": 1}',
+        json.dumps({"name": "x" * 257}),
+        json.dumps({"email": "x" * 3000}),
+    ],
+)
+def test_parse_payer_data_invalid(raw):
+    with pytest.raises(ValueError):
+        parse_payer_data(raw)
+
+
+def test_callback_comments_and_payer_data(tmp_path):
+    app = app_factory()
+    settings = app.state.settings.copy(
+        update={"comment_allowed": 10, "payer_data": True, "tip_page_comments": 5}
+    )
+    app.state.settings = settings
+    app.state.artifacts = LnurlArtifacts.build(settings)
+    app.state.comment_store = CommentStore(tmp_path)
+    with TestClient(app) as client:
+        descriptions = []
+        createinvoice = app.state.phoenixd_client.createinvoice
+
+        async def recording_createinvoice(**kwargs):
+            descriptions.append(kwargs["description_hash"])
+            return await createinvoice(**kwargs)
+
+        app.state.phoenixd_client.createinvoice = recording_createinvoice
+        pay_request = client.get("/.well-known/lnurlp/satoshi").json()
+        assert pay_request["commentAllowed"] == 10
+        assert set(pay_request["payerData"]) == {
+            "name",
+            "pubkey",
+            "identifier",
+            "email",
+        }
+
+        url = "/lnurlp/satoshi/callback"
+        response = client.get(url, params={"amount": 1337000, "comment": "x" * 11})
+        assert response.status_code == 400
+        assert response.json()["reason"] == (
+            "Comment is too long, maximum is 10 characters"
+        )
+        response = client.get(url, params={"amount": 1337000, "payerdata": "[]"})
+        assert response.status_code == 400
+
+        payer_data = json.dumps({"name": "Hal"})
+        response = client.get(
+            url,
+            params={"amount": 1337000, "comment": "gm", "payerdata": payer_data},
+        )
+        assert response.status_code == 200
+        (stored,) = app.state.comment_store.recent.values()
+        assert stored.comment == "gm"
+        assert stored.payer_data == {"name": "Hal"}
+        assert stored.amount_sat == 1337
+        # The invoice commits to the payer data too
+        assert descriptions[-1] == payer_data_description_hash(
+            app.state.artifacts.metadata, payer_data
+        )
+
+        app.state.comment_store.mark_paid(stored.payment_hash)
+        assert "gm" in client.get("/lnurl").text
+
+
+def test_callback_ignores_comments_when_off(tmp_path):
+    app = app_factory()
+    app.state.comment_store = CommentStore(tmp_path)
+    with TestClient(app) as client:
+        assert "commentAllowed" not in client.get("/lnurlp/satoshi").json()
+        response = client.get(
+            "/lnurlp/satoshi/callback",
+            params={"amount": 1337000, "comment": "x" * 3000},
+        )
+        assert response.status_code == 200
+    assert not app.state.comment_store.recent
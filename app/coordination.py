@@ -0,0 +1,340 @@
+"""
+What hosts share through `SHARED_STATE_URL` (see `shared_state.py`), without
+it costing the payRequest path a round trip.
+
+Requests only touch in-memory buffers here. Every
+`SHARED_STATE_FLUSH_INTERVAL` seconds a background task sends what's buffered
+as one batch, and keeps the totals it gets back:
+
+- rate-limit counters, for `CALLBACK_RATE_LIMIT`: each host adds the callbacks
+  it counted since the last flush to the total across hosts as of the last
+  flush, so a limit holds across hosts give or take a flush interval's worth
+- issued invoices, recorded as they're made, so any host can tell which host
+  issued an invoice, when and for how much
+- payment statuses, recorded as phoenixd reports payments, or once looked up,
+  so each payment is only asked of phoenixd once
+
+`GET /admin/invoices/{payment_hash}` reads the last two. If the shared state
+can't be reached, counts are kept for the next flush, records are kept up to
+a limit (then dropped and counted), and requests carry on with what this host
+knows. Counters are capped in number too, so a flood of client addresses
+can't use up memory.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Annotated
+
+import aiohttp
+from fastapi import (
+    APIRouter,
+    Header,
+    Path,
+    status,
+)
+from fastapi.requests import Request
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+)
+from lnurl import LnurlErrorResponse
+from loguru import logger
+from pydantic import ValidationError
+from starlette.types import Scope
+
+from .export import check_admin
+from .phoenixd_client import (
+    CreateInvoiceResponse,
+    PhoenixdClientBase,
+)
+from .settings import PhoenixdLNURLSettings
+from .shared_state import (
+    SharedStateBase,
+    SharedStateError,
+    StateBatch,
+    shared_state_for,
+)
+
+# Identifies this process in the records it shares
+HOST = f"{socket.gethostname()}:{os.getpid()}"
+# Seconds records are kept for
+INVOICE_TTL = 24 * 60 * 60
+PAID_TTL = 7 * 24 * 60 * 60
+
+coordination_router = APIRouter()
+
+
+class SharedStateSync:
+    def __init__(
+        self,
+        backend: SharedStateBase,
+        *,
+        flush_interval: float = 0.5,
+        buffer_size: int = 10_000,
+        max_keys: int = 100_000,
+    ):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_keys = max_keys
+        # Records that couldn't be buffered as the shared state was unreachable,
+        # and counts or totals that couldn't be kept for too many keys
+        self.dropped = 0
+        # Counted here since the last flush: key -> (count, ttl)
+        self._pending: dict[str, tuple[int, float]] = {}
+        # Totals across hosts as of the last flush: key -> (total, expiry)
+        self._totals: dict[str, tuple[int, float]] = {}
+        # Records to write: key -> (value, ttl)
+        self._writes: dict[str, tuple[str, float]] = {}
+        self._failing = False
+        self._task: asyncio.Task | None = None
+
+    def count(self, key: str, ttl: float) -> int:
+        """
+        Count one more for `key`, returning the total across hosts as best
+        known. Constant time, never waits on the shared state
+        """
+        total, _ = self._totals.get(key, (0, 0.0))
+        pending, _ = self._pending.get(key, (0, ttl))
+        if not pending and len(self._pending) >= self.max_keys:
+            self.dropped += 1
+            return total + 1
+        self._pending[key] = (pending + 1, ttl)
+        return total + pending + 1
+
+    def put(self, key: str, value: str, ttl: float):
+        if len(self._writes) >= self.buffer_size and key not in self._writes:
+            self.dropped += 1
+            return
+        self._writes[key] = (value, ttl)
+
+    async def get_many(self, keys: list[str]) -> dict[str, str | None]:
+        """
+        Read `keys`, including records not flushed yet. A round trip, so not
+        for the payRequest path
+        """
+        batch = StateBatch()
+        for key in keys:
+            batch.get(key)
+        values = (await self.backend.execute(batch)).values
+        for key in keys:
+            if key in self._writes:
+                values[key] = self._writes[key][0]
+        return values
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except SharedStateError as exc:
+            logger.warning("Could not flush shared state: {exc}", exc=exc)
+        await self.backend.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except SharedStateError as exc:
+                if not self._failing:
+                    logger.warning(
+                        "Shared state unreachable, using what this host knows: {exc}",
+                        exc=exc,
+                    )
+                self._failing = True
+                continue
+            if self._failing:
+                logger.info("Shared state reachable again")
+                self._failing = False
+
+    async def flush(self):
+        now = time.monotonic()
+        self._totals = {
+            key: entry for key, entry in self._totals.items() if entry[1] > now
+        }
+        if not self._pending and not self._writes and not self._totals:
+            return
+        pending, self._pending = self._pending, {}
+        writes, self._writes = self._writes, {}
+        batch = StateBatch()
+        for key, (amount, ttl) in pending.items():
+            batch.incr(key, amount, ttl)
+        for key, (_, expiry) in self._totals.items():
+            # NOTE a whole millisecond left at least, as the shared state
+            # takes expiries in those and refuses 0
+            if key not in pending and expiry - now >= 0.001:
+                # Counted by nothing here since, but maybe by other hosts
+                batch.incr(key, 0, expiry - now)
+        for key, (value, ttl) in writes.items():
+            batch.set(key, value, ttl)
+        try:
+            result = await self.backend.execute(batch)
+        except BaseException:
+            # Kept for the next flush, along with anything since
+            for key, (amount, ttl) in pending.items():
+                since, _ = self._pending.get(key, (0, ttl))
+                if not since and len(self._pending) >= self.max_keys:
+                    self.dropped += 1
+                    continue
+                self._pending[key] = (amount + since, ttl)
+            for key, (value, ttl) in writes.items():
+                if key not in self._writes:
+                    self.put(key, value, ttl)
+            raise
+        now = time.monotonic()
+        for key, total in result.counts.items():
+            if key in pending:
+                if key not in self._totals and len(self._totals) >= self.max_keys:
+                    self.dropped += 1
+                    continue
+                self._totals[key] = (total, now + pending[key][1])
+            else:
+                self._totals[key] = (total, self._totals[key][1])
+
+
+def shared_state_sync_for(settings: PhoenixdLNURLSettings) -> SharedStateSync:
+    return SharedStateSync(
+        shared_state_for(settings),
+        flush_interval=settings.shared_state_flush_interval,
+    )
+
+
+def client_id(scope: Scope, proxy_hops: int) -> str:
+    """
+    The client's address as seen by the outermost of `proxy_hops` reverse
+    proxies, each of which appends the address it got the request from to
+    X-Forwarded-For. Addresses to the left of those are whatever the client
+    sent, so can't be trusted
+    """
+    if proxy_hops:
+        forwarded_for = b",".join(
+            value for name, value in scope["headers"] if name == b"x-forwarded-for"
+        )
+        if forwarded_for:
+            hops = [hop.strip() for hop in forwarded_for.decode("latin-1").split(",")]
+            return hops[max(len(hops) - proxy_hops, 0)]
+    # NOTE under uvicorn with proxy headers on (as under gunicorn) this is the
+    # rightmost X-Forwarded-For address not appended by a proxy it trusts, by
+    # default those on localhost
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def over_rate_limit(
+    sync: SharedStateSync, settings: PhoenixdLNURLSettings, scope: Scope
+) -> bool:
+    """
+    Count a callback from this request's client, and whether it's one more
+    than `CALLBACK_RATE_LIMIT` in the current window
+    """
+    if not settings.callback_rate_limit:
+        return False
+    window = settings.callback_rate_window
+    # Windows start at the same time on every host, with synced clocks
+    client = client_id(scope, settings.trusted_proxy_hops)
+    key = f"ratelimit:{int(time.time() // window)}:{client}"
+    return sync.count(key, ttl=window) > settings.callback_rate_limit
+
+
+def record_invoice(
+    sync: SharedStateSync, invoice: CreateInvoiceResponse, amount_sat: int
+):
+    sync.put(
+        f"invoice:{invoice.payment_hash}",
+        json.dumps(
+            {
+                "amount_sat": amount_sat,
+                "created_at": int(time.time() * 1000),
+                "host": HOST,
+            }
+        ),
+        INVOICE_TTL,
+    )
+
+
+def record_paid(sync: SharedStateSync, payment_hash: str):
+    sync.put(
+        f"paid:{payment_hash}",
+        json.dumps({"seen_at": int(time.time() * 1000), "host": HOST}),
+        PAID_TTL,
+    )
+
+
+async def invoice_status(
+    sync: SharedStateSync, client: PhoenixdClientBase, payment_hash: str
+) -> dict | None:
+    """
+    What's known of an invoice across hosts, asking phoenixd whether it's
+    paid only if no host knows yet. None if it's not known at all
+    """
+    invoice_key, paid_key = f"invoice:{payment_hash}", f"paid:{payment_hash}"
+    values = await sync.get_many([invoice_key, paid_key])
+    issued = values[invoice_key]
+    paid = values[paid_key] is not None
+    if not paid:
+        try:
+            payment = await client.incoming_payment_hash(payment_hash)
+        except (
+            aiohttp.ClientError,
+            TimeoutError,
+            ValidationError,
+            NotImplementedError,
+        ) as exc:
+            logger.debug(
+                "Could not look up payment {payment_hash}: {exc!r}",
+                payment_hash=payment_hash,
+                exc=exc,
+            )
+        else:
+            if payment.is_paid:
+                record_paid(sync, payment_hash)
+                paid = True
+    if issued is None and not paid:
+        return None
+    return {
+        "payment_hash": payment_hash,
+        "issued": json.loads(issued) if issued is not None else None,
+        "paid": paid,
+    }
+
+
+@coordination_router.get(
+    path="/admin/invoices/{payment_hash}",
+    summary="Look up an invoice issued by any host",
+    description="Which host issued an invoice, when and for how much, and whether it's paid",
+    operation_id="admin-invoice-status",
+)
+async def admin_invoice_status(
+    request: Request,
+    payment_hash: Annotated[str, Path(regex=r"^[0-9a-f]{64}$")],
+    authorization: Annotated[str | None, Header()] = None,
+) -> Response:
+    if (denied := check_admin(request, authorization)) is not None:
+        return denied
+    try:
+        found = await invoice_status(
+            request.app.state.shared_state,
+            request.app.state.phoenixd_client,
+            payment_hash,
+        )
+    except SharedStateError as exc:
+        logger.warning("Could not read shared state: {exc}", exc=exc)
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=LnurlErrorResponse(reason="Shared state unavailable").dict(),
+        )
+    if found is None:
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content=LnurlErrorResponse(reason="Unknown invoice").dict(),
+        )
+    return JSONResponse(found)
@@ -0,0 +1,184 @@
+import contextlib
+import time
+
+import httpx
+import pytest
+
+from .coordination import (
+    SharedStateSync,
+    client_id,
+    record_paid,
+)
+from .main import app_factory
+from .shared_state import (
+    InProcessSharedState,
+    RespSharedState,
+    SharedStateError,
+)
+from .shared_state_test import standin_url
+
+# The mock client's invoices all have this payment hash
+PAYMENT_HASH = "30cf1dfc68ab7c5cd1c79c060d26d001e361e42b19f8cc109178d49833259e92"
+
+
+@pytest.mark.asyncio
+async def test_counts_across_hosts():
+    async with standin_url() as (_, url):
+        first = SharedStateSync(RespSharedState(url))
+        second = SharedStateSync(RespSharedState(url))
+        for _ in range(3):
+            first.count("ratelimit:client", ttl=60)
+        assert second.count("ratelimit:client", ttl=60) == 1
+        second.count("ratelimit:client", ttl=60)
+        await first.flush()
+        await second.flush()
+        # Each host's own counts since, plus the total as of its last flush
+        assert second.count("ratelimit:client", ttl=60) == 6
+        # Totals are read back even with nothing new counted
+        await first.flush()
+        assert first.count("ratelimit:client", ttl=60) == 6
+        await first.stop()
+        await second.stop()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_shared_state():
+    async with standin_url() as (_, url):
+        pass
+    sync = SharedStateSync(RespSharedState(url, timeout=0.5), buffer_size=2)
+    sync.count("ratelimit:client", ttl=60)
+    for i in range(3):
+        sync.put(f"record:{i}", "x", ttl=60)
+    assert sync.dropped == 1
+    with pytest.raises(SharedStateError):
+        await sync.flush()
+    # Counts kept for the next flush, with what's counted since
+    assert sync.count("ratelimit:client", ttl=60) == 2
+    assert sync.dropped == 1
+    await sync.stop()
+
+
+@pytest.mark.asyncio
+async def test_counters_are_capped():
+    sync = SharedStateSync(InProcessSharedState(), max_keys=2)
+    for client in ("a", "b", "c"):
+        assert sync.count(f"ratelimit:{client}", ttl=60) == 1
+    assert sync.dropped == 1
+    # Known keys are still counted
+    assert sync.count("ratelimit:a", ttl=60) == 2
+    await sync.flush()
+    assert sync.count("ratelimit:c", ttl=60) == 1
+    assert sync.count("ratelimit:d", ttl=60) == 1
+    await sync.flush()
+    # Over the cap of totals kept
+    assert sync.count("ratelimit:d", ttl=60) == 1
+    assert sync.dropped == 3
+
+
+@pytest.mark.asyncio
+async def test_flush_skips_counters_about_to_expire():
+    async with standin_url() as (standin, url):
+        sync = SharedStateSync(RespSharedState(url))
+        sync.count("ratelimit:client", ttl=60)
+        await sync.flush()
+        key, (total, _) = next(iter(sync._totals.items()))
+        sync._totals[key] = (total, time.monotonic() + 0.0005)
+        # Rather than re-reading it with an expiry of 0, which is refused
+        await sync.flush()
+        assert standin.stats["commands"] == 2 + 2
+        await sync.stop()
+
+
+@pytest.mark.parametrize(
+    "forwarded_for,proxy_hops,client",
+    [
+        (None, 1, "10.0.0.1"),
+        ("203.0.113.7", 1, "203.0.113.7"),
+        # Anything a client sends is left of what the proxy appends
+        ("spoofed, 203.0.113.7", 1, "203.0.113.7"),
+        ("spoofed, 203.0.113.7, 10.0.0.2", 2, "203.0.113.7"),
+        ("203.0.113.7", 3, "203.0.113.7"),
+        ("spoofed", 0, "10.0.0.1"),
+    ],
+)
+def test_client_id(forwarded_for, proxy_hops, client):
+    headers = (
+        [] if forwarded_for is None else [(b"x-forwarded-for", forwarded_for.encode())]
+    )
+    scope = {"type": "http", "client": ("10.0.0.1", 1234), "headers": headers}
+    assert client_id(scope, proxy_hops) == client
+
+
+@contextlib.asynccontextmanager
+async def serving(monkeypatch, url: str, fast_path: str = "1"):
+    monkeypatch.setenv("SHARED_STATE_URL", url)
+    monkeypatch.setenv("CALLBACK_RATE_LIMIT", "3")
+    monkeypatch.setenv("ADMIN_TOKEN", "hunter2")
+    monkeypatch.setenv("FAST_PATH", fast_path)
+    # Behind a proxy
+    monkeypatch.setenv("TRUSTED_PROXY_HOPS", "1")
+    app = app_factory()
+    async with (
+        app.router.lifespan_context(app),
+        httpx.AsyncClient(
+            # NOTE mypy unhappy with FastAPI's ASGI signature but it's correct
+            transport=httpx.ASGITransport(app=app),  # type: ignore[arg-type]
+            base_url="http://host",
+        ) as client,
+    ):
+        yield app, client
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fast_path", ["1", "0"])
+async def test_rate_limit_across_hosts(monkeypatch, fast_path):
+    async with (
+        standin_url() as (_, url),
+        serving(monkeypatch, url, fast_path) as (first, first_client),
+        serving(monkeypatch, url, fast_path) as (second, second_client),
+    ):
+        callback = "/lnurlp/satoshi/callback?amount=1337000"
+        for _ in range(2):
+            assert (await first_client.get(callback)).status_code == 200
+        await first.state.shared_state.flush()
+        # Not limited until it's flushed and learned the first host's count
+        assert (await second_client.get(callback)).status_code == 200
+        await second.state.shared_state.flush()
+        limited = await second_client.get(callback)
+        assert limited.status_code == 429
+        assert limited.json() == {
+            "status": "ERROR",
+            "reason": "Too many invoices requested, try again later",
+        }
+        # Requests that don't make invoices aren't limited
+        pay_request = await second_client.get("/.well-known/lnurlp/satoshi")
+        assert pay_request.status_code == 200
+        # Nor can it be dodged by sending X-Forwarded-For, which the proxy
+        # appends the client's actual address to
+        spoofed = {"X-Forwarded-For": "203.0.113.7, 127.0.0.1"}
+        limited = await second_client.get(callback, headers=spoofed)
+        assert limited.status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_invoice_status_across_hosts(monkeypatch):
+    async with (
+        standin_url() as (_, url),
+        serving(monkeypatch, url) as (first, first_client),
+        serving(monkeypatch, url) as (second, second_client),
+    ):
+        headers = {"Authorization": "Bearer hunter2"}
+        lookup = f"/admin/invoices/{PAYMENT_HASH}"
+        assert (await second_client.get(lookup, headers=headers)).status_code == 404
+
+        await first_client.get("/lnurlp/satoshi/callback?amount=1337000")
+        await first.state.shared_state.flush()
+        found = (await second_client.get(lookup, headers=headers)).json()
+        assert found["issued"]["amount_sat"] == 1337
+        assert found["paid"] is False
+
+        record_paid(first.state.shared_state, PAYMENT_HASH)
+        await first.state.shared_state.flush()
+        found = (await second_client.get(lookup, headers=headers)).json()
+        assert found["paid"] is True
+        assert (await second_client.get(lookup)).status_code == 401
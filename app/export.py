@@ -0,0 +1,336 @@
+"""
+Export of received payments as NDJSON or CSV, e.g. to reconcile zaps with
+accounting, from the admin endpoint:
+
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" \\
+        "https://example.com/admin/payments/export?format=csv&from=2024-01-01"
+
+or from the command line, talking to phoenixd directly:
+
+    python -m app.export --format csv --from 2024-01-01 --output payments.csv
+
+Payments are paged through newest first, one page at a time, so memory use
+is bounded however many there are, and streamed out as they arrive.
+"""
+
+import argparse
+import asyncio
+import csv
+import hmac
+import io
+import json
+import sys
+import time
+from collections.abc import AsyncIterator
+from datetime import (
+    datetime,
+    timezone,
+)
+from typing import (
+    Annotated,
+    Literal,
+)
+
+import aiohttp
+from fastapi import (
+    APIRouter,
+    Header,
+    Query,
+    status,
+)
+from fastapi.requests import Request
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from lnurl import LnurlErrorResponse
+
+from .artifacts import load_artifacts
+from .phoenixd_client import (
+    IncomingPayment,
+    PhoenixdClientBase,
+    phoenixd_client_for,
+)
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+)
+
+ExportFormat = Literal["ndjson", "csv"]
+
+PAGE_SIZE = 500
+EXPORT_FIELDS = (
+    "completed_at",
+    "created_at",
+    "payment_hash",
+    "received_sat",
+    "fees",
+    "external_id",
+    "description",
+    "preimage",
+    "invoice",
+)
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+admin_router = APIRouter()
+
+
+def _to_ms(moment: datetime | None) -> int | None:
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def _iso(ms: int | None) -> str | None:
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat()
+
+
+def _received_at(payment: IncomingPayment) -> int:
+    return payment.completed_at or payment.created_at
+
+
+async def iter_incoming_payments(
+    client: PhoenixdClientBase,
+    *,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    external_id: str | None = None,
+    page_size: int = PAGE_SIZE,
+) -> AsyncIterator[IncomingPayment]:
+    """
+    Every payment received between `since` and `until` (inclusive), newest
+    first, fetching a page at a time.
+
+    Pages are keyed by time rather than offset: each page ends the time range
+    of the next, so payments arriving mid-export can't shift pages and cause
+    skips or repeats. The offset only counts past payments received in the
+    same millisecond as the end of the range.
+    """
+    to_ms = _to_ms(until) or int(time.time() * 1000)
+    offset = 0
+    while True:
+        page = await client.incoming_payments(
+            from_ms=_to_ms(since),
+            to_ms=to_ms,
+            limit=page_size,
+            offset=offset,
+            external_id=external_id,
+        )
+        for payment in page:
+            yield payment
+        if len(page) < page_size:
+            return
+        last = _received_at(page[-1])
+        at_last = sum(1 for payment in page if _received_at(payment) == last)
+        if last == to_ms:
+            offset += at_last
+        else:
+            to_ms = last
+            offset = at_last
+
+
+def export_record(payment: IncomingPayment) -> dict:
+    return {
+        "completed_at": _iso(payment.completed_at),
+        "created_at": _iso(payment.created_at),
+        "payment_hash": payment.payment_hash,
+        "received_sat": payment.received_sat,
+        "fees": payment.fees,
+        "external_id": payment.external_id,
+        "description": payment.description,
+        "preimage": payment.preimage,
+        "invoice": payment.invoice,
+    }
+
+
+async def export_lines(
+    payments: AsyncIterator[IncomingPayment], format: ExportFormat
+) -> AsyncIterator[str]:
+    if format == "ndjson":
+        async for payment in payments:
+            yield json.dumps(export_record(payment)) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    async for payment in payments:
+        writer.writerow(export_record(payment))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        # Only the header, as there were no payments
+        yield buffer.getvalue()
+
+
+async def _prefetched(
+    payments: AsyncIterator[IncomingPayment],
+) -> AsyncIterator[IncomingPayment]:
+    """
+    Fetch the first payment now, so phoenixd being unreachable is an error
+    response rather than a truncated export
+    """
+    first = await anext(payments, None)
+
+    async def chained() -> AsyncIterator[IncomingPayment]:
+        if first is not None:
+            yield first
+            async for payment in payments:
+                yield payment
+
+    return chained()
+
+
+def check_admin(request: Request, authorization: str | None) -> JSONResponse | None:
+    """
+    An error response unless `authorization` has the admin token
+    """
+    settings: PhoenixdLNURLSettings = request.app.state.settings
+    if settings.admin_token is None:
+        # Admin endpoints are off without a token
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content=LnurlErrorResponse(reason="Not Found").dict(),
+        )
+    expected = f"Bearer {settings.admin_token.get_secret_value()}"
+    if authorization is None or not hmac.compare_digest(
+        authorization.encode(), expected.encode()
+    ):
+        return JSONResponse(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            content=LnurlErrorResponse(reason="Unauthorized").dict(),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return None
+
+
+@admin_router.get(
+    path="/admin/payments/export",
+    summary="Export received payments",
+    description="Streams received payments, newest first, as NDJSON or CSV",
+    operation_id="admin-payments-export",
+    response_class=StreamingResponse,
+)
+async def export_payments(
+    request: Request,
+    format: Annotated[ExportFormat, Query()] = "ndjson",
+    since: Annotated[
+        datetime | None,
+        Query(alias="from", description="Earliest payment time, ISO 8601"),
+    ] = None,
+    until: Annotated[
+        datetime | None,
+        Query(alias="to", description="Latest payment time, ISO 8601"),
+    ] = None,
+    external_id: Annotated[
+        str | None,
+        Query(
+            alias="externalId",
+            description="Only payments to invoices with this external id, e.g. the LNURL metadata hash",
+        ),
+    ] = None,
+    authorization: Annotated[str | None, Header()] = None,
+) -> Response:
+    if (denied := check_admin(request, authorization)) is not None:
+        return denied
+    payments = await _prefetched(
+        iter_incoming_payments(
+            request.app.state.phoenixd_client,
+            since=since,
+            until=until,
+            external_id=external_id,
+        )
+    )
+    return StreamingResponse(
+        export_lines(payments, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="payments.{format}"'},
+    )
+
+
+async def export(
+    settings: PhoenixdLNURLSettings,
+    output,
+    *,
+    format: ExportFormat,
+    since: datetime | None,
+    until: datetime | None,
+    external_id: str | None,
+    page_size: int,
+):
+    async with aiohttp.ClientSession() as session:
+        client = phoenixd_client_for(settings, session)
+        payments = iter_incoming_payments(
+            client,
+            since=since,
+            until=until,
+            external_id=external_id,
+            page_size=page_size,
+        )
+        async for line in export_lines(payments, format):
+            output.write(line)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.export",
+        description="Export payments received by phoenixd as NDJSON or CSV",
+    )
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument(
+        "--from",
+        dest="since",
+        type=datetime.fromisoformat,
+        help="Earliest payment time, ISO 8601 (UTC unless given)",
+    )
+    parser.add_argument(
+        "--to",
+        dest="until",
+        type=datetime.fromisoformat,
+        help="Latest payment time, ISO 8601 (UTC unless given)",
+    )
+    parser.add_argument(
+        "--external-id",
+        help="Only payments to invoices with this external id",
+    )
+    parser.add_argument(
+        "--lnurl-only",
+        action="store_true",
+        help="Only payments to this LNURL, by the current metadata hash",
+    )
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w", encoding="utf-8"),
+        default=sys.stdout,
+        help="Defaults to stdout",
+    )
+    args = parser.parse_args(argv)
+    settings = load_settings()
+    external_id = args.external_id
+    if args.lnurl_only:
+        external_id = load_artifacts(settings).metadata_hash
+    asyncio.run(
+        export(
+            settings,
+            args.output,
+            format=args.format,
+            since=args.since,
+            until=args.until,
+            external_id=external_id,
+            page_size=args.page_size,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
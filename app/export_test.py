@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+from datetime import (
+    datetime,
+    timezone,
+)
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+from fastapi.testclient import TestClient
+from pydantic import SecretStr
+
+from .export import (
+    EXPORT_FIELDS,
+    export_lines,
+    iter_incoming_payments,
+)
+from .main import app_factory
+from .phoenixd_client import (
+    IncomingPayment,
+    PhoenixdHttpClient,
+    PhoenixdMockClient,
+)
+from .phoenixd_standin import (
+    PhoenixdStandin,
+    StandinConfig,
+)
+
+# 2024-01-01T00:00:00Z
+START_MS = 1_704_067_200_000
+
+
+def paid_standin(completed_at_ms: list[int]) -> PhoenixdStandin:
+    standin = PhoenixdStandin(StandinConfig(password="hunter2", seed=1))
+    for i, completed_at in enumerate(completed_at_ms):
+        invoice = standin.create_invoice(
+            amount_sat=1000 + i,
+            description="zap",
+            external_id="ours" if i % 2 else "theirs",
+        )
+        standin.settle(invoice.payment_hash)
+        invoice.completed_at = completed_at
+    # Never paid, so never exported
+    standin.create_invoice(amount_sat=1, description="zap")
+    return standin
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("page_size", [1, 3, 7, 100])
+async def test_iter_incoming_payments(page_size):
+    # Lots received in the same millisecond, across page boundaries
+    times = [START_MS + offset for offset in [0, 0, 0, 0, 5, 5, 9, 9, 9, 9, 9, 12]]
+    standin = paid_standin(times)
+    server = TestServer(standin.app())
+    await server.start_server()
+    session = aiohttp.ClientSession(auth=aiohttp.BasicAuth("_", "hunter2"))
+    client = PhoenixdHttpClient(session=session, phoenixd_url=str(server.make_url("/")))
+    try:
+        payments = [
+            p async for p in iter_incoming_payments(client, page_size=page_size)
+        ]
+        assert len(payments) == len(times)
+        assert len({p.payment_hash for p in payments}) == len(times)
+        assert [p.completed_at for p in payments] == sorted(times, reverse=True)
+
+        ranged = [
+            p
+            async for p in iter_incoming_payments(
+                client,
+                since=datetime.fromtimestamp((START_MS + 5) / 1000, tz=timezone.utc),
+                until=datetime.fromtimestamp((START_MS + 9) / 1000, tz=timezone.utc),
+                external_id="ours",
+                page_size=page_size,
+            )
+        ]
+        assert [p.completed_at for p in ranged] == [START_MS + 9] * 2 + [START_MS + 5]
+        assert {p.external_id for p in ranged} == {"ours"}
+    finally:
+        await session.close()
+        await server.close()
+
+
+class ListingClient(PhoenixdMockClient):
+    def __init__(self, payments: list[IncomingPayment]):
+        super().__init__(phoenixd_url="http://127.0.0.1:9740")
+        self.payments = payments
+
+    async def incoming_payments(self, *, limit=20, offset=0, **kwargs):
+        return self.payments[offset : offset + limit]
+
+
+class TimingOutClient(ListingClient):
+    async def incoming_payments(self, **kwargs):
+        raise TimeoutError()
+
+
+PAYMENT = IncomingPayment.parse_obj(
+    {
+        "paymentHash": "ab" * 32,
+        "preimage": "cd" * 32,
+        "externalId": "ours",
+        "description": "Zap, with a comma",
+        "isPaid": True,
+        "receivedSat": 1337,
+        "fees": 0,
+        "completedAt": START_MS,
+        "createdAt": START_MS - 1000,
+    }
+)
+
+
+async def _collect(lines) -> str:
+    return "".join([line async for line in lines])
+
+
+async def _payments(payments):
+    for payment in payments:
+        yield payment
+
+
+@pytest.mark.asyncio
+async def test_export_lines():
+    ndjson = await _collect(export_lines(_payments([PAYMENT] * 2), "ndjson"))
+    records = [json.loads(line) for line in ndjson.splitlines()]
+    assert len(records) == 2
+    assert records[0]["completed_at"] == "2024-01-01T00:00:00+00:00"
+    assert records[0]["received_sat"] == 1337
+
+    exported = await _collect(export_lines(_payments([PAYMENT] * 2), "csv"))
+    rows = list(csv.DictReader(io.StringIO(exported)))
+    assert len(rows) == 2
+    assert rows[0]["description"] == "Zap, with a comma"
+    assert tuple(rows[0]) == EXPORT_FIELDS
+
+    empty = await _collect(export_lines(_payments([]), "csv"))
+    assert empty.splitlines() == [",".join(EXPORT_FIELDS)]
+
+
+def test_export_endpoint():
+    app = app_factory()
+    with TestClient(app) as client:
+        app.state.phoenixd_client = ListingClient([PAYMENT] * 3)
+        url = "/admin/payments/export"
+
+        # Off without a token
+        assert client.get(url).status_code == 404
+
+        app.state.settings = app.state.settings.copy(
+            update={"admin_token": SecretStr("hunter2")}
+        )
+        assert client.get(url).status_code == 401
+        response = client.get(url, headers={"Authorization": "Bearer nope"})
+        assert response.status_code == 401
+
+        headers = {"Authorization": "Bearer hunter2"}
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert len(response.text.splitlines()) == 3
+
+        response = client.get(url, params={"format": "csv"}, headers=headers)
+        assert response.headers["content-type"] == "text/csv; charset=utf-8"
+        assert len(list(csv.DictReader(io.StringIO(response.text)))) == 3
+
+        # phoenixd failing is an error response, not an empty export
+        app.state.phoenixd_client = TimingOutClient([])
+        assert client.get(url, headers=headers).status_code == 500
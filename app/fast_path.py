@@ -0,0 +1,223 @@
+"""
+A lean ASGI path for the LNURL payRequest and callback routes, which take
+nearly all of the traffic.
+
+Valid requests to those routes are answered here directly, skipping the CORS
+middleware, routing, dependency resolution and request validation FastAPI
+would otherwise do on every request. Anything else, including every request
+that would fail validation, falls through to the FastAPI app unchanged, so
+responses (and error bodies) are identical either way; `fast_path_test.py`
+checks that they stay so.
+"""
+
+import math
+import re
+from urllib.parse import parse_qsl
+
+from fastapi import status
+from fastapi.encoders import jsonable_encoder
+from fastapi.requests import Request
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+)
+from lnurl import (
+    LnurlErrorResponse,
+    LnurlPayActionResponse,
+)
+from loguru import logger
+from starlette.types import (
+    ASGIApp,
+    Receive,
+    Scope,
+    Send,
+)
+
+from .artifacts import LnurlArtifacts
+from .coordination import (
+    SharedStateSync,
+    over_rate_limit,
+    record_invoice,
+)
+from .fiat_rates import FiatRates
+from .phoenixd_client import CreateInvoiceResponse
+from .server_timing import (
+    mark,
+    phase,
+)
+from .settings import PhoenixdLNURLSettings
+from .setup_logging import sampled_logger
+
+# Same as the path patterns Starlette compiles for the routes in `main.py`
+PAY_REQUEST_LUD06_PATH = re.compile(r"^/lnurlp/(?P<username>[^/]+)$")
+PAY_REQUEST_LUD16_PATH = re.compile(r"^/\.well-known/lnurlp/(?P<username>[^/]+)$")
+CALLBACK_PATH = re.compile(r"^/lnurlp/(?P<username>[^/]+)/callback$")
+USERNAME = re.compile(r"^[a-z0-9-_\.]+$")
+# Callbacks with a LUD-12 comment or LUD-18 payer data are left to `main.py`
+FULL_PATH_PARAMS = frozenset({"comment", "payerdata"})
+
+
+def _model_response(model, status_code: int = status.HTTP_200_OK) -> JSONResponse:
+    # Serialized the way FastAPI does for `response_model_exclude_none=True`
+    return JSONResponse(
+        content=jsonable_encoder(model, by_alias=True, exclude_none=True),
+        status_code=status_code,
+    )
+
+
+def _error_response(reason: str, status_code: int) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content=LnurlErrorResponse(reason=reason).dict(),
+    )
+
+
+class LnurlFastPathMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        settings: PhoenixdLNURLSettings = scope["app"].state.settings
+        if not settings.fast_path:
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        response: Response | None = None
+        if match := PAY_REQUEST_LUD16_PATH.match(path):
+            response = self.pay_request(scope, match["username"], "LUD-16")
+        elif match := PAY_REQUEST_LUD06_PATH.match(path):
+            response = self.pay_request(scope, match["username"], "LUD-06")
+        elif match := CALLBACK_PATH.match(path):
+            response = await self.callback(scope, match["username"])
+
+        if response is None:
+            await self.app(scope, receive, send)
+            return
+        self.add_cors_headers(scope, response)
+        await response(scope, receive, send)
+
+    @staticmethod
+    def add_cors_headers(scope: Scope, response: Response):
+        """
+        Add the headers `CORSMiddleware` would with `allow_origins=["*"]`
+        """
+        headers = dict(scope["headers"])
+        origin = headers.get(b"origin")
+        if origin is None:
+            return
+        if b"cookie" in headers:
+            # Requests with cookies get the specific origin rather than "*"
+            response.headers["access-control-allow-origin"] = origin.decode("latin-1")
+            response.headers.add_vary_header("Origin")
+        else:
+            response.headers["access-control-allow-origin"] = "*"
+
+    def pay_request(self, scope: Scope, username: str, lud: str) -> Response | None:
+        state = scope["app"].state
+        settings: PhoenixdLNURLSettings = state.settings
+        artifacts: LnurlArtifacts = state.artifacts
+        if username != settings.username:
+            if not USERNAME.match(username):
+                return None
+            return _error_response("Unknown user", status.HTTP_404_NOT_FOUND)
+        mark("validate")
+
+        sampled_logger.info(
+            lud + " payRequest for username='{username}'", username=username
+        )
+        # Only depends on settings (and exchange rates), so is serialized once
+        rates: FiatRates = state.fiat_rates
+        body = rates.pay_request_body(artifacts)
+        mark("settings")
+        return Response(body, media_type="application/json")
+
+    async def callback(self, scope: Scope, username: str) -> JSONResponse | None:
+        if not USERNAME.match(username):
+            return None
+        query = parse_qsl(
+            scope["query_string"].decode("latin-1"), keep_blank_values=True
+        )
+        if any(key in FULL_PATH_PARAMS for key, _ in query):
+            return None
+        # NOTE as with Starlette's `QueryParams`, the last value wins
+        amount_values = [value for key, value in query if key == "amount"]
+        if not amount_values:
+            return None
+        try:
+            amount = int(amount_values[-1])
+        except ValueError:
+            return None
+        if amount <= 0:
+            return None
+
+        app = scope["app"]
+        settings: PhoenixdLNURLSettings = app.state.settings
+        artifacts: LnurlArtifacts = app.state.artifacts
+        if username != settings.username:
+            return _error_response("Unknown user", status.HTTP_404_NOT_FOUND)
+        mark("validate")
+
+        amount_sat = math.ceil(amount / 1000)
+        sampled_logger.info(
+            "LUD-06 payRequestCallback for username='{username}' sat={amount_sat} (mSat={amount})",
+            username=username,
+            amount_sat=amount_sat,
+            amount=amount,
+        )
+        if amount_sat < settings.min_sats_receivable:
+            logger.warning(
+                "LUD-06 payRequestCallback with too-low amount {amount_sat} sats",
+                amount_sat=amount_sat,
+            )
+            return _error_response(
+                f"Amount is too low, minimum is {settings.min_sats_receivable} sats",
+                status.HTTP_400_BAD_REQUEST,
+            )
+        if amount_sat > settings.max_sats_receivable:
+            logger.warning(
+                "LUD-06 payRequestCallback with too-high amount {amount_sat} sats",
+                amount_sat=amount_sat,
+            )
+            return _error_response(
+                f"Amount is too high, maximum is {settings.max_sats_receivable} sats",
+                status.HTTP_400_BAD_REQUEST,
+            )
+
+        shared_state: SharedStateSync = app.state.shared_state
+        if over_rate_limit(shared_state, settings, scope):
+            return _error_response(
+                "Too many invoices requested, try again later",
+                status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+        mark("settings")
+        try:
+            with phase("phoenixd"):
+                invoice: CreateInvoiceResponse = (
+                    await app.state.phoenixd_client.createinvoice(
+                        amount_sat=amount_sat,
+                        description_hash=artifacts.metadata_hash,
+                        external_id=artifacts.metadata_hash,
+                    )
+                )
+        except TimeoutError as exc:
+            # Answered by the app's own handler, as it would be without the
+            # fast path. Other exceptions propagate to `ServerErrorMiddleware`
+            handler = app.exception_handlers[TimeoutError]
+            return await handler(Request(scope), exc)
+        record_invoice(shared_state, invoice, amount_sat)
+        return _model_response(
+            LnurlPayActionResponse.parse_obj(
+                dict(
+                    pr=invoice.serialized,
+                    success_action={
+                        "tag": "message",
+                        "message": f"Thanks for zapping {username}",
+                    },
+                    routes=[],
+                )
+            )
+        )
@@ -0,0 +1,88 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from .fast_path import LnurlFastPathMiddleware
+from .main import app_factory
+
+fast_app = app_factory()
+slow_app = app_factory()
+slow_app.state.settings.fast_path = False
+
+REQUESTS = [
+    ("/lnurlp/satoshi", {}, {}),
+    ("/.well-known/lnurlp/satoshi", {}, {}),
+    ("/lnurlp/notsatoshi", {}, {}),
+    ("/.well-known/lnurlp/notsatoshi", {}, {}),
+    ("/lnurlp/BOBBYTABLES", {}, {}),
+    ("/lnurlp/satoshi/", {}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": 1337000}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": "1_337_000"}, {}),
+    ("/lnurlp/notsatoshi/callback", {"amount": 1337000}, {}),
+    ("/lnurlp/BOBBYTABLES/callback", {"amount": 1337000}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": 1000}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": 500_001_000}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": -100_000}, {}),
+    ("/lnurlp/satoshi/callback", {"amount": "1.5"}, {}),
+    ("/lnurlp/satoshi/callback", {}, {}),
+    ("/lnurlp/satoshi", {}, {"Origin": "https://example.com"}),
+    (
+        "/lnurlp/satoshi",
+        {},
+        {"Origin": "https://example.com", "Cookie": "a=b"},
+    ),
+    ("/lnurlp/satoshi/callback", {"amount": 1000}, {"Origin": "https://example.com"}),
+]
+
+
+@pytest.mark.parametrize("path,params,headers", REQUESTS)
+def test_fast_path_matches_fastapi(path, params, headers):
+    with TestClient(fast_app) as fast_client, TestClient(slow_app) as slow_client:
+        fast = fast_client.get(path, params=params, headers=headers)
+        slow = slow_client.get(path, params=params, headers=headers)
+    assert fast.status_code == slow.status_code
+    assert fast.content == slow.content
+    assert fast.headers.multi_items() == slow.headers.multi_items()
+
+
+@pytest.mark.parametrize(
+    "path,query_string,handled",
+    [
+        ("/lnurlp/satoshi", b"", True),
+        ("/.well-known/lnurlp/satoshi", b"", True),
+        ("/lnurlp/notsatoshi", b"", True),
+        ("/lnurlp/satoshi/callback", b"amount=1337000", True),
+        ("/lnurlp/satoshi/callback", b"amount=1000", True),
+        ("/lnurlp/satoshi/callback", b"amount=-1", False),
+        ("/lnurlp/satoshi/callback", b"amount=1337000&comment=gm", False),
+        ("/lnurlp/satoshi/callback", b"payerdata=%7B%7D&amount=1337000", False),
+        ("/lnurlp/BOBBYTABLES", b"", False),
+        ("/lnurl", b"", False),
+    ],
+)
+@pytest.mark.asyncio
+async def test_fast_path_falls_through(path, query_string, handled):
+    fallen_through = []
+
+    async def fallback(scope, receive, send):
+        fallen_through.append(scope["path"])
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    with TestClient(fast_app):
+        await LnurlFastPathMiddleware(fallback)(
+            {
+                "type": "http",
+                "method": "GET",
+                "path": path,
+                "query_string": query_string,
+                "headers": [],
+                "app": fast_app,
+            },
+            receive,
+            send,
+        )
+    assert fallen_through == ([] if handled else [path])
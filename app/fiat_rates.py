@@ -0,0 +1,322 @@
+"""
+Exchange rates for showing amounts in fiat currencies (`FIAT_CURRENCIES`), on
+the tip page and as LUD-21 `currencies` in payRequest responses.
+
+Requests only ever read the rates in memory. A background task refreshes them
+every `FIAT_REFRESH_INTERVAL` seconds, meanwhile the previous rates are still
+used, as they are if the provider fails, until they're `FIAT_MAX_AGE` seconds
+old when they're no longer shown at all. Rates are also written to a small
+snapshot file, which other workers (and restarts) pick up instead of fetching
+them again, so the provider sees about one request per interval however many
+workers there are.
+
+Amounts invoiced are always in sats; fiat is only for display, and is kept out
+of the payRequest `metadata`, which invoices commit to.
+"""
+
+import asyncio
+import os
+import random
+import time
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from pathlib import Path
+
+import aiohttp
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    Field,
+    ValidationError,
+)
+
+from .payer_data import LnurlPayResponsePayerData
+from .settings import PhoenixdLNURLSettings
+
+# Tip page placeholder for fiat values, filled in per request
+FIAT_SLOT = "<!-- fiat-rates -->"
+# Sats shown converted on the tip page
+TIP_PAGE_SATS = 1000
+MSAT_PER_BTC = 100_000_000_000
+
+# name, symbol, decimals; others are shown by code with 2 decimals
+CURRENCIES: dict[str, tuple[str, str, int]] = {
+    "USD": ("US Dollar", "$", 2),
+    "EUR": ("Euro", "€", 2),
+    "GBP": ("British Pound", "£", 2),
+    "JPY": ("Japanese Yen", "¥", 0),
+    "CAD": ("Canadian Dollar", "CA$", 2),
+    "AUD": ("Australian Dollar", "A$", 2),
+    "CHF": ("Swiss Franc", "CHF", 2),
+    "CNY": ("Chinese Yuan", "CN¥", 2),
+    "INR": ("Indian Rupee", "₹", 2),
+    "BRL": ("Brazilian Real", "R$", 2),
+    "MXN": ("Mexican Peso", "MX$", 2),
+    "PHP": ("Philippine Peso", "₱", 2),
+    "ZAR": ("South African Rand", "R", 2),
+}
+
+
+class Currency(BaseModel):
+    """
+    A LUD-21 currency, for display only (not `convertible`)
+    """
+
+    code: str
+    name: str
+    symbol: str
+    decimals: int = Field(ge=0)
+    # Millisatoshis per smallest unit of the currency, e.g. cents
+    multiplier: float = Field(gt=0)
+
+
+class LnurlPayResponseCurrencies(LnurlPayResponsePayerData):
+    currencies: list[Currency] | None = None
+
+
+class RateSnapshot(BaseModel):
+    # Fiat per bitcoin, by currency code
+    rates: dict[str, float]
+    # Seconds since the epoch
+    fetched_at: float
+
+
+class RateProviderBase(ABC):
+    @abstractmethod
+    async def fetch_rates(
+        self, session: aiohttp.ClientSession, currencies: list[str]
+    ) -> dict[str, float]:
+        """
+        Fiat per bitcoin for each of `currencies` the provider knows
+        """
+        ...
+
+
+class CoinGeckoRateProvider(RateProviderBase):
+    def __init__(self, url: str):
+        self.url = url
+
+    async def fetch_rates(
+        self, session: aiohttp.ClientSession, currencies: list[str]
+    ) -> dict[str, float]:
+        async with session.get(
+            self.url,
+            params={
+                "ids": "bitcoin",
+                "vs_currencies": ",".join(currencies).lower(),
+            },
+        ) as response:
+            response.raise_for_status()
+            prices = (await response.json())["bitcoin"]
+        return {
+            code: float(prices[code.lower()])
+            for code in currencies
+            if code.lower() in prices
+        }
+
+
+class StaticRateProvider(RateProviderBase):
+    """
+    Fixed rates, for tests and running without network access
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        self.rates = rates
+        self.fetches = 0
+
+    async def fetch_rates(
+        self, session: aiohttp.ClientSession, currencies: list[str]
+    ) -> dict[str, float]:
+        self.fetches += 1
+        return {code: self.rates[code] for code in currencies if code in self.rates}
+
+
+def currency(code: str, rate: float) -> Currency:
+    name, symbol, decimals = CURRENCIES.get(code, (code, code, 2))
+    return Currency(
+        code=code,
+        name=name,
+        symbol=symbol,
+        decimals=decimals,
+        multiplier=round(MSAT_PER_BTC / (rate * 10**decimals), 3),
+    )
+
+
+class FiatRates:
+    def __init__(
+        self,
+        provider: RateProviderBase,
+        currencies: list[str],
+        *,
+        snapshot_path: Path,
+        refresh_interval: float = 300.0,
+        max_age: float = 3600.0,
+    ):
+        self.provider = provider
+        self.currencies = currencies
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.snapshot: RateSnapshot | None = None
+        self._version = 0
+        self._pay_request_cache: tuple[tuple, bytes] | None = None
+        self._page_cache: tuple[tuple, str] | None = None
+        self._task: asyncio.Task | None = None
+        if currencies:
+            self._adopt(self._read_snapshot())
+
+    # Reading, from memory only
+
+    def rates(self) -> dict[str, float]:
+        """
+        Current rates, or none if they're too old to show
+        """
+        if self.snapshot is None:
+            return {}
+        if time.time() - self.snapshot.fetched_at > self.max_age:
+            return {}
+        return self.snapshot.rates
+
+    def lud21_currencies(self) -> list[Currency] | None:
+        rates = self.rates()
+        currencies = [
+            currency(code, rates[code]) for code in self.currencies if code in rates
+        ]
+        return currencies or None
+
+    def _key(self) -> tuple:
+        # Changes when new rates arrive, or the current ones get too old
+        return (self._version, bool(self.rates()))
+
+    def pay_request_body(self, artifacts) -> bytes:
+        """
+        `artifacts.pay_request_body()` with LUD-21 currencies, serialized once
+        per set of rates
+        """
+        if not self.currencies:
+            return artifacts.pay_request_body()
+        key = (artifacts.fingerprint, *self._key())
+        if self._pay_request_cache is None or self._pay_request_cache[0] != key:
+            self._pay_request_cache = (
+                key,
+                artifacts.pay_request_body(self.lud21_currencies()),
+            )
+        return self._pay_request_cache[1]
+
+    def render_fiat(self, sats: int = TIP_PAGE_SATS) -> str:
+        rates = self.rates()
+        currencies = self.lud21_currencies()
+        if not currencies:
+            return ""
+        values = [
+            f"{c.symbol}{sats * rates[c.code] / 100_000_000:,.{c.decimals}f}"
+            for c in currencies
+        ]
+        return f"<br>{sats:,} sats ≈ {' · '.join(values)}<br>"
+
+    def tip_page(self, page: str) -> str:
+        key = (page, *self._key())
+        if self._page_cache is None or self._page_cache[0] != key:
+            self._page_cache = (key, page.replace(FIAT_SLOT, self.render_fiat()))
+        return self._page_cache[1]
+
+    # Refreshing, in the background
+
+    def start(self, session: aiohttp.ClientSession):
+        if self.currencies:
+            self._task = asyncio.create_task(self._run(session))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _adopt(self, snapshot: RateSnapshot | None) -> bool:
+        if snapshot is None:
+            return False
+        if (
+            self.snapshot is not None
+            and snapshot.fetched_at <= self.snapshot.fetched_at
+        ):
+            return False
+        self.snapshot = snapshot
+        self._version += 1
+        return True
+
+    def _fresh(self) -> bool:
+        return (
+            self.snapshot is not None
+            and time.time() - self.snapshot.fetched_at < self.refresh_interval
+        )
+
+    async def refresh(self, session: aiohttp.ClientSession):
+        """
+        Use another worker's rates if fresh enough, otherwise fetch them
+        """
+        self._adopt(await asyncio.to_thread(self._read_snapshot))
+        if self._fresh():
+            return
+        try:
+            rates = await self.provider.fetch_rates(session, self.currencies)
+        except (aiohttp.ClientError, TimeoutError, KeyError, ValueError) as exc:
+            logger.warning(
+                "Could not fetch exchange rates, keeping the last ones: {exc!r}",
+                exc=exc,
+            )
+            return
+        if not rates:
+            logger.warning("No exchange rates for {codes}", codes=self.currencies)
+            return
+        snapshot = RateSnapshot(rates=rates, fetched_at=time.time())
+        self._adopt(snapshot)
+        try:
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+        except OSError:
+            logger.exception(
+                "Could not write exchange rates to '{path}'", path=self.snapshot_path
+            )
+
+    async def _run(self, session: aiohttp.ClientSession):
+        while True:
+            await self.refresh(session)
+            # Jittered so workers don't all check at once
+            await asyncio.sleep(self.refresh_interval * random.uniform(0.5, 1.0))
+
+    def _read_snapshot(self) -> RateSnapshot | None:
+        try:
+            return RateSnapshot.parse_raw(self.snapshot_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValidationError) as exc:
+            logger.warning(
+                "Ignoring exchange rates in '{path}': {exc}",
+                path=self.snapshot_path,
+                exc=exc,
+            )
+            return None
+
+    def _write_snapshot(self, snapshot: RateSnapshot):
+        tmp_path = self.snapshot_path.with_name(
+            f"{self.snapshot_path.name}.{os.getpid()}.tmp"
+        )
+        tmp_path.write_text(snapshot.json())
+        tmp_path.replace(self.snapshot_path)
+
+
+def fiat_rates_for(settings: PhoenixdLNURLSettings) -> FiatRates:
+    provider: RateProviderBase = (
+        # Roughly right, so tests never touch the network
+        StaticRateProvider({"USD": 60_000.0, "EUR": 55_000.0, "GBP": 47_000.0})
+        if settings.is_test
+        else CoinGeckoRateProvider(settings.fiat_rate_url)
+    )
+    return FiatRates(
+        provider,
+        [code.upper() for code in settings.fiat_currencies],
+        snapshot_path=settings.fiat_rates_snapshot,
+        refresh_interval=settings.fiat_refresh_interval,
+        max_age=settings.fiat_max_age,
+    )
@@ -0,0 +1,124 @@
+import json
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from fastapi.testclient import TestClient
+
+from .artifacts import LnurlArtifacts
+from .fiat_rates import (
+    CoinGeckoRateProvider,
+    FiatRates,
+    RateProviderBase,
+    RateSnapshot,
+    StaticRateProvider,
+)
+from .main import app_factory
+
+
+class FailingRateProvider(RateProviderBase):
+    async def fetch_rates(self, session, currencies):
+        raise aiohttp.ClientConnectionError("down")
+
+
+def fiat_rates(tmp_path, provider, **kwargs) -> FiatRates:
+    return FiatRates(
+        provider,
+        ["USD", "JPY"],
+        snapshot_path=tmp_path / "fiat-rates.json",
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_fiat_rates_refresh(tmp_path):
+    provider = StaticRateProvider({"USD": 50_000.0, "JPY": 8_000_000.0})
+    rates = fiat_rates(tmp_path, provider)
+    assert rates.rates() == {}
+    assert rates.lud21_currencies() is None
+
+    async with aiohttp.ClientSession() as session:
+        await rates.refresh(session)
+        assert rates.rates() == {"USD": 50_000.0, "JPY": 8_000_000.0}
+        usd, jpy = rates.lud21_currencies()
+        # 1 cent is 20 sats at $50,000
+        assert (usd.code, usd.multiplier) == ("USD", 20_000)
+        assert (jpy.decimals, jpy.multiplier) == (0, 12_500)
+        assert rates.render_fiat() == "<br>1,000 sats ≈ $0.50 · ¥80<br>"
+
+        # Another worker reads the snapshot rather than fetching again
+        other = fiat_rates(tmp_path, provider)
+        assert other.rates() == rates.rates()
+        await other.refresh(session)
+        assert provider.fetches == 1
+
+
+@pytest.mark.asyncio
+async def test_fiat_rates_fallback(tmp_path):
+    snapshot = RateSnapshot(rates={"USD": 50_000.0}, fetched_at=time.time() - 600)
+    (tmp_path / "fiat-rates.json").write_text(snapshot.json())
+    rates = fiat_rates(tmp_path, FailingRateProvider(), max_age=900)
+    async with aiohttp.ClientSession() as session:
+        await rates.refresh(session)
+    # Stale but still shown, as the provider is down
+    assert rates.rates() == {"USD": 50_000.0}
+    # ...until too old
+    rates.max_age = 300
+    assert rates.rates() == {}
+    assert rates.render_fiat() == ""
+
+
+@pytest.mark.asyncio
+async def test_coingecko_rate_provider():
+    async def simple_price(request):
+        assert request.query["vs_currencies"] == "usd,xyz"
+        return web.json_response({"bitcoin": {"usd": 61234.5}})
+
+    app = web.Application()
+    app.router.add_get("/simple/price", simple_price)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        provider = CoinGeckoRateProvider(str(server.make_url("/simple/price")))
+        async with aiohttp.ClientSession() as session:
+            assert await provider.fetch_rates(session, ["USD", "XYZ"]) == {
+                "USD": 61234.5
+            }
+    finally:
+        await server.close()
+
+
+def test_fiat_in_pay_request_and_tip_page(tmp_path):
+    app = app_factory()
+    settings = app.state.settings.copy(update={"fiat_currencies": ["USD"]})
+    app.state.settings = settings
+    app.state.artifacts = LnurlArtifacts.build(settings)
+    app.state.fiat_rates = fiat_rates(tmp_path, StaticRateProvider({}))
+    with TestClient(app) as client:
+        # No rates yet, so no currencies
+        fast = client.get("/lnurlp/satoshi").json()
+        assert "currencies" not in fast
+        assert "sats ≈" not in client.get("/lnurl").text
+
+        app.state.fiat_rates._adopt(
+            RateSnapshot(rates={"USD": 50_000.0}, fetched_at=time.time())
+        )
+        fast = client.get("/lnurlp/satoshi").json()
+        assert fast["currencies"] == [
+            {
+                "code": "USD",
+                "name": "US Dollar",
+                "symbol": "$",
+                "decimals": 2,
+                "multiplier": 20_000,
+            }
+        ]
+        app.state.settings = settings.copy(update={"fast_path": False})
+        assert client.get("/lnurlp/satoshi").json() == fast
+        assert "1,000 sats ≈ $0.50" in client.get("/lnurl").text
+    # Display only, invoices commit to the same metadata as ever
+    assert json.loads(fast["metadata"]) == json.loads(
+        settings.metadata_for_payrequest()
+    )
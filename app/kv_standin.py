@@ -0,0 +1,190 @@
+"""
+A local stand-in for the key-value server behind `SHARED_STATE_URL`.
+
+Speaks enough of the Redis protocol (RESP) for `RespSharedState`, from an
+in-memory dict, so several instances of the app can share state on one
+machine, in tests or load tests, without running Redis:
+
+    python -m app.kv_standin --port 6379 --password hunter2
+    SHARED_STATE_URL=redis://:hunter2@127.0.0.1:6379/0 ./run.sh
+
+Commands: PING, AUTH, SELECT, GET, MGET, SET (with EX, PX and NX), INCRBY,
+DEL, PTTL and FLUSHALL.
+"""
+
+import argparse
+import asyncio
+import time
+
+from loguru import logger
+
+from .shared_state import (
+    RespError,
+    SharedStateError,
+    read_reply,
+)
+
+
+def encode_reply(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RespError):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode_reply(r) for r in reply)
+    if reply == "OK" or reply == "PONG":
+        return b"+%s\r\n" % reply.encode()
+    data = str(reply).encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class KVStandin:
+    def __init__(self, *, password: str | None = None):
+        self.password = password
+        # (db, key) -> (value, when it expires on the monotonic clock, or None)
+        self.data: dict[tuple[str, str], tuple[str, float | None]] = {}
+        self.stats = {"connections": 0, "commands": 0}
+        self._server: asyncio.Server | None = None
+        self._handlers: set[asyncio.Task] = set()
+
+    def _get(self, db: str, key: str) -> str | None:
+        entry = self.data.get((db, key))
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.data[(db, key)]
+            return None
+        return value
+
+    def command(self, session: dict, args: list[str]):
+        name, args = args[0].upper(), args[1:]
+        self.stats["commands"] += 1
+        if name == "AUTH":
+            if args[-1] != self.password:
+                return RespError("WRONGPASS invalid password")
+            session["authenticated"] = True
+            return "OK"
+        if self.password is not None and not session.get("authenticated"):
+            return RespError("NOAUTH Authentication required.")
+        db = session["db"]
+        if name == "PING":
+            return "PONG"
+        if name == "SELECT":
+            session["db"] = args[0]
+            return "OK"
+        if name == "GET":
+            return self._get(db, args[0])
+        if name == "MGET":
+            return [self._get(db, key) for key in args]
+        if name == "SET":
+            return self._set(db, args)
+        if name == "INCRBY":
+            current = self._get(db, args[0])
+            try:
+                total = int(current or 0) + int(args[1])
+            except ValueError:
+                return RespError("ERR value is not an integer or out of range")
+            _, expires = self.data.get((db, args[0]), (None, None))
+            self.data[(db, args[0])] = (str(total), expires)
+            return total
+        if name == "DEL":
+            deleted = 0
+            for key in args:
+                if self._get(db, key) is not None:
+                    del self.data[(db, key)]
+                    deleted += 1
+            return deleted
+        if name == "PTTL":
+            if self._get(db, args[0]) is None:
+                return -2
+            _, expires = self.data[(db, args[0])]
+            if expires is None:
+                return -1
+            return int((expires - time.monotonic()) * 1000)
+        if name == "FLUSHALL":
+            self.data.clear()
+            return "OK"
+        return RespError(f"ERR unknown command '{name}'")
+
+    def _set(self, db: str, args: list[str]):
+        key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+        expires = None
+        for option, unit in (("EX", 1), ("PX", 1000)):
+            if option not in options:
+                continue
+            try:
+                ttl = int(args[2 + options.index(option) + 1])
+            except (IndexError, ValueError):
+                return RespError("ERR value is not an integer or out of range")
+            # As Redis, which refuses to set a key that's already expired
+            if ttl <= 0:
+                return RespError("ERR invalid expire time in 'set' command")
+            expires = time.monotonic() + ttl / unit
+        if "NX" in options and self._get(db, key) is not None:
+            return None
+        self.data[(db, key)] = (value, expires)
+        return "OK"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats["connections"] += 1
+        handler = asyncio.current_task()
+        assert handler is not None
+        self._handlers.add(handler)
+        session: dict = {"db": "0"}
+        try:
+            while True:
+                request = await read_reply(reader)
+                if not isinstance(request, list) or not request:
+                    writer.write(encode_reply(RespError("ERR expected a command")))
+                    continue
+                writer.write(encode_reply(self.command(session, request)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (SharedStateError, ValueError) as exc:
+            # Not RESP, e.g. inline commands, which aren't supported
+            logger.warning("Dropping client sending {exc}", exc=exc)
+        finally:
+            self._handlers.discard(handler)
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 6379) -> asyncio.Server:
+        self._server = await asyncio.start_server(self.handle, host, port)
+        return self._server
+
+    async def close(self):
+        """
+        Stop listening and drop every client
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for handler in list(self._handlers):
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+
+async def run(host: str, port: int, password: str | None):
+    server = await KVStandin(password=password).serve(host, port)
+    logger.info("Key-value stand-in listening on {host}:{port}", host=host, port=port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.kv_standin",
+        description="Run a local stand-in for the SHARED_STATE_URL key-value server",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args(argv)
+    asyncio.run(run(args.host, args.port, args.password))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
+import asyncio
 import math
 import sys
+import time
+from collections.abc import Callable
 from contextlib import asynccontextmanager
-from typing import Annotated
+from typing import (
+    Annotated,
+    Any,
+    TextIO,
+)
 
 import aiohttp
 from fastapi import (
@@ -15,26 +22,77 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.requests import Request
 from fastapi.responses import (
+    HTMLResponse,
     JSONResponse,
     Response,
 )
-from fastapi.templating import Jinja2Templates
 from lnurl import (
     LnurlErrorResponse,
     LnurlPayActionResponse,
-    LnurlPayResponse,
 )
 from loguru import logger
 from pydantic import PositiveInt
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from .artifacts import (
+    LnurlArtifacts,
+    load_artifacts,
+)
+from .batch import (
+    batch_router,
+    shutdown_qr_pool,
+)
+from .capture import (
+    TrafficCaptureMiddleware,
+    traffic_capture_for,
+)
+from .comments import (
+    CommentStore,
+    PaymentNote,
+    comment_store_for,
+    watch_payments,
+)
+from .coordination import (
+    SharedStateSync,
+    coordination_router,
+    over_rate_limit,
+    record_invoice,
+    record_paid,
+    shared_state_sync_for,
+)
+from .export import admin_router
+from .fast_path import LnurlFastPathMiddleware
+from .fiat_rates import (
+    FiatRates,
+    LnurlPayResponseCurrencies,
+    fiat_rates_for,
+)
+from .payer_data import (
+    parse_payer_data,
+    payer_data_description_hash,
+)
 from .phoenixd_client import (
     CreateInvoiceResponse,
-    PhoenixdHttpClient,
-    PhoenixdMockClient,
+    phoenixd_client_for,
+)
+from .reload import SettingsReloader
+from .server_timing import (
+    ServerTimingMiddleware,
+    mark,
+    phase,
+    server_timing_options,
+)
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+)
+from .setup_logging import (
+    QueuedWriter,
+    intercept_logging,
+    json_format,
+    sampled_logger,
+    sampling_filter,
 )
-from .settings import PhoenixdLNURLSettings
-from .setup_logging import intercept_logging
 
 DEFAULT_ERROR_RESPONSE_MODELS: dict[int | str, dict[str, type]] = {
     400: {"model": LnurlErrorResponse},
@@ -44,7 +102,6 @@ DEFAULT_ERROR_RESPONSE_MODELS: dict[int | str, dict[str, type]] = {
 }
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
 
 
 @router.get(
@@ -55,29 +112,26 @@ templates = Jinja2Templates(directory="app/templates")
     response_class=Response,
 )
 async def lnurl_get_lud01(request: Request) -> Response:
+    mark("validate")
     settings: PhoenixdLNURLSettings = request.app.state.settings
-    return templates.TemplateResponse(
-        name="lnurl-splash.html",
-        context={
-            "request": request,
-            "username": settings.username,
-            "lnurl_address": settings.lnurl_address(),
-            "nostr_address": settings.user_nostr_address,
-            "profile_image_url": settings.user_profile_image_url,
-            "meta_description": settings.lnurl_hostname,
-            "meta_author": settings.lnurl_address(),
-            "encoded_lnurl": settings.lnurl_address_encoded(),
-            "lnurl_qr": settings.lnurl_qr(),
-            "smaller_heading": settings.is_long_username(),
-        },
-    )
+    artifacts: LnurlArtifacts = request.app.state.artifacts
+    with phase("render"):
+        # NOTE nothing on the page depends on the request, so it's rendered once
+        page = artifacts.tip_page(settings)
+        if settings.tip_page_comments:
+            store: CommentStore = request.app.state.comment_store
+            page = store.tip_page(page, settings.tip_page_comments)
+        if settings.fiat_currencies:
+            rates: FiatRates = request.app.state.fiat_rates
+            page = rates.tip_page(page)
+    return HTMLResponse(page)
 
 
 @router.get(
     path="/lnurlp/{username}",
     summary="payRequest LUD-06",
     operation_id="lnurlp-LUD06",
-    response_model=LnurlPayResponse,
+    response_model=LnurlPayResponseCurrencies,
     responses=DEFAULT_ERROR_RESPONSE_MODELS,
     response_model_exclude_none=True,
     response_model_exclude_unset=False,
@@ -92,12 +146,14 @@ async def lnurl_pay_request_lud06(
             regex=r"^[a-z0-9-_\.]+$",
         ),
     ],
-) -> LnurlPayResponse | JSONResponse:
+) -> LnurlPayResponseCurrencies | JSONResponse:
     """
     Implements [LUD-06](https://github.com/lnurl/luds/blob/luds/06.md)
     `payRequest` initial step
     """
+    mark("validate")
     settings: PhoenixdLNURLSettings = request.app.state.settings
+    artifacts: LnurlArtifacts = request.app.state.artifacts
     if username != settings.username:
         return JSONResponse(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -105,22 +161,20 @@ async def lnurl_pay_request_lud06(
         )
     username = settings.username
 
-    logger.info("LUD-06 payRequest for username='{username}'", username=username)
-    return LnurlPayResponse.parse_obj(
-        dict(
-            callback=str(settings.base_url() / f"lnurlp/{username}/callback"),
-            minSendable=settings.min_sats_receivable * 1000,
-            maxSendable=settings.max_sats_receivable * 1000,
-            metadata=settings.metadata_for_payrequest(),
-        )
+    sampled_logger.info(
+        "LUD-06 payRequest for username='{username}'", username=username
     )
+    rates: FiatRates = request.app.state.fiat_rates
+    pay_request = artifacts.pay_request(rates.lud21_currencies())
+    mark("settings")
+    return pay_request
 
 
 @router.get(
     path="/.well-known/lnurlp/{username}",
     summary="payRequest LUD-16",
     operation_id="lnurlp-LUD16",
-    response_model=LnurlPayResponse,
+    response_model=LnurlPayResponseCurrencies,
     responses=DEFAULT_ERROR_RESPONSE_MODELS,
     response_model_exclude_none=True,
     response_model_exclude_unset=False,
@@ -135,12 +189,14 @@ async def lnurl_pay_request_lud16(
             regex=r"^[a-z0-9-_\.]+$",
         ),
     ],
-) -> LnurlPayResponse | JSONResponse:
+) -> LnurlPayResponseCurrencies | JSONResponse:
     """
     Implements [LUD-16](https://github.com/lnurl/luds/blob/luds/16.md) `payRequest`
     initial step, using human-readable `username@host` addresses.
     """
+    mark("validate")
     settings: PhoenixdLNURLSettings = request.app.state.settings
+    artifacts: LnurlArtifacts = request.app.state.artifacts
     if username != settings.username:
         return JSONResponse(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -148,15 +204,13 @@ async def lnurl_pay_request_lud16(
         )
     username = settings.username
 
-    logger.info("LUD-16 payRequest for username='{username}'", username=username)
-    return LnurlPayResponse.parse_obj(
-        dict(
-            callback=str(settings.base_url() / f"lnurlp/{username}/callback"),
-            minSendable=settings.min_sats_receivable * 1000,
-            maxSendable=settings.max_sats_receivable * 1000,
-            metadata=settings.metadata_for_payrequest(),
-        )
+    sampled_logger.info(
+        "LUD-16 payRequest for username='{username}'", username=username
     )
+    rates: FiatRates = request.app.state.fiat_rates
+    pay_request = artifacts.pay_request(rates.lud21_currencies())
+    mark("settings")
+    return pay_request
 
 
 @router.get(
@@ -185,8 +239,18 @@ async def lnurl_pay_request_callback_lud06(
             examples=[1337000],
         ),
     ],
+    comment: Annotated[
+        str | None,
+        Query(description="LUD-12 comment, if `commentAllowed`"),
+    ] = None,
+    payerdata: Annotated[
+        str | None,
+        Query(description="LUD-18 payer data JSON, if `payerData` was asked for"),
+    ] = None,
 ) -> LnurlPayActionResponse | JSONResponse:
+    mark("validate")
     settings: PhoenixdLNURLSettings = request.app.state.settings
+    artifacts: LnurlArtifacts = request.app.state.artifacts
     if username != settings.username:
         return JSONResponse(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -197,7 +261,7 @@ async def lnurl_pay_request_callback_lud06(
     # TODO check compatibility of conversion to sats, some wallets
     # may not like the invoice amount not matching?
     amount_sat = math.ceil(amount / 1000)
-    logger.info(
+    sampled_logger.info(
         "LUD-06 payRequestCallback for username='{username}' sat={amount_sat} (mSat={amount})",
         username=username,
         amount_sat=amount_sat,
@@ -228,13 +292,59 @@ async def lnurl_pay_request_callback_lud06(
             ).dict(),
         )
 
-    invoice: CreateInvoiceResponse = (
-        await request.app.state.phoenixd_client.createinvoice(
-            amount_sat=amount_sat,
-            description=settings.metadata_hash(),
-            external_id=settings.metadata_hash(),
+    if not artifacts.comment_allowed:
+        # Per LUD-12, ignored unless asked for
+        comment = None
+    elif comment is not None and len(comment) > artifacts.comment_allowed:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content=LnurlErrorResponse(
+                reason=f"Comment is too long, maximum is {artifacts.comment_allowed} characters"
+            ).dict(),
+        )
+
+    description_hash = artifacts.metadata_hash
+    payer_data: dict[str, str] | None = None
+    if artifacts.payer_data and payerdata is not None:
+        try:
+            payer_data = parse_payer_data(payerdata)
+        except ValueError as exc:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content=LnurlErrorResponse(reason=f"Invalid payerdata: {exc}").dict(),
+            )
+        description_hash = payer_data_description_hash(artifacts.metadata, payerdata)
+
+    shared_state: SharedStateSync = request.app.state.shared_state
+    if over_rate_limit(shared_state, settings, request.scope):
+        return JSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content=LnurlErrorResponse(
+                reason="Too many invoices requested, try again later"
+            ).dict(),
+        )
+    mark("settings")
+
+    with phase("phoenixd"):
+        invoice: CreateInvoiceResponse = (
+            await request.app.state.phoenixd_client.createinvoice(
+                amount_sat=amount_sat,
+                description_hash=description_hash,
+                external_id=artifacts.metadata_hash,
+            )
+        )
+    record_invoice(shared_state, invoice, amount_sat)
+    if comment or payer_data:
+        store: CommentStore = request.app.state.comment_store
+        store.add(
+            PaymentNote(
+                time=int(time.time() * 1000),
+                payment_hash=invoice.payment_hash,
+                amount_sat=amount_sat,
+                comment=comment or None,
+                payer_data=payer_data,
+            )
         )
-    )
     return LnurlPayActionResponse.parse_obj(
         dict(
             pr=invoice.serialized,
@@ -293,24 +403,49 @@ def register_exception_handlers(app: FastAPI):
         )
 
 
-def configure_logging(loglevel: str = "INFO"):
+def configure_logging(
+    loglevel: str = "INFO",
+    *,
+    log_format: str = "pretty",
+    enqueue: bool = False,
+    sample_rate: float = 1.0,
+):
     logger.remove()
     intercept_logging()
+    sink: TextIO | QueuedWriter = QueuedWriter(sys.stdout) if enqueue else sys.stdout
+    formatter: str | Callable[[Any], str] = (
+        "<fg #FF9900>{time:%Y-%m-%d:%H:%m:%S}</fg #FF9900>  <level>{level:9}  {message}</level>"
+    )
+    if log_format == "json":
+        formatter = json_format
     logger.add(
-        sys.stdout,
-        colorize=True,
+        sink,
+        colorize=log_format == "pretty",
         level=loglevel,
-        format="<fg #FF9900>{time:%Y-%m-%d:%H:%m:%S}</fg #FF9900>  <level>{level:9}  {message}</level>",
+        filter=sampling_filter(sample_rate),
+        format=formatter,
     )
 
 
-def app_factory() -> FastAPI:
-    # Settings are auto-loaded from a `.env` file
-    settings: PhoenixdLNURLSettings = PhoenixdLNURLSettings()  # type: ignore
-    if settings.is_test:
-        settings = PhoenixdLNURLSettings(_env_file="test.env")  # type: ignore
+def warm_up(app: FastAPI):
+    """
+    Build everything that's otherwise built on first use, e.g. in the gunicorn
+    master before forking workers so they all share it
+    """
+    app.state.artifacts.tip_page(app.state.settings)
+    app.state.artifacts.pay_request_body()
+    app.openapi()
+
+
+def app_factory(settings_override: PhoenixdLNURLSettings | None = None) -> FastAPI:
+    settings = load_settings() if settings_override is None else settings_override
 
-    configure_logging(settings.log_level)
+    configure_logging(
+        settings.log_level,
+        log_format=settings.log_format,
+        enqueue=settings.log_enqueue,
+        sample_rate=settings.log_sample_rate,
+    )
     logger.debug("Loaded settings: {settings}", settings=settings)
 
     if not settings.debug:
@@ -327,16 +462,40 @@ def app_factory() -> FastAPI:
                 connect=2.0,
             )
         )
-        if settings.is_test:
-            app.state.phoenixd_client = PhoenixdMockClient(
-                phoenixd_url=settings.phoenixd_url.get_secret_value(),
-            )
-        else:
-            app.state.phoenixd_client = PhoenixdHttpClient(
-                session=app.state.client_session,
-                phoenixd_url=settings.phoenixd_url.get_secret_value(),
+        app.state.phoenixd_client = phoenixd_client_for(
+            settings, app.state.client_session
+        )
+        app.state.phoenixd_client.start()
+        reloader = SettingsReloader(app)
+        reloader.start()
+        app.state.comment_store.start()
+        app.state.fiat_rates.start(app.state.client_session)
+        app.state.batch_semaphore = asyncio.Semaphore(settings.batch_concurrency)
+        app.state.shared_state.start()
+        if capture is not None:
+            capture.start()
+        watcher = None
+        if settings.tip_page_comments or settings.shared_state_url is not None:
+            watcher = asyncio.create_task(
+                watch_payments(
+                    app.state.comment_store,
+                    lambda: app.state.phoenixd_client,
+                    on_paid=lambda payment_hash: record_paid(
+                        app.state.shared_state, payment_hash
+                    ),
+                )
             )
         yield
+        if watcher is not None:
+            watcher.cancel()
+        if capture is not None:
+            await capture.stop()
+        await app.state.shared_state.stop()
+        await app.state.fiat_rates.stop()
+        await app.state.comment_store.stop()
+        await reloader.stop()
+        await asyncio.to_thread(shutdown_qr_pool)
+        await app.state.phoenixd_client.close()
         await app.state.client_session.close()
 
     app = FastAPI(
@@ -351,9 +510,26 @@ def app_factory() -> FastAPI:
         logger=logger,
     )
     app.state.settings = settings
+    app.state.artifacts = load_artifacts(settings)
+    app.state.comment_store = comment_store_for(settings)
+    app.state.fiat_rates = fiat_rates_for(settings)
+    app.state.shared_state = shared_state_sync_for(settings)
     app.add_middleware(
         CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
     )
+    # NOTE added last so it's in front of the CORS middleware
+    app.add_middleware(LnurlFastPathMiddleware)
+    timing_options = server_timing_options(settings)
+    if timing_options is not None:
+        # In front of the fast path, so it times requests answered there too
+        app.add_middleware(ServerTimingMiddleware, **timing_options)
+    capture = traffic_capture_for(settings)
+    if capture is not None:
+        # Outermost, so it times everything else
+        app.add_middleware(TrafficCaptureMiddleware, capture=capture)
     app.include_router(router)
+    app.include_router(admin_router)
+    app.include_router(batch_router)
+    app.include_router(coordination_router)
     register_exception_handlers(app)
     return app
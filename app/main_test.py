@@ -1,4 +1,6 @@
 import json
+import subprocess
+import sys
 
 from fastapi.testclient import TestClient
 from lnurl import (
@@ -6,12 +8,32 @@ from lnurl import (
     LnurlPayResponse,
 )
 
-from .main import app_factory
+from .main import (
+    app_factory,
+    warm_up,
+)
 
 app = app_factory()
 test_client = TestClient(app)
 
 
+def test_import_defers_tip_page_dependencies():
+    # QR code and template dependencies are only needed for the tip page, and
+    # are slow to import, so shouldn't be loaded at startup
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, app.main; "
+            "print(sorted({'qrcode', 'PIL', 'jinja2'} & set(sys.modules)))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
 def test_read_main():
     response = test_client.get("/")
     assert response.status_code == 400
@@ -208,3 +230,11 @@ def test_lnurl_pay_request_callback_lud06_bad_amount():
         ),
     }
     assert response.status_code == 400
+
+
+def test_warm_up():
+    warm_app = app_factory()
+    assert warm_app.state.artifacts.tip_page_html is None
+    warm_up(warm_app)
+    assert warm_app.state.artifacts.tip_page_html is not None
+    assert warm_app.openapi_schema is not None
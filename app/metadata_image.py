@@ -0,0 +1,260 @@
+"""
+A thumbnail of an image (e.g. your profile photo) for the LUD-06 payRequest
+metadata, which wallets can show when paying.
+
+The image is fetched (or read from disk), resized to fit `METADATA_IMAGE_SIZE`
+pixels and, once base64-encoded, `METADATA_IMAGE_MAX_BYTES`, then cached in
+`METADATA_IMAGE_CACHE`. Every worker, and every restart, uses the cached copy,
+so the metadata and its hash (which invoices commit to) stay byte-for-byte
+the same. If it can't be made or cached, startup fails rather than a worker
+going without, which would give it a different metadata hash.
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import time
+import urllib.request
+from pathlib import Path
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+)
+
+# Bump when how thumbnails are made changes, so cached ones are remade
+METADATA_IMAGE_VERSION = 2
+FETCH_TIMEOUT = 10.0
+# Tries at making the image, with this many seconds between, each time
+# checking whether another worker has cached it meanwhile
+BUILD_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+# Largest image accepted before resizing, to not decode something huge
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+JPEG_QUALITIES = (85, 75, 65, 55, 45)
+
+
+class MetadataImageError(Exception):
+    """
+    The metadata image couldn't be made and cached
+    """
+
+
+class MetadataImage(BaseModel):
+    key: str
+    mime_type: str
+    data: str
+
+    def metadata_entry(self) -> tuple[str, str]:
+        """
+        As in LUD-06 metadata, e.g. `["image/jpeg;base64", "..."]`
+        """
+        return f"{self.mime_type};base64", self.data
+
+
+def _is_url(source: str) -> bool:
+    return source.startswith(("http://", "https://"))
+
+
+def image_key(settings: PhoenixdLNURLSettings) -> str | None:
+    """
+    Identifies the thumbnail settings would give, without fetching anything
+    """
+    source = settings.metadata_image
+    if source is None:
+        return None
+    inputs = [
+        str(METADATA_IMAGE_VERSION),
+        source,
+        str(settings.metadata_image_size),
+        str(settings.metadata_image_max_bytes),
+    ]
+    if not _is_url(source):
+        # So edits to a local file are picked up
+        try:
+            stat = os.stat(source)
+            inputs += [str(stat.st_mtime_ns), str(stat.st_size)]
+        except OSError:
+            pass
+    return hashlib.sha256("\0".join(inputs).encode()).hexdigest()
+
+
+def read_source(source: str) -> bytes:
+    if _is_url(source):
+        request = urllib.request.Request(
+            source, headers={"User-Agent": "phoenixd-lnurl"}
+        )
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+            raw = response.read(MAX_SOURCE_BYTES + 1)
+    else:
+        with open(source, "rb") as file:
+            raw = file.read(MAX_SOURCE_BYTES + 1)
+    if len(raw) > MAX_SOURCE_BYTES:
+        raise ValueError(f"Image is over {MAX_SOURCE_BYTES} bytes")
+    return raw
+
+
+def make_thumbnail(raw: bytes, *, size: int, max_bytes: int) -> tuple[str, bytes]:
+    """
+    Resize an image to fit within `size` pixels and `max_bytes`, as a PNG if it
+    has transparency and is small enough, as a JPEG otherwise
+    """
+    # NOTE PIL is slow to import and only needed here, once
+    from PIL import (
+        Image,
+        ImageOps,
+    )
+
+    with Image.open(io.BytesIO(raw)) as opened:
+        # A rotated copy, per its EXIF orientation if any
+        image = ImageOps.exif_transpose(opened)
+        assert image is not None
+        image.load()
+
+    while True:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        if thumbnail.has_transparency_data:
+            output = io.BytesIO()
+            thumbnail.save(output, format="PNG", optimize=True)
+            if len(output.getvalue()) <= max_bytes:
+                return "image/png", output.getvalue()
+            # Flatten onto white, as JPEGs have no transparency
+            background = Image.new("RGBA", thumbnail.size, "white")
+            thumbnail = Image.alpha_composite(background, thumbnail.convert("RGBA"))
+        thumbnail = thumbnail.convert("RGB")
+        for quality in JPEG_QUALITIES:
+            output = io.BytesIO()
+            thumbnail.save(output, format="JPEG", quality=quality, optimize=True)
+            if len(output.getvalue()) <= max_bytes:
+                return "image/jpeg", output.getvalue()
+        if size <= 16:
+            raise ValueError(f"Image won't fit in {max_bytes} bytes")
+        size = size * 3 // 4
+
+
+def build_metadata_image(settings: PhoenixdLNURLSettings) -> MetadataImage:
+    key = image_key(settings)
+    assert settings.metadata_image is not None and key is not None
+    mime_type, thumbnail = make_thumbnail(
+        read_source(settings.metadata_image),
+        size=settings.metadata_image_size,
+        # The most that fits in the cap once base64-encoded, 4 bytes per 3
+        max_bytes=settings.metadata_image_max_bytes // 4 * 3,
+    )
+    return MetadataImage(
+        key=key,
+        mime_type=mime_type,
+        data=base64.b64encode(thumbnail).decode("ascii"),
+    )
+
+
+def _read_cache(path: Path, key: str) -> MetadataImage | None:
+    try:
+        cached = MetadataImage.parse_raw(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return cached if cached.key == key else None
+
+
+def _write_cache(path: Path, image: MetadataImage, *, replace: bool):
+    # Written atomically, and only replacing another worker's copy if stale or
+    # when asked to
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(image.json())
+        try:
+            # Only succeeds if there's no cached image yet
+            os.link(tmp_path, path)
+        except FileExistsError:
+            if replace or _read_cache(path, image.key) is None:
+                tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def load_metadata_image(
+    settings: PhoenixdLNURLSettings, *, refresh: bool = False
+) -> MetadataImage | None:
+    """
+    The metadata thumbnail for `settings`, from the cache if there, otherwise
+    built and cached. `None` if not configured, raises `MetadataImageError` if
+    it couldn't be built and cached, by this or another worker.
+    """
+    key = image_key(settings)
+    if key is None:
+        return None
+    path = settings.metadata_image_cache
+    if not refresh and (cached := _read_cache(path, key)) is not None:
+        return cached
+
+    error: Exception | None = None
+    for attempt in range(BUILD_ATTEMPTS):
+        if attempt:
+            time.sleep(RETRY_DELAY)
+            if (cached := _read_cache(path, key)) is not None:
+                return cached
+        try:
+            image = build_metadata_image(settings)
+            _write_cache(path, image, replace=refresh)
+        except Exception as exc:
+            logger.warning(
+                "Could not make metadata image from '{source}' in '{path}': {exc!r}",
+                source=settings.metadata_image,
+                path=path,
+                exc=exc,
+            )
+            error = exc
+            continue
+        logger.info(
+            "Made {mime_type} metadata image ({size} bytes base64) from '{source}'",
+            mime_type=image.mime_type,
+            size=len(image.data),
+            source=settings.metadata_image,
+        )
+        # Read back, so if another worker got there first everyone uses its copy
+        if (cached := _read_cache(path, key)) is not None:
+            return cached
+    raise MetadataImageError(
+        f"No metadata image from '{settings.metadata_image}' in '{path}'"
+    ) from error
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.metadata_image",
+        description="Fetch, resize and cache the payRequest metadata image",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Remake the image even if cached, e.g. when it changed at its URL",
+    )
+    args = parser.parse_args(argv)
+    settings = load_settings()
+    if settings.metadata_image is None:
+        parser.error("METADATA_IMAGE is not set")
+    try:
+        image = load_metadata_image(settings, refresh=args.refresh)
+    except MetadataImageError as exc:
+        parser.exit(1, f"{exc}: {exc.__cause__!r}\n")
+    assert image is not None
+    print(
+        json.dumps(
+            {
+                "output": str(settings.metadata_image_cache),
+                "mime_type": image.mime_type,
+                "bytes": len(image.data),
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import base64
+import io
+import json
+import random
+
+import pytest
+from PIL import Image
+
+from . import metadata_image
+from .artifacts import LnurlArtifacts
+from .metadata_image import (
+    MetadataImageError,
+    build_metadata_image,
+    load_metadata_image,
+    make_thumbnail,
+)
+from .settings import PhoenixdLNURLSettings
+
+
+def image_bytes(mode: str, size: tuple[int, int], format: str) -> bytes:
+    rng = random.Random(1)
+    image = Image.new(mode, size)
+    # Noise, which compresses badly, to exercise the size cap
+    image.putdata(
+        [tuple(rng.randrange(256) for _ in mode) for _ in range(size[0] * size[1])]
+    )
+    output = io.BytesIO()
+    image.save(output, format=format)
+    return output.getvalue()
+
+
+@pytest.fixture
+def settings(tmp_path) -> PhoenixdLNURLSettings:
+    source = tmp_path / "profile.jpg"
+    source.write_bytes(image_bytes("RGB", (400, 300), "JPEG"))
+    return PhoenixdLNURLSettings(
+        _env_file="test.env",  # type: ignore
+        metadata_image=str(source),
+        metadata_image_cache=tmp_path / "metadata-image.json",
+    )
+
+
+@pytest.mark.parametrize(
+    "mode,format,max_bytes,mime_type",
+    [
+        ("RGB", "JPEG", 32 * 1024, "image/jpeg"),
+        ("RGBA", "PNG", 128 * 1024, "image/png"),
+        # Too big as a PNG, so flattened to a JPEG
+        ("RGBA", "PNG", 8 * 1024, "image/jpeg"),
+        ("RGB", "JPEG", 2 * 1024, "image/jpeg"),
+    ],
+)
+def test_make_thumbnail(mode, format, max_bytes, mime_type):
+    raw = image_bytes(mode, (400, 300), format)
+    made_mime_type, thumbnail = make_thumbnail(raw, size=128, max_bytes=max_bytes)
+    assert made_mime_type == mime_type
+    assert len(thumbnail) <= max_bytes
+    with Image.open(io.BytesIO(thumbnail)) as image:
+        assert max(image.size) <= 128
+
+
+def test_metadata_image_is_cached(settings):
+    image = load_metadata_image(settings)
+    assert image is not None
+    assert settings.metadata_image_cache.exists()
+
+    # Served from the cache, even if the source is gone
+    source = settings.metadata_image
+    settings.metadata_image_cache.write_text(
+        image.copy(update={"data": "Y2FjaGVk"}).json()
+    )
+    assert load_metadata_image(settings).data == "Y2FjaGVk"
+    # ...unless it's stale
+    with open(source, "wb") as file:
+        file.write(image_bytes("RGB", (64, 64), "JPEG"))
+    assert load_metadata_image(settings).data != "Y2FjaGVk"
+
+
+def test_metadata_image_in_artifacts(settings):
+    artifacts = LnurlArtifacts.build(settings)
+    metadata = json.loads(artifacts.metadata)
+    mime_type, data = metadata[-1]
+    assert mime_type == "image/jpeg;base64"
+    assert base64.b64decode(data)[:2] == b"\xff\xd8"
+    # Byte for byte the same when built again, e.g. by another worker
+    assert LnurlArtifacts.build(settings).metadata_hash == artifacts.metadata_hash
+    # Without an image the metadata is as it was
+    plain = LnurlArtifacts.build(settings.copy(update={"metadata_image": None}))
+    assert plain.metadata == settings.metadata_for_payrequest()
+    assert plain.fingerprint != artifacts.fingerprint
+
+
+def test_metadata_image_size_cap_is_base64(settings):
+    settings.metadata_image_max_bytes = 2048
+    image = build_metadata_image(settings)
+    assert 1536 < len(image.data) <= 2048
+
+
+def test_metadata_image_error_fails_startup(settings, tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_image, "RETRY_DELAY", 0)
+    settings.metadata_image = str(tmp_path / "missing.png")
+    with pytest.raises(MetadataImageError):
+        load_metadata_image(settings)
+    # Rather than this worker leaving it out of its metadata
+    with pytest.raises(MetadataImageError):
+        LnurlArtifacts.build(settings)
+    assert not settings.metadata_image_cache.exists()
+
+
+def test_metadata_image_from_another_worker(settings, monkeypatch):
+    made = build_metadata_image(settings)
+
+    def failing(source):
+        raise OSError("Unreachable")
+
+    def another_worker_caches(seconds):
+        settings.metadata_image_cache.write_text(made.json())
+
+    monkeypatch.setattr(metadata_image, "read_source", failing)
+    monkeypatch.setattr(metadata_image.time, "sleep", another_worker_caches)
+    assert load_metadata_image(settings) == made
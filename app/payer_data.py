@@ -0,0 +1,72 @@
+"""
+LUD-12 comments and LUD-18 payer data: what's advertised in the payRequest
+response, and validation of what payers send to the callback.
+"""
+
+import hashlib
+import json
+
+from lnurl import LnurlPayResponse
+from pydantic import (
+    BaseModel,
+    Field,
+)
+
+# Payer data that can be asked for. NOTE LUD-18 `auth` isn't supported, as it
+# needs LNURL-auth signatures checking
+PAYER_DATA_FIELDS = ("name", "pubkey", "identifier", "email")
+PAYER_DATA_MAX_BYTES = 2048
+PAYER_DATA_FIELD_MAX_LENGTH = 256
+
+
+class PayerDataOption(BaseModel):
+    mandatory: bool = False
+
+
+class PayerDataOptions(BaseModel):
+    name: PayerDataOption | None = None
+    pubkey: PayerDataOption | None = None
+    identifier: PayerDataOption | None = None
+    email: PayerDataOption | None = None
+
+    @classmethod
+    def optional(cls) -> "PayerDataOptions":
+        return cls(**{field: PayerDataOption() for field in PAYER_DATA_FIELDS})
+
+
+class LnurlPayResponsePayerData(LnurlPayResponse):
+    """
+    `LnurlPayResponse` with LUD-12 `commentAllowed` and LUD-18 `payerData`,
+    both left out when not enabled
+    """
+
+    comment_allowed: int | None = Field(default=None, alias="commentAllowed", gt=0)
+    payer_data: PayerDataOptions | None = Field(default=None, alias="payerData")
+
+
+def parse_payer_data(raw: str) -> dict[str, str]:
+    """
+    Validate LUD-18 `payerdata` sent to the callback, raising `ValueError`
+    """
+    if len(raw.encode("UTF-8")) > PAYER_DATA_MAX_BYTES:
+        raise ValueError(f"over {PAYER_DATA_MAX_BYTES} bytes")
+    payer_data = json.loads(raw)
+    if not isinstance(payer_data, dict):
+        raise ValueError("not a JSON object")
+    for key, value in payer_data.items():
+        if key not in PAYER_DATA_FIELDS:
+            raise ValueError(f"'{key}' wasn't asked for")
+        if not isinstance(value, str):
+            raise ValueError(f"'{key}' isn't a string")
+        if len(value) > PAYER_DATA_FIELD_MAX_LENGTH:
+            raise ValueError(
+                f"'{key}' is over {PAYER_DATA_FIELD_MAX_LENGTH} characters"
+            )
+    return payer_data
+
+
+def payer_data_description_hash(metadata: str, raw_payer_data: str) -> str:
+    """
+    Per LUD-18, invoices for payments with payer data commit to both
+    """
+    return hashlib.sha256((metadata + raw_payer_data).encode("UTF-8")).hexdigest()
@@ -2,6 +2,7 @@ from abc import (
     ABC,
     abstractmethod,
 )
+from collections.abc import AsyncIterator
 
 import aiohttp
 from loguru import logger
@@ -11,6 +12,9 @@ from pydantic import (
 )
 from yarl import URL
 
+from .settings import PhoenixdLNURLSettings
+from .setup_logging import sampled_logger
+
 
 class ChannelInfo(BaseModel):
     state: str
@@ -43,7 +47,51 @@ class CreateInvoiceResponse(BaseModel):
     serialized: str
 
 
+class IncomingPayment(BaseModel):
+    payment_hash: str = Field(alias="paymentHash")
+    preimage: str
+    external_id: str | None = Field(default=None, alias="externalId")
+    description: str | None = None
+    invoice: str | None = None
+    is_paid: bool = Field(alias="isPaid")
+    received_sat: int = Field(alias="receivedSat", ge=0)
+    fees: int = Field(ge=0)
+    completed_at: int | None = Field(default=None, alias="completedAt")
+    created_at: int = Field(alias="createdAt")
+
+
+class OutgoingPayment(BaseModel):
+    payment_id: str = Field(alias="paymentId")
+    payment_hash: str | None = Field(default=None, alias="paymentHash")
+    preimage: str | None = None
+    is_paid: bool = Field(alias="isPaid")
+    sent: int = Field(ge=0)
+    fees: int = Field(ge=0)
+    invoice: str | None = None
+    completed_at: int | None = Field(default=None, alias="completedAt")
+    created_at: int = Field(alias="createdAt")
+
+
+class PaymentReceivedEvent(BaseModel):
+    type: str
+    amount_sat: int = Field(alias="amountSat", ge=0)
+    payment_hash: str = Field(alias="paymentHash")
+    external_id: str | None = Field(default=None, alias="externalId")
+
+
 class PhoenixdClientBase(ABC):
+    baseurl: URL
+
+    def start(self):  # noqa: B027 optional, unlike the API methods
+        """
+        Start any background work, called once the event loop is running
+        """
+
+    async def close(self):  # noqa: B027
+        """
+        Stop any background work started by `start`
+        """
+
     @abstractmethod
     async def getinfo(self) -> GetInfoResponse: ...
 
@@ -67,7 +115,8 @@ class PhoenixdClientBase(ABC):
         self,
         *,
         amount_sat: int,
-        description: str | bytes,
+        description: str | bytes | None = None,
+        description_hash: str | None = None,
         external_id: str | None = None,
     ) -> CreateInvoiceResponse: ...
 
@@ -89,16 +138,30 @@ class PhoenixdClientBase(ABC):
     ): ...
 
     @abstractmethod
-    async def incoming_payments_external_id(self, external_id: str): ...
+    async def incoming_payments_external_id(
+        self, external_id: str
+    ) -> list[IncomingPayment]: ...
 
     @abstractmethod
-    async def incoming_payment_hash(self, hash: str | bytes): ...
+    async def incoming_payments(
+        self,
+        *,
+        from_ms: int | None = None,
+        to_ms: int | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        external_id: str | None = None,
+        include_unpaid: bool = False,
+    ) -> list[IncomingPayment]: ...
+
+    @abstractmethod
+    async def incoming_payment_hash(self, hash: str | bytes) -> IncomingPayment: ...
 
     @abstractmethod
-    async def outgoing_payment_id(self, payment_id: str): ...
+    async def outgoing_payment_id(self, payment_id: str) -> OutgoingPayment: ...
 
     @abstractmethod
-    async def payments_websocket(self): ...
+    def payments_websocket(self) -> AsyncIterator[PaymentReceivedEvent]: ...
 
 
 class PhoenixdHttpClient(PhoenixdClientBase):
@@ -123,7 +186,8 @@ class PhoenixdHttpClient(PhoenixdClientBase):
 
     async def listchannels(self) -> ListChannelsResponse:
         async with self.session.get(self.baseurl / "listchannels") as response:
-            return ListChannelsResponse.parse_obj(await response.json())
+            # phoenixd responds with a bare JSON list of channels
+            return ListChannelsResponse.parse_obj({"channels": await response.json()})
 
     async def closechannel(
         self,
@@ -138,13 +202,19 @@ class PhoenixdHttpClient(PhoenixdClientBase):
         self,
         *,
         amount_sat: int,
-        description: str | bytes,
+        description: str | bytes | None = None,
+        description_hash: str | None = None,
         external_id: str | None = None,
     ) -> CreateInvoiceResponse:
-        form_data = {
-            "amountSat": amount_sat,
-            "description": description,
-        }
+        form_data: dict[str, str | bytes | int] = {"amountSat": amount_sat}
+        # A hex SHA256 hash the invoice commits to, instead of a description
+        # in plain text, e.g. of LUD-06 metadata
+        if description_hash is not None:
+            form_data["descriptionHash"] = description_hash
+        elif description is not None:
+            form_data["description"] = description
+        else:
+            raise ValueError("Either description or description_hash is required")
         if external_id is not None:
             form_data["externalId"] = external_id
         async with self.session.post(
@@ -152,7 +222,7 @@ class PhoenixdHttpClient(PhoenixdClientBase):
             data=form_data,
         ) as response:
             invoice = CreateInvoiceResponse.parse_obj(await response.json())
-        logger.info(
+        sampled_logger.info(
             "Created invoice {inv_short}... externalId: '{external_id}'",
             inv_short=invoice.serialized[:12],
             external_id=external_id,
@@ -177,17 +247,64 @@ class PhoenixdHttpClient(PhoenixdClientBase):
     ):
         raise NotImplementedError()
 
-    async def incoming_payments_external_id(self, external_id: str):
-        raise NotImplementedError()
+    async def incoming_payments_external_id(
+        self, external_id: str
+    ) -> list[IncomingPayment]:
+        async with self.session.get(
+            self.baseurl / "payments" / "incoming",
+            params={"externalId": external_id},
+        ) as response:
+            return [IncomingPayment.parse_obj(p) for p in await response.json()]
 
-    async def incoming_payment_hash(self, hash: str | bytes):
-        raise NotImplementedError()
+    async def incoming_payments(
+        self,
+        *,
+        from_ms: int | None = None,
+        to_ms: int | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        external_id: str | None = None,
+        include_unpaid: bool = False,
+    ) -> list[IncomingPayment]:
+        """
+        A page of incoming payments, newest first. Times are in milliseconds
+        since the epoch, and compared to when payments completed (or were
+        created, with `include_unpaid`)
+        """
+        params: dict[str, str | int] = {"limit": limit, "offset": offset}
+        if from_ms is not None:
+            params["from"] = from_ms
+        if to_ms is not None:
+            params["to"] = to_ms
+        if external_id is not None:
+            params["externalId"] = external_id
+        if include_unpaid:
+            params["all"] = "true"
+        async with self.session.get(
+            self.baseurl / "payments" / "incoming", params=params
+        ) as response:
+            return [IncomingPayment.parse_obj(p) for p in await response.json()]
 
-    async def outgoing_payment_id(self, payment_id: str):
-        raise NotImplementedError()
+    async def incoming_payment_hash(self, hash: str | bytes) -> IncomingPayment:
+        if isinstance(hash, bytes):
+            hash = hash.hex()
+        async with self.session.get(
+            self.baseurl / "payments" / "incoming" / hash
+        ) as response:
+            return IncomingPayment.parse_obj(await response.json())
 
-    async def payments_websocket(self):
-        raise NotImplementedError()
+    async def outgoing_payment_id(self, payment_id: str) -> OutgoingPayment:
+        async with self.session.get(
+            self.baseurl / "payments" / "outgoing" / payment_id
+        ) as response:
+            return OutgoingPayment.parse_obj(await response.json())
+
+    async def payments_websocket(self) -> AsyncIterator[PaymentReceivedEvent]:
+        async with self.session.ws_connect(self.baseurl / "websocket") as ws:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                yield PaymentReceivedEvent.parse_raw(message.data)
 
 
 class PhoenixdMockClient(PhoenixdClientBase):
@@ -222,7 +339,8 @@ class PhoenixdMockClient(PhoenixdClientBase):
         self,
         *,
         amount_sat: int,
-        description: str | bytes,
+        description: str | bytes | None = None,
+        description_hash: str | None = None,
         external_id: str | None = None,
     ) -> CreateInvoiceResponse:
         # Static mock invoice
@@ -246,7 +364,7 @@ class PhoenixdMockClient(PhoenixdClientBase):
                 ),
             }
         )
-        logger.info(
+        sampled_logger.info(
             "Created invoice {inv_short}... externalId: '{external_id}'",
             inv_short=invoice.serialized[:12],
             external_id=external_id,
@@ -271,14 +389,51 @@ class PhoenixdMockClient(PhoenixdClientBase):
     ):
         raise NotImplementedError()
 
-    async def incoming_payments_external_id(self, external_id: str):
+    async def incoming_payments_external_id(
+        self, external_id: str
+    ) -> list[IncomingPayment]:
+        raise NotImplementedError()
+
+    async def incoming_payments(
+        self,
+        *,
+        from_ms: int | None = None,
+        to_ms: int | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        external_id: str | None = None,
+        include_unpaid: bool = False,
+    ) -> list[IncomingPayment]:
         raise NotImplementedError()
 
-    async def incoming_payment_hash(self, hash: str | bytes):
+    async def incoming_payment_hash(self, hash: str | bytes) -> IncomingPayment:
         raise NotImplementedError()
 
-    async def outgoing_payment_id(self, payment_id: str):
+    async def outgoing_payment_id(self, payment_id: str) -> OutgoingPayment:
         raise NotImplementedError()
 
-    async def payments_websocket(self):
+    def payments_websocket(self) -> AsyncIterator[PaymentReceivedEvent]:
         raise NotImplementedError()
+
+
+def phoenixd_client_for(
+    settings: PhoenixdLNURLSettings,
+    session: aiohttp.ClientSession,
+) -> PhoenixdClientBase:
+    urls = [settings.phoenixd_url, *settings.phoenixd_urls]
+    clients: list[PhoenixdClientBase] = [
+        PhoenixdMockClient(phoenixd_url=url.get_secret_value())
+        if settings.is_test
+        else PhoenixdHttpClient(session=session, phoenixd_url=url.get_secret_value())
+        for url in urls
+    ]
+    if len(clients) == 1:
+        return clients[0]
+    # NOTE imported here as the pool is built on this module
+    from .phoenixd_pool import PhoenixdPoolClient
+
+    return PhoenixdPoolClient(
+        clients,
+        strategy=settings.phoenixd_pool_strategy,
+        health_interval=settings.phoenixd_health_interval,
+    )
@@ -0,0 +1,447 @@
+"""
+Spreads requests across several phoenixd instances, for more invoice throughput
+than one can give, and so one going down doesn't stop payments.
+
+Each instance is health checked with `getinfo` every `PHOENIXD_HEALTH_INTERVAL`
+seconds, and is also taken out of rotation after repeated failed requests,
+until a health check passes again. Invoices go to a healthy instance chosen by
+`PHOENIXD_POOL_STRATEGY`, failing over to the next on error. The instance that
+issued each invoice is remembered, so later lookups by payment hash go to it.
+"""
+
+import asyncio
+import contextlib
+import random
+from collections import OrderedDict
+from collections.abc import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+)
+from typing import (
+    Literal,
+    TypeVar,
+)
+
+import aiohttp
+from loguru import logger
+from pydantic import ValidationError
+
+from .phoenixd_client import (
+    CreateInvoiceResponse,
+    GetBalanceResponse,
+    GetInfoResponse,
+    IncomingPayment,
+    ListChannelsResponse,
+    OutgoingPayment,
+    PaymentReceivedEvent,
+    PhoenixdClientBase,
+)
+
+# Errors that mean an instance couldn't answer, rather than a bad request
+BACKEND_ERRORS = (aiohttp.ClientError, TimeoutError, ValidationError)
+# Seconds before reconnecting to an instance's payment events, doubling with
+# each attempt that fails, up to the maximum
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+
+T = TypeVar("T")
+
+
+class PoolBackend:
+    def __init__(self, client: PhoenixdClientBase):
+        self.client = client
+        # NOTE without credentials, as it's logged
+        self.name = str(client.baseurl.with_user(None))
+        self.healthy = True
+        # Consecutive failed requests
+        self.failures = 0
+        # Requests in flight
+        self.outstanding = 0
+        # As of the last health check
+        self.inbound_liquidity_sat = 0
+
+    def __repr__(self) -> str:
+        return f"<PoolBackend {self.name} healthy={self.healthy}>"
+
+
+class PhoenixdPoolClient(PhoenixdClientBase):
+    def __init__(
+        self,
+        clients: list[PhoenixdClientBase],
+        *,
+        strategy: Literal["least_outstanding", "liquidity"] = "least_outstanding",
+        health_interval: float = 10.0,
+        max_failures: int = 3,
+        issued_cache_size: int = 100_000,
+    ):
+        if not clients:
+            raise ValueError("A pool needs at least one phoenixd client")
+        self.backends = [PoolBackend(client) for client in clients]
+        self.baseurl = clients[0].baseurl
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.issued_cache_size = issued_cache_size
+        # payment hash -> backend that issued the invoice, least recent first
+        self._issued: OrderedDict[str, PoolBackend] = OrderedDict()
+        self._health_task: asyncio.Task | None = None
+        self._rotation = 0
+
+    def start(self):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._health_task
+            self._health_task = None
+
+    # Health
+
+    async def _health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    async def check_health(self):
+        await asyncio.gather(*(self._check(backend) for backend in self.backends))
+
+    async def _check(self, backend: PoolBackend):
+        try:
+            info = await asyncio.wait_for(
+                backend.client.getinfo(), timeout=self.health_interval
+            )
+        except Exception as exc:
+            self._eject(backend, exc)
+            return
+        backend.inbound_liquidity_sat = sum(
+            channel.inbound_liquidity_sat
+            for channel in info.channels
+            if channel.state == "Normal"
+        )
+        backend.failures = 0
+        if not backend.healthy:
+            logger.info("phoenixd {name} is healthy again", name=backend.name)
+            backend.healthy = True
+
+    def _eject(self, backend: PoolBackend, exc: BaseException):
+        if backend.healthy:
+            logger.warning(
+                "Taking phoenixd {name} out of the pool: {exc!r}",
+                name=backend.name,
+                exc=exc,
+            )
+            backend.healthy = False
+
+    def _failed(self, backend: PoolBackend, exc: BaseException):
+        backend.failures += 1
+        if backend.failures >= self.max_failures:
+            self._eject(backend, exc)
+
+    # Choosing backends
+
+    def _candidates(self) -> list[PoolBackend]:
+        healthy = [backend for backend in self.backends if backend.healthy]
+        # With none healthy it's still worth trying rather than failing outright
+        return healthy or list(self.backends)
+
+    def _order(self, amount_sat: int = 0) -> list[PoolBackend]:
+        """
+        Backends to try for a new invoice or payment, best first
+        """
+        candidates = self._candidates()
+        if self.strategy == "liquidity":
+            # Weighted random order (Efraimidis-Spirakis), preferring backends
+            # that can take the whole amount
+            def key(backend: PoolBackend) -> tuple[bool, float]:
+                weight = backend.inbound_liquidity_sat + 1
+                return (
+                    backend.inbound_liquidity_sat >= amount_sat,
+                    random.random() ** (1 / weight),
+                )
+
+            return sorted(candidates, key=key, reverse=True)
+        # Rotated first so ties go round-robin, the sort being stable
+        self._rotation = (self._rotation + 1) % len(candidates)
+        rotated = candidates[self._rotation :] + candidates[: self._rotation]
+        return sorted(rotated, key=lambda backend: backend.outstanding)
+
+    def _remember(self, payment_hash: str, backend: PoolBackend):
+        self._issued[payment_hash] = backend
+        self._issued.move_to_end(payment_hash)
+        while len(self._issued) > self.issued_cache_size:
+            self._issued.popitem(last=False)
+
+    async def _call(
+        self,
+        backend: PoolBackend,
+        call: Callable[[PhoenixdClientBase], Awaitable[T]],
+        *,
+        count_failure: bool = True,
+    ) -> T:
+        backend.outstanding += 1
+        try:
+            result = await call(backend.client)
+        except BACKEND_ERRORS as exc:
+            if count_failure:
+                self._failed(backend, exc)
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.failures = 0
+        return result
+
+    async def _first(
+        self,
+        backends: list[PoolBackend],
+        call: Callable[[PhoenixdClientBase], Awaitable[T]],
+        *,
+        count_failure: bool = True,
+    ) -> tuple[PoolBackend, T]:
+        """
+        Try `call` on each backend in turn, returning the first success
+        """
+        error: BaseException | None = None
+        for backend in backends:
+            try:
+                return backend, await self._call(
+                    backend, call, count_failure=count_failure
+                )
+            except BACKEND_ERRORS as exc:
+                error = exc
+        assert error is not None
+        raise error
+
+    async def _all(self, call: Callable[[PhoenixdClientBase], Awaitable[T]]) -> list[T]:
+        """
+        `call` on every candidate backend, failing only if all fail
+        """
+        backends = self._candidates()
+        results = await asyncio.gather(
+            *(self._call(backend, call) for backend in backends),
+            return_exceptions=True,
+        )
+        successes = [r for r in results if not isinstance(r, BaseException)]
+        if not successes:
+            raise next(r for r in results if isinstance(r, BaseException))
+        return successes  # type: ignore[return-value]
+
+    # phoenixd API
+
+    async def getinfo(self) -> GetInfoResponse:
+        # NOTE each instance is its own node, so this is the first healthy one's
+        _, info = await self._first(self._candidates(), lambda c: c.getinfo())
+        return info
+
+    async def getbalance(self) -> GetBalanceResponse:
+        balances = await self._all(lambda c: c.getbalance())
+        return GetBalanceResponse.parse_obj(
+            {
+                "balanceSat": sum(b.balance_sat for b in balances),
+                "feeCreditSat": sum(b.fee_credit_sat for b in balances),
+            }
+        )
+
+    async def listchannels(self) -> ListChannelsResponse:
+        responses = await self._all(lambda c: c.listchannels())
+        return ListChannelsResponse.parse_obj(
+            {"channels": [c for r in responses for c in r.channels]}
+        )
+
+    async def closechannel(
+        self,
+        *,
+        channel_id: str,
+        address: str,
+        feerate_sat_vbyte: int,
+    ):
+        for backend in self._candidates():
+            channels = (await self._call(backend, lambda c: c.listchannels())).channels
+            if any(channel.get("channelId") == channel_id for channel in channels):
+                return await backend.client.closechannel(
+                    channel_id=channel_id,
+                    address=address,
+                    feerate_sat_vbyte=feerate_sat_vbyte,
+                )
+        raise ValueError(f"No phoenixd in the pool has channel {channel_id}")
+
+    async def createinvoice(
+        self,
+        *,
+        amount_sat: int,
+        description: str | bytes | None = None,
+        description_hash: str | None = None,
+        external_id: str | None = None,
+    ) -> CreateInvoiceResponse:
+        backend, invoice = await self._first(
+            self._order(amount_sat),
+            lambda c: c.createinvoice(
+                amount_sat=amount_sat,
+                description=description,
+                description_hash=description_hash,
+                external_id=external_id,
+            ),
+        )
+        self._remember(invoice.payment_hash, backend)
+        return invoice
+
+    async def payinvoice(
+        self,
+        *,
+        invoice: str,
+        amount_sat: int | None = None,
+    ):
+        # NOTE no failover, a payment that timed out may still have been sent
+        backend = self._order()[0]
+        return await self._call(
+            backend, lambda c: c.payinvoice(invoice=invoice, amount_sat=amount_sat)
+        )
+
+    async def sendtoaddress(
+        self,
+        *,
+        address: str,
+        amount_sat: int,
+        feerate_sat_vbyte: int,
+    ):
+        # NOTE no failover, as for `payinvoice`
+        backend = self._order()[0]
+        return await self._call(
+            backend,
+            lambda c: c.sendtoaddress(
+                address=address,
+                amount_sat=amount_sat,
+                feerate_sat_vbyte=feerate_sat_vbyte,
+            ),
+        )
+
+    async def incoming_payments_external_id(
+        self, external_id: str
+    ) -> list[IncomingPayment]:
+        responses = await self._all(
+            lambda c: c.incoming_payments_external_id(external_id)
+        )
+        return sorted(
+            (payment for payments in responses for payment in payments),
+            key=lambda payment: payment.created_at,
+        )
+
+    async def incoming_payments(
+        self,
+        *,
+        from_ms: int | None = None,
+        to_ms: int | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        external_id: str | None = None,
+        include_unpaid: bool = False,
+    ) -> list[IncomingPayment]:
+        # The page at `offset` across every instance can only be found from
+        # the first `offset + limit` of each. All are asked, healthy or not,
+        # as a listing missing an instance would be wrong rather than partial.
+        pages = await asyncio.gather(
+            *(
+                self._call(
+                    backend,
+                    lambda c: c.incoming_payments(
+                        from_ms=from_ms,
+                        to_ms=to_ms,
+                        limit=offset + limit,
+                        offset=0,
+                        external_id=external_id,
+                        include_unpaid=include_unpaid,
+                    ),
+                )
+                for backend in self.backends
+            )
+        )
+
+        def timestamp(payment: IncomingPayment) -> int:
+            if include_unpaid or payment.completed_at is None:
+                return payment.created_at
+            return payment.completed_at
+
+        merged = sorted(
+            (payment for page in pages for payment in page),
+            key=timestamp,
+            reverse=True,
+        )
+        return merged[offset : offset + limit]
+
+    async def incoming_payment_hash(self, hash: str | bytes) -> IncomingPayment:
+        if isinstance(hash, bytes):
+            hash = hash.hex()
+        payment_hash = hash
+        issuer = self._issued.get(payment_hash)
+        if issuer is not None:
+            return await self._call(
+                issuer, lambda c: c.incoming_payment_hash(payment_hash)
+            )
+        # Issued before a restart (or forgotten), so ask each until one knows
+        # it. The others not knowing it isn't them failing.
+        backend, payment = await self._first(
+            self.backends,
+            lambda c: c.incoming_payment_hash(payment_hash),
+            count_failure=False,
+        )
+        self._remember(payment_hash, backend)
+        return payment
+
+    async def outgoing_payment_id(self, payment_id: str) -> OutgoingPayment:
+        _, payment = await self._first(
+            self.backends,
+            lambda c: c.outgoing_payment_id(payment_id),
+            count_failure=False,
+        )
+        return payment
+
+    async def payments_websocket(self) -> AsyncIterator[PaymentReceivedEvent]:
+        """
+        Payment events from every instance, merged. An instance's events are
+        reconnected to by themselves when they drop, so the others' carry on
+        """
+        # None for each instance without payment events
+        events: asyncio.Queue[PaymentReceivedEvent | None] = asyncio.Queue()
+
+        async def pump(backend: PoolBackend):
+            delay = RECONNECT_DELAY
+            while True:
+                # None if they ended rather than failed
+                exc: Exception | None = None
+                try:
+                    async for event in backend.client.payments_websocket():
+                        delay = RECONNECT_DELAY
+                        self._remember(event.payment_hash, backend)
+                        await events.put(event)
+                except NotImplementedError:
+                    await events.put(None)
+                    return
+                except Exception as error:
+                    exc = error
+                logger.warning(
+                    "Lost payment events from phoenixd {name}, reconnecting in "
+                    "{delay}s: {exc!r}",
+                    name=backend.name,
+                    delay=delay,
+                    exc=exc,
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        tasks = [asyncio.create_task(pump(backend)) for backend in self.backends]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await events.get()
+                if event is None:
+                    remaining -= 1
+                    continue
+                yield event
+            raise NotImplementedError("No phoenixd in the pool has payment events")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,470 @@
+"""
+A stateful, local stand-in for the phoenixd HTTP API.
+
+Serves the endpoints that `PhoenixdClientBase` models from an in-memory ledger,
+so `PhoenixdHttpClient` (and the whole app) can be run, tested and load tested
+without a Lightning node. Invoices are bech32-valid but carry a random rather
+than a real signature, and payments are simulated: they settle after a delay,
+or when `POST /_standin/settle/{paymentHash}` is called.
+
+Latency, throughput caps and failure injection are tunable, e.g.:
+
+    python -m app.phoenixd_standin --port 9740 --password hunter2 \\
+        --latency 0.05 --max-rps 200 --failure-rate 0.01 --settle-after 2
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+
+from aiohttp import (
+    BasicAuth,
+    WSMsgType,
+    web,
+)
+from bech32 import (
+    bech32_encode,
+    convertbits,
+)
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    Field,
+)
+
+# bech32 field codes for BOLT11 tagged fields
+_TAG_PAYMENT_HASH = 1
+_TAG_PAYMENT_SECRET = 16
+_TAG_DESCRIPTION = 13
+_TAG_DESCRIPTION_HASH = 23
+
+
+class StandinConfig(BaseModel):
+    # phoenixd `http-password`, checked against HTTP basic auth if set
+    password: str | None = None
+    chain: str = "testnet"
+    # Mean added latency per request and the +/- uniform jitter around it
+    latency: float = Field(default=0.0, ge=0)
+    latency_jitter: float = Field(default=0.0, ge=0)
+    # Throughput caps. Requests over `max_rps` are delayed, not rejected
+    max_rps: float | None = Field(default=None, gt=0)
+    max_concurrency: int | None = Field(default=None, ge=1)
+    # Fraction of requests that fail with a HTTP 500
+    failure_rate: float = Field(default=0.0, ge=0, le=1)
+    # Fraction of requests that hang for `stall_seconds` before answering
+    stall_rate: float = Field(default=0.0, ge=0, le=1)
+    stall_seconds: float = Field(default=30.0, ge=0)
+    # Seconds after creation that an invoice is paid, `None` to never auto-settle
+    settle_after: float | None = Field(default=None, ge=0)
+    inbound_liquidity_sat: int = Field(default=2_000_000, ge=0)
+    seed: int | None = None
+
+
+class StandinInvoice(BaseModel):
+    payment_hash: str
+    preimage: str
+    amount_sat: int
+    # None if the invoice commits to a description hash instead
+    description: str | None
+    external_id: str | None
+    serialized: str
+    created_at: int
+    completed_at: int | None = None
+    received_sat: int = 0
+    is_paid: bool = False
+
+    def to_phoenixd(self) -> dict:
+        return {
+            "paymentHash": self.payment_hash,
+            "preimage": self.preimage,
+            "externalId": self.external_id,
+            "description": self.description,
+            "invoice": self.serialized,
+            "isPaid": self.is_paid,
+            "receivedSat": self.received_sat,
+            "fees": 0,
+            "completedAt": self.completed_at,
+            "createdAt": self.created_at,
+        }
+
+
+class _TokenBucket:
+    """
+    Spaces calls out so that no more than `rate` per second are let through
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _tagged(tag: int, data: bytes) -> list[int]:
+    words = convertbits(data, 8, 5, True) or []
+    return [tag, len(words) >> 5, len(words) & 31, *words]
+
+
+def encode_invoice(
+    *,
+    amount_sat: int,
+    payment_hash: bytes,
+    payment_secret: bytes,
+    description: str | None = None,
+    description_hash: bytes | None = None,
+    timestamp: int,
+    signature: bytes,
+    chain: str = "testnet",
+) -> str:
+    """
+    Build a BOLT11-shaped invoice. The encoding and checksum are valid, but the
+    signature is whatever bytes are passed in, so it will not verify.
+    """
+    hrp = "ln" + {"mainnet": "bc", "testnet": "tb"}.get(chain, "bcrt")
+    if amount_sat:
+        # 1 nano-bitcoin is a tenth of a sat
+        hrp += f"{amount_sat * 10}n"
+    words = [(timestamp >> (5 * i)) & 31 for i in reversed(range(7))]
+    words += _tagged(_TAG_PAYMENT_HASH, payment_hash)
+    words += _tagged(_TAG_PAYMENT_SECRET, payment_secret)
+    if description_hash is not None:
+        words += _tagged(_TAG_DESCRIPTION_HASH, description_hash)
+    else:
+        words += _tagged(_TAG_DESCRIPTION, (description or "").encode("UTF-8"))
+    words += convertbits(signature, 8, 5, True) or []
+    return bech32_encode(hrp, words)
+
+
+class PhoenixdStandin:
+    def __init__(self, config: StandinConfig | None = None):
+        self.config = config or StandinConfig()
+        self.rng = random.Random(self.config.seed)
+        self.node_id = "02" + self.rng.randbytes(32).hex()
+        self.invoices: dict[str, StandinInvoice] = {}
+        self.balance_sat = 0
+        self.websockets: set[web.WebSocketResponse] = set()
+        self.stats = {
+            "requests": 0,
+            "failures_injected": 0,
+            "stalls_injected": 0,
+            "invoices_created": 0,
+            "invoices_settled": 0,
+        }
+        self._bucket = (
+            _TokenBucket(self.config.max_rps) if self.config.max_rps else None
+        )
+        self._semaphore = (
+            asyncio.Semaphore(self.config.max_concurrency)
+            if self.config.max_concurrency
+            else None
+        )
+        # Auto-settles pending, by payment hash
+        self._settle_handles: dict[str, asyncio.TimerHandle] = {}
+        # Payment events being sent to websocket listeners
+        self._sends: set[asyncio.Future] = set()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes(
+            [
+                web.get("/getinfo", self.getinfo),
+                web.get("/getbalance", self.getbalance),
+                web.get("/listchannels", self.listchannels),
+                web.post("/createinvoice", self.createinvoice),
+                web.get("/payments/incoming", self.incoming_payments),
+                web.get("/payments/incoming/{payment_hash}", self.incoming_payment),
+                web.get("/payments/outgoing/{payment_id}", self.outgoing_payment),
+                web.get("/websocket", self.websocket),
+                web.post("/_standin/settle/{payment_hash}", self.settle_endpoint),
+                web.get("/_standin/stats", self.stats_endpoint),
+            ]
+        )
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    # Ledger
+
+    def _channel(self) -> dict:
+        inbound = max(self.config.inbound_liquidity_sat - self.balance_sat, 0)
+        return {
+            "state": "Normal",
+            "channelId": hashlib.sha256(self.node_id.encode()).hexdigest(),
+            "balanceSat": self.balance_sat,
+            "inboundLiquiditySat": inbound,
+            "capacitySat": self.balance_sat + inbound,
+            "fundingTxId": hashlib.sha256(
+                b"funding" + self.node_id.encode()
+            ).hexdigest(),
+        }
+
+    def create_invoice(
+        self,
+        *,
+        amount_sat: int,
+        description: str | None = None,
+        description_hash: bytes | None = None,
+        external_id: str | None = None,
+    ) -> StandinInvoice:
+        preimage = self.rng.randbytes(32)
+        payment_hash = hashlib.sha256(preimage).digest()
+        created_at = int(time.time() * 1000)
+        invoice = StandinInvoice(
+            payment_hash=payment_hash.hex(),
+            preimage=preimage.hex(),
+            amount_sat=amount_sat,
+            description=description,
+            external_id=external_id,
+            serialized=encode_invoice(
+                amount_sat=amount_sat,
+                payment_hash=payment_hash,
+                payment_secret=self.rng.randbytes(32),
+                description=description,
+                description_hash=description_hash,
+                timestamp=created_at // 1000,
+                signature=self.rng.randbytes(65),
+                chain=self.config.chain,
+            ),
+            created_at=created_at,
+        )
+        self.invoices[invoice.payment_hash] = invoice
+        self.stats["invoices_created"] += 1
+        if self.config.settle_after is not None:
+            handle = asyncio.get_running_loop().call_later(
+                self.config.settle_after, self._settle_later, invoice.payment_hash
+            )
+            self._settle_handles[invoice.payment_hash] = handle
+        return invoice
+
+    def _settle_later(self, payment_hash: str):
+        self._settle_handles.pop(payment_hash, None)
+        self.settle(payment_hash)
+
+    def settle(self, payment_hash: str, amount_sat: int | None = None) -> bool:
+        """
+        Mark an invoice paid and notify websocket listeners, returns `False` if
+        the invoice is unknown or already paid.
+        """
+        invoice = self.invoices.get(payment_hash)
+        if invoice is None or invoice.is_paid:
+            return False
+        invoice.is_paid = True
+        invoice.received_sat = (
+            amount_sat if amount_sat is not None else invoice.amount_sat
+        )
+        invoice.completed_at = int(time.time() * 1000)
+        self.balance_sat += invoice.received_sat
+        self.stats["invoices_settled"] += 1
+        event = {
+            "type": "payment_received",
+            "timestamp": invoice.completed_at,
+            "amountSat": invoice.received_sat,
+            "paymentHash": invoice.payment_hash,
+            "externalId": invoice.external_id,
+        }
+        for ws in list(self.websockets):
+            send = asyncio.ensure_future(ws.send_json(event))
+            # Kept so it isn't garbage collected before it's sent
+            self._sends.add(send)
+            send.add_done_callback(self._sends.discard)
+        logger.debug(
+            "Standin settled {payment_hash} sat={amount_sat}",
+            payment_hash=payment_hash,
+            amount_sat=invoice.received_sat,
+        )
+        return True
+
+    # Middleware
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        self.stats["requests"] += 1
+        if self.config.password is not None and not request.path.startswith(
+            "/_standin/"
+        ):
+            try:
+                auth = BasicAuth.decode(request.headers.get("Authorization", ""))
+            except ValueError:
+                auth = None
+            if auth is None or auth.password != self.config.password:
+                raise web.HTTPUnauthorized(text="Unauthorized")
+
+        if self._bucket is not None:
+            await self._bucket.acquire()
+        if self._semaphore is None:
+            return await self._handle(request, handler)
+        async with self._semaphore:
+            return await self._handle(request, handler)
+
+    async def _handle(self, request: web.Request, handler):
+        config = self.config
+        if config.latency or config.latency_jitter:
+            delay = config.latency + self.rng.uniform(
+                -config.latency_jitter, config.latency_jitter
+            )
+            await asyncio.sleep(max(delay, 0.0))
+        if config.stall_rate and self.rng.random() < config.stall_rate:
+            self.stats["stalls_injected"] += 1
+            await asyncio.sleep(config.stall_seconds)
+        if config.failure_rate and self.rng.random() < config.failure_rate:
+            self.stats["failures_injected"] += 1
+            raise web.HTTPInternalServerError(text="Injected failure")
+        return await handler(request)
+
+    # phoenixd API
+
+    async def getinfo(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "nodeId": self.node_id,
+                "channels": [self._channel()],
+                "chain": self.config.chain,
+                "version": "0.0.0-standin",
+            }
+        )
+
+    async def getbalance(self, request: web.Request) -> web.Response:
+        return web.json_response({"balanceSat": self.balance_sat, "feeCreditSat": 0})
+
+    async def listchannels(self, request: web.Request) -> web.Response:
+        return web.json_response([self._channel()])
+
+    async def createinvoice(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        try:
+            amount_sat = int(str(form["amountSat"]))
+            # As phoenixd, either a description or the hex hash of one
+            description_hash = (
+                bytes.fromhex(str(form["descriptionHash"]))
+                if "descriptionHash" in form
+                else None
+            )
+            description = str(form["description"]) if description_hash is None else None
+            if description_hash is not None and len(description_hash) != 32:
+                raise ValueError("descriptionHash must be a hex SHA256 hash")
+        except (KeyError, ValueError) as exc:
+            raise web.HTTPBadRequest(
+                text=f"Invalid createinvoice request: {exc}"
+            ) from exc
+        external_id = form.get("externalId")
+        invoice = self.create_invoice(
+            amount_sat=amount_sat,
+            description=description,
+            description_hash=description_hash,
+            external_id=str(external_id) if external_id is not None else None,
+        )
+        return web.json_response(
+            {
+                "amountSat": invoice.amount_sat,
+                "paymentHash": invoice.payment_hash,
+                "serialized": invoice.serialized,
+            }
+        )
+
+    async def incoming_payments(self, request: web.Request) -> web.Response:
+        # As phoenixd: only paid invoices unless `all`, newest first, within
+        # an inclusive `from`-`to` range of (completion or creation) times
+        query = request.query
+        try:
+            external_id = query.get("externalId")
+            include_unpaid = query.get("all", "false").lower() == "true"
+            from_ms = int(query.get("from", 0))
+            to_ms = int(query.get("to", time.time() * 1000))
+            limit = int(query.get("limit", 20))
+            offset = int(query.get("offset", 0))
+        except ValueError as exc:
+            raise web.HTTPBadRequest(text=f"Invalid parameter: {exc}") from exc
+
+        def timestamp(invoice: StandinInvoice) -> int:
+            if include_unpaid or invoice.completed_at is None:
+                return invoice.created_at
+            return invoice.completed_at
+
+        invoices = sorted(
+            (
+                invoice
+                for invoice in self.invoices.values()
+                if (include_unpaid or invoice.is_paid)
+                and (external_id is None or invoice.external_id == external_id)
+                and from_ms <= timestamp(invoice) <= to_ms
+            ),
+            key=timestamp,
+            reverse=True,
+        )
+        return web.json_response(
+            [invoice.to_phoenixd() for invoice in invoices[offset : offset + limit]]
+        )
+
+    async def incoming_payment(self, request: web.Request) -> web.Response:
+        invoice = self.invoices.get(request.match_info["payment_hash"])
+        if invoice is None:
+            raise web.HTTPNotFound(text="Payment not found")
+        return web.json_response(invoice.to_phoenixd())
+
+    async def outgoing_payment(self, request: web.Request) -> web.Response:
+        # The stand-in never pays out
+        raise web.HTTPNotFound(text="Payment not found")
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.websockets.add(ws)
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.websockets.discard(ws)
+        return ws
+
+    # Stand-in controls
+
+    async def settle_endpoint(self, request: web.Request) -> web.Response:
+        amount = request.query.get("amountSat")
+        settled = self.settle(
+            request.match_info["payment_hash"],
+            int(amount) if amount is not None else None,
+        )
+        if not settled:
+            raise web.HTTPNotFound(text="Payment not found or already paid")
+        return web.json_response({"settled": True})
+
+    async def stats_endpoint(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def _on_shutdown(self, app: web.Application):
+        for handle in self._settle_handles.values():
+            handle.cancel()
+        self._settle_handles.clear()
+        await asyncio.gather(*self._sends, return_exceptions=True)
+        for ws in list(self.websockets):
+            await ws.close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.phoenixd_standin",
+        description="Run a local stand-in for the phoenixd HTTP API",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9740)
+    for name, field in StandinConfig.__fields__.items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=field.outer_type_ if field.outer_type_ in (int, float) else str,
+            default=None,
+        )
+    args = vars(parser.parse_args(argv))
+    host, port = args.pop("host"), args.pop("port")
+    config = StandinConfig.parse_obj({k: v for k, v in args.items() if v is not None})
+    web.run_app(PhoenixdStandin(config).app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
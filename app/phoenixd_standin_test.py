@@ -0,0 +1,136 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+from bech32 import (
+    bech32_decode,
+    convertbits,
+)
+from lnurl import LnurlPayActionResponse
+
+from .phoenixd_client import PhoenixdHttpClient
+from .phoenixd_standin import (
+    PhoenixdStandin,
+    StandinConfig,
+)
+
+
+def _tagged_fields(serialized: str) -> dict[int, bytes]:
+    _, words = bech32_decode(serialized)
+    assert words is not None
+    # After the timestamp, up to the 65 byte signature
+    words, fields = words[7:-104], {}
+    while words:
+        tag, length = words[0], words[1] << 5 | words[2]
+        fields[tag] = bytes(convertbits(words[3 : 3 + length], 5, 8, False) or [])
+        words = words[3 + length :]
+    return fields
+
+
+async def _client_for(standin: PhoenixdStandin):
+    server = TestServer(standin.app())
+    await server.start_server()
+    session = aiohttp.ClientSession(auth=aiohttp.BasicAuth("_", "hunter2"))
+    client = PhoenixdHttpClient(session=session, phoenixd_url=str(server.make_url("/")))
+    return server, session, client
+
+
+@pytest.mark.asyncio
+async def test_standin_node_info():
+    standin = PhoenixdStandin(StandinConfig(password="hunter2", seed=1))
+    server, session, client = await _client_for(standin)
+    try:
+        info = await client.getinfo()
+        assert info.node_id == standin.node_id
+        assert info.channels[0].inbound_liquidity_sat == 2_000_000
+        assert (await client.getbalance()).balance_sat == 0
+        assert len((await client.listchannels()).channels) == 1
+    finally:
+        await session.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_standin_rejects_bad_password():
+    standin = PhoenixdStandin(StandinConfig(password="hunter2"))
+    server = TestServer(standin.app())
+    await server.start_server()
+    async with (
+        aiohttp.ClientSession() as session,
+        session.get(server.make_url("/getinfo")) as response,
+    ):
+        assert response.status == 401
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_standin_invoice_lifecycle():
+    standin = PhoenixdStandin(StandinConfig(password="hunter2", seed=1))
+    server, session, client = await _client_for(standin)
+    try:
+        first = await client.createinvoice(
+            amount_sat=1337, description_hash="a" * 64, external_id="ext"
+        )
+        second = await client.createinvoice(amount_sat=1337, description="a" * 64)
+        assert first.payment_hash != second.payment_hash
+        # A hash only if passed as one, like phoenixd
+        assert _tagged_fields(first.serialized)[23] == bytes.fromhex("a" * 64)
+        assert _tagged_fields(second.serialized)[13] == b"a" * 64
+        assert first.serialized.startswith("lntb13370n1")
+        # Invoices have to pass the same validation as in the callback route
+        LnurlPayActionResponse(pr=first.serialized)
+
+        payment = await client.incoming_payment_hash(first.payment_hash)
+        assert payment.is_paid is False
+        assert payment.external_id == "ext"
+
+        events = client.payments_websocket()
+        next_event = asyncio.ensure_future(events.__anext__())
+        # Give the websocket time to connect before paying
+        await asyncio.sleep(0.1)
+        async with session.post(
+            server.make_url(f"/_standin/settle/{first.payment_hash}")
+        ) as response:
+            assert response.status == 200
+        event = await asyncio.wait_for(next_event, timeout=2)
+        assert event.payment_hash == first.payment_hash
+        assert event.amount_sat == 1337
+        await events.aclose()
+
+        (paid,) = await client.incoming_payments_external_id("ext")
+        assert paid.is_paid is True
+        assert paid.received_sat == 1337
+        assert (await client.getbalance()).balance_sat == 1337
+    finally:
+        await session.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_standin_auto_settle():
+    standin = PhoenixdStandin(StandinConfig(password="hunter2", settle_after=0))
+    server, session, client = await _client_for(standin)
+    try:
+        invoice = await client.createinvoice(amount_sat=21, description="demo")
+        await asyncio.sleep(0.05)
+        assert (await client.incoming_payment_hash(invoice.payment_hash)).is_paid
+        # Forgotten once fired
+        assert standin._settle_handles == {}
+    finally:
+        await session.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_standin_failure_injection():
+    standin = PhoenixdStandin(StandinConfig(password="hunter2", failure_rate=1.0))
+    server, session, client = await _client_for(standin)
+    try:
+        with pytest.raises(aiohttp.ClientResponseError):
+            await client.createinvoice(amount_sat=21, description="demo")
+        assert standin.stats["failures_injected"] == 1
+        assert standin.invoices == {}
+    finally:
+        await session.close()
+        await server.close()
@@ -0,0 +1,210 @@
+"""
+Hot reload of settings, so editing `phoenixd-lnurl.env` doesn't need a restart
+(dropping keep-alive connections and starting every worker cold).
+
+The env file is checked for changes every `SETTINGS_RELOAD_INTERVAL` seconds,
+and reloaded straight away on SIGHUP where the app owns the main thread (e.g.
+plain uvicorn; gunicorn workers each watch the file). New settings are
+validated, and everything derived from them built, off the event loop before
+being swapped in at once; invalid settings are logged and the old ones kept.
+The phoenixd client is only replaced if its settings changed.
+"""
+
+import asyncio
+import os
+import signal
+from collections.abc import Callable
+from pathlib import Path
+
+from fastapi import FastAPI
+from loguru import logger
+from pydantic import ValidationError
+
+from .artifacts import LnurlArtifacts
+from .phoenixd_client import phoenixd_client_for
+from .settings import (
+    PhoenixdLNURLSettings,
+    load_settings,
+    settings_env_file,
+)
+
+# Changes to these need a new phoenixd client
+PHOENIXD_CLIENT_FIELDS = frozenset(
+    {
+        "phoenixd_url",
+        "phoenixd_urls",
+        "phoenixd_pool_strategy",
+        "phoenixd_health_interval",
+    }
+)
+
+# Only read at startup, so changes are logged, and the current values kept
+# until a restart
+RESTART_REQUIRED = frozenset(
+    {
+        "debug",
+        "is_test",
+        "log_level",
+        "log_format",
+        "log_enqueue",
+        "log_sample_rate",
+        "settings_reload_interval",
+        "tip_page_comments",
+        "comments_dir",
+        "comments_segment_bytes",
+        "comments_max_segments",
+        "fiat_currencies",
+        "fiat_rate_url",
+        "fiat_refresh_interval",
+        "fiat_max_age",
+        "fiat_rates_snapshot",
+        "batch_concurrency",
+        "capture_file",
+        "capture_max_bytes",
+        "capture_sample_rate",
+        "server_timing",
+        "slow_request_ms",
+        "shared_state_url",
+        "shared_state_flush_interval",
+    }
+)
+
+
+def build_artifacts(settings: PhoenixdLNURLSettings) -> LnurlArtifacts:
+    # Built in full, so nothing is left to build (slowly) on the next request
+    artifacts = LnurlArtifacts.build(settings, eager=True)
+    artifacts.pay_request_body()
+    return artifacts
+
+
+class SettingsReloader:
+    def __init__(
+        self,
+        app: FastAPI,
+        *,
+        path: Path | None = None,
+        interval: float | None = None,
+        load: Callable[[], PhoenixdLNURLSettings] = load_settings,
+    ):
+        settings: PhoenixdLNURLSettings = app.state.settings
+        self.app = app
+        self.path = path or settings_env_file(settings)
+        self.interval = (
+            settings.settings_reload_interval if interval is None else interval
+        )
+        self.load = load
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        self._signal_handler = False
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.interval > 0:
+            # Stat now, so changes made before the task first runs aren't missed
+            self._spawn(self.watch(self._stat()))
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
+            self._signal_handler = True
+        except (ValueError, RuntimeError, NotImplementedError, AttributeError):
+            # Not the main thread (e.g. under a test client), or not Unix
+            logger.debug("Not reloading settings on SIGHUP")
+
+    async def stop(self):
+        if self._signal_handler:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._signal_handler = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _on_sighup(self):
+        logger.info("Got SIGHUP, reloading settings")
+        self._spawn(self.reload())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _stat(self) -> tuple[int, int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        # Inode too, as editors often save by replacing the file
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    async def watch(self, last: tuple[int, int, int] | None):
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self._stat()
+            if current != last:
+                last = current
+                await self.reload()
+
+    async def reload(self) -> bool:
+        """
+        Reload settings, returning whether anything changed
+        """
+        async with self._lock:
+            try:
+                settings = await asyncio.to_thread(self.load)
+            except ValidationError as exc:
+                logger.error(
+                    "Invalid settings in '{path}', keeping current settings: {exc}",
+                    path=self.path,
+                    exc=exc,
+                )
+                return False
+
+            state = self.app.state
+            current: PhoenixdLNURLSettings = state.settings
+            if settings == current:
+                logger.debug("Settings in '{path}' unchanged", path=self.path)
+                return False
+            changed = {
+                field
+                for field in settings.__fields__
+                if getattr(settings, field) != getattr(current, field)
+            }
+            if restart_required := sorted(changed & RESTART_REQUIRED):
+                logger.warning(
+                    "Changes to {fields} take effect on restart",
+                    fields=restart_required,
+                )
+                # Kept as they were, as requests read them too, and half
+                # applying them (e.g. showing comments nothing marks paid, or
+                # currencies nothing fetches rates for) is worse than waiting
+                settings = settings.copy(
+                    update={
+                        field: getattr(current, field) for field in restart_required
+                    }
+                )
+                changed -= RESTART_REQUIRED
+                if not changed:
+                    return False
+
+            try:
+                artifacts = await asyncio.to_thread(build_artifacts, settings)
+            except Exception:
+                logger.exception("Could not apply new settings, keeping current")
+                return False
+
+            # NOTE no awaits from here on, so every request sees either the old
+            # or the new state, never a mix. Requests already in flight finish
+            # with whatever they already read.
+            if changed & PHOENIXD_CLIENT_FIELDS:
+                previous_client = state.phoenixd_client
+                state.phoenixd_client = phoenixd_client_for(
+                    settings, state.client_session
+                )
+                state.phoenixd_client.start()
+                self._spawn(previous_client.close())
+            state.settings = settings
+            state.artifacts = artifacts
+            logger.info(
+                "Reloaded settings from '{path}', changed: {fields}",
+                path=self.path,
+                fields=sorted(changed),
+            )
+            return True
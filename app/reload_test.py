@@ -0,0 +1,126 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from .main import app_factory
+from .phoenixd_client import PhoenixdMockClient
+from .reload import SettingsReloader
+from .settings import PhoenixdLNURLSettings
+
+
+@pytest.fixture
+def env_file(tmp_path) -> Path:
+    path = tmp_path / "phoenixd-lnurl.env"
+    path.write_text(Path("test.env").read_text())
+    return path
+
+
+@pytest.fixture
+def app(env_file):
+    app = app_factory()
+    app.state.settings = PhoenixdLNURLSettings(_env_file=env_file)
+    app.state.client_session = None
+    app.state.phoenixd_client = PhoenixdMockClient(
+        phoenixd_url=app.state.settings.phoenixd_url.get_secret_value()
+    )
+    return app
+
+
+def reloader_for(app, env_file, **kwargs) -> SettingsReloader:
+    return SettingsReloader(
+        app,
+        path=env_file,
+        load=lambda: PhoenixdLNURLSettings(_env_file=env_file),  # type: ignore
+        **kwargs,
+    )
+
+
+def edit(env_file: Path, old: str, new: str):
+    env_file.write_text(env_file.read_text().replace(old, new))
+
+
+@pytest.mark.asyncio
+async def test_reload_swaps_settings_and_artifacts(app, env_file):
+    reloader = reloader_for(app, env_file)
+    client = app.state.phoenixd_client
+    assert not await reloader.reload()
+
+    edit(env_file, "USERNAME=satoshi", "USERNAME=hal")
+    assert await reloader.reload()
+    assert app.state.settings.username == "hal"
+    assert app.state.artifacts.username == "hal"
+    assert app.state.artifacts.metadata_hash == app.state.settings.metadata_hash()
+    # Built in full, so the first request after a reload isn't slow
+    assert app.state.artifacts.tip_page_html is not None
+    assert app.state.artifacts.lnurl_qr is not None
+    # Same phoenixd, same client
+    assert app.state.phoenixd_client is client
+
+
+@pytest.mark.asyncio
+async def test_reload_rebuilds_phoenixd_client_on_url_change(app, env_file):
+    reloader = reloader_for(app, env_file)
+    client = app.state.phoenixd_client
+    edit(env_file, "127.0.0.1:9740", "127.0.0.1:9741")
+    assert await reloader.reload()
+    assert app.state.phoenixd_client is not client
+    assert app.state.phoenixd_client.baseurl.port == 9741
+
+
+@pytest.mark.asyncio
+async def test_reload_keeps_restart_required_settings(app, env_file):
+    reloader = reloader_for(app, env_file)
+    artifacts = app.state.artifacts
+    with open(env_file, "a") as file:
+        file.write("TIP_PAGE_COMMENTS=5\nFIAT_CURRENCIES='[\"EUR\"]'\n")
+    # Nothing else changed, so nothing to reload
+    assert not await reloader.reload()
+    assert app.state.artifacts is artifacts
+
+    edit(env_file, "USERNAME=satoshi", "USERNAME=hal")
+    assert await reloader.reload()
+    assert app.state.settings.username == "hal"
+    # Until restarted, as the comment watcher and rate fetching aren't running
+    assert app.state.settings.tip_page_comments == 0
+    assert app.state.settings.fiat_currencies == []
+    assert "recent-comments" not in app.state.artifacts.tip_page_html
+
+
+@pytest.mark.asyncio
+async def test_reload_keeps_settings_when_invalid(app, env_file):
+    reloader = reloader_for(app, env_file)
+    settings = app.state.settings
+    artifacts = app.state.artifacts
+    edit(env_file, "USERNAME=satoshi", "USERNAME='Not Valid!'")
+    assert not await reloader.reload()
+    assert app.state.settings is settings
+    assert app.state.artifacts is artifacts
+
+
+@pytest.mark.asyncio
+async def test_watch_reloads_on_change(app, env_file):
+    reloader = reloader_for(app, env_file, interval=0.01)
+    reloader.start()
+    try:
+        edit(env_file, "MAX_SATS_RECEIVABLE=500000", "MAX_SATS_RECEIVABLE=21000")
+        for _ in range(200):
+            if app.state.settings.max_sats_receivable == 21000:
+                break
+            await asyncio.sleep(0.01)
+        assert app.state.settings.max_sats_receivable == 21000
+        assert app.state.artifacts.max_sendable == 21000 * 1000
+    finally:
+        await reloader.stop()
+
+
+def test_requests_after_reload(app, env_file):
+    with TestClient(app) as client:
+        assert client.get("/lnurlp/satoshi").status_code == 200
+        edit(env_file, "USERNAME=satoshi", "USERNAME=hal")
+        assert client.portal.call(reloader_for(app, env_file).reload)
+        assert client.get("/lnurlp/satoshi").status_code == 404
+        response = client.get("/.well-known/lnurlp/hal")
+        assert response.status_code == 200
+        assert response.json()["callback"].endswith("/lnurlp/hal/callback")
@@ -0,0 +1,207 @@
+"""
+Replay traffic captured with `CAPTURE_FILE` (see `capture.py`), keeping its
+timing, against an instance of the app, and report latencies by route:
+
+    python -m app.replay capture.ndjson capture.ndjson.1 --speed 10
+
+By default the app is run in-process with `PhoenixdMockClient` and the test
+settings (`test.env`, without shared state, fiat rates or a rate limit), so
+what's measured is the app itself, not phoenixd, the network or the
+configured instance's limits; `--url` replays against a running instance
+instead, which should have `CALLBACK_RATE_LIMIT` off as every request comes
+from the one address. Requests are sent when they were captured,
+divided by `--speed`, without waiting on earlier ones, so bursts are replayed
+as bursts.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+from pathlib import Path
+
+import httpx
+
+from .capture import OTHER_PATH
+from .main import app_factory
+from .phoenixd_client import PhoenixdMockClient
+from .settings import (
+    TEST_ENV_FILE,
+    PhoenixdLNURLSettings,
+    load_settings,
+)
+
+# Sent for paths the app doesn't serve
+OTHER_PATH_REPLAYED = "/replayed-unknown-path"
+
+
+def load_trace(paths: Iterable[Path]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="UTF-8") as lines:
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # e.g. a partly written last line
+                    continue
+    return sorted(records, key=lambda record: record["t"])
+
+
+def request_for(record: dict, username: str) -> tuple[str, str, dict[str, str]]:
+    """
+    A request like the one captured in `record`: method, path and query
+    """
+    path = record["p"]
+    if path == OTHER_PATH:
+        path = OTHER_PATH_REPLAYED
+    path = path.replace("{user}", username).replace("{other}", f"not{username}")
+    params = {}
+    for key, value in record["q"].items():
+        if key == "amount":
+            params[key] = "" if value is None else str(value)
+        elif key == "payerdata":
+            # Roughly as long as the original
+            params[key] = json.dumps({"name": "x" * max(value - 12, 0)})
+        else:
+            params[key] = "x" * value
+    return record["m"], path, params
+
+
+def percentiles(latencies: list[float]) -> dict[str, float]:
+    ordered = sorted(latencies)
+    cuts = statistics.quantiles(ordered, n=100) if len(ordered) > 1 else ordered * 99
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 3),
+        "p50": round(cuts[49], 3),
+        "p90": round(cuts[89], 3),
+        "p99": round(cuts[98], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+async def replay(
+    client: httpx.AsyncClient,
+    records: list[dict],
+    *,
+    username: str,
+    speed: float = 1.0,
+) -> dict:
+    """
+    Latency percentiles in milliseconds by method and path, and how many
+    responses had a different status than when captured
+    """
+    latencies: dict[str, list[float]] = defaultdict(list)
+    mismatched: dict[str, int] = defaultdict(int)
+
+    async def send(record: dict):
+        method, path, params = request_for(record, username)
+        started = time.perf_counter()
+        response = await client.request(method, path, params=params)
+        route = f"{record['m']} {record['p']}"
+        latencies[route].append((time.perf_counter() - started) * 1000)
+        if response.status_code != record["s"]:
+            mismatched[route] += 1
+
+    if not records:
+        return {"routes": {}, "status_mismatches": {}}
+    first = records[0]["t"]
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        delay = (record["t"] - first) / 1000 / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(record)))
+    await asyncio.gather(*tasks)
+    return {
+        "duration": round(time.perf_counter() - started, 3),
+        "routes": {
+            route: percentiles(route_latencies)
+            for route, route_latencies in sorted(latencies.items())
+        },
+        "status_mismatches": dict(mismatched),
+    }
+
+
+def replay_settings() -> PhoenixdLNURLSettings:
+    """
+    The test settings, with nothing that reaches outside the process, and no
+    limit on the one client replaying everything
+    """
+    return PhoenixdLNURLSettings(
+        _env_file=TEST_ENV_FILE,  # type: ignore
+        # NOTE passed in, as they'd otherwise be taken from the environment
+        shared_state_url=None,
+        callback_rate_limit=0,
+        fiat_currencies=[],
+        metadata_image=None,
+        capture_file=None,
+        artifacts_file=None,
+        settings_reload_interval=0,
+    )
+
+
+async def replay_in_process(records: list[dict], *, speed: float) -> dict:
+    settings = replay_settings()
+    app = app_factory(settings)
+    async with app.router.lifespan_context(app):
+        app.state.phoenixd_client = PhoenixdMockClient(
+            phoenixd_url=settings.phoenixd_url.get_secret_value()
+        )
+        async with httpx.AsyncClient(
+            # NOTE mypy unhappy with FastAPI's ASGI signature but it's correct
+            transport=httpx.ASGITransport(app=app),  # type: ignore[arg-type]
+            base_url="http://replay",
+        ) as client:
+            return await replay(
+                client, records, username=settings.username, speed=speed
+            )
+
+
+async def replay_remote(
+    records: list[dict], *, url: str, username: str, speed: float
+) -> dict:
+    async with httpx.AsyncClient(base_url=url, timeout=30.0) as client:
+        return await replay(client, records, username=username, speed=speed)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.replay",
+        description="Replay captured traffic and report latencies by route",
+    )
+    parser.add_argument("captures", nargs="+", type=Path)
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="e.g. 10 to replay 10x faster"
+    )
+    parser.add_argument(
+        "--url",
+        help="Replay against a running instance rather than in-process",
+    )
+    parser.add_argument(
+        "--username",
+        help="The instance's USERNAME, with --url. Defaults to the configured one",
+    )
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    records = load_trace(args.captures)
+    print(f"Replaying {len(records)} requests", file=sys.stderr)
+    if args.url is None:
+        report = asyncio.run(replay_in_process(records, speed=args.speed))
+    else:
+        username = args.username or load_settings().username
+        report = asyncio.run(
+            replay_remote(records, url=args.url, username=username, speed=args.speed)
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Opt-in per-request timing, for finding where the time went on a slow zap
+from the wallet or proxy side without full tracing.
+
+With `SERVER_TIMING=1`, responses get a `Server-Timing` header (shown by
+browser dev tools, and loggable by nginx as `$sent_http_server_timing`) with
+milliseconds spent in each phase of the request:
+
+    Server-Timing: validate;dur=0.41, settings;dur=0.05, phoenixd;dur=82.1,
+        serialize;dur=0.12, total;dur=82.9
+
+- `validate`, from the request arriving to the route's code starting: routing
+  and query validation (and the middleware ahead of them)
+- `settings`, deriving the response from settings and metadata: amount limits,
+  comments, payer data, the payRequest itself
+- `phoenixd`, the `createinvoice` round trip
+- `render`, the tip page at `/lnurl`
+- `serialize`, from the route's code finishing to the response being sent
+
+Phases are only reported for requests that reach them. With
+`SLOW_REQUEST_MS`, requests taking longer than that in total are logged as a
+warning with the same breakdown as structured fields, whether or not the
+header is sent.
+"""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from loguru import logger
+from starlette.types import (
+    ASGIApp,
+    Message,
+    Receive,
+    Scope,
+    Send,
+)
+
+from .settings import PhoenixdLNURLSettings
+
+
+class RequestTiming:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        # When the last phase ended, which is when the next one starts
+        self.boundary = self.started
+        # Milliseconds, in the order phases happened
+        self.phases: dict[str, float] = {}
+        self.reached_route = False
+
+    def add(self, name: str, since: float) -> None:
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + (now - since) * 1000
+        self.boundary = now
+
+    def breakdown(self, responded: float) -> dict[str, float]:
+        """
+        Milliseconds in each phase, and in total, for a response sent at
+        `responded`
+        """
+        phases = dict(self.phases)
+        if self.reached_route:
+            phases["serialize"] = (responded - self.boundary) * 1000
+        phases["total"] = (responded - self.started) * 1000
+        return {name: round(ms, 2) for name, ms in phases.items()}
+
+
+def server_timing_header(breakdown: dict[str, float]) -> bytes:
+    return ", ".join(f"{name};dur={ms}" for name, ms in breakdown.items()).encode(
+        "latin-1"
+    )
+
+
+_timing: ContextVar[RequestTiming | None] = ContextVar("timing", default=None)
+
+
+def mark(name: str) -> None:
+    """
+    End a phase `name` that started when the last one ended, e.g. `validate`
+    at the start of a route
+    """
+    timing = _timing.get()
+    if timing is not None:
+        timing.reached_route = True
+        timing.add(name, timing.boundary)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Time what's run in the block as phase `name`
+    """
+    timing = _timing.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, started)
+
+
+class ServerTimingMiddleware:
+    def __init__(self, app: ASGIApp, *, header: bool, slow_request_ms: float):
+        self.app = app
+        self.header = header
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = _timing.set(timing)
+        status_code = 500
+        breakdown: dict[str, float] | None = None
+
+        async def timing_send(message: Message):
+            nonlocal status_code, breakdown
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                breakdown = timing.breakdown(time.perf_counter())
+                if self.header:
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"server-timing", server_timing_header(breakdown)),
+                        ],
+                    }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timing_send)
+        finally:
+            _timing.reset(token)
+            total_ms = (time.perf_counter() - timing.started) * 1000
+            if self.slow_request_ms and total_ms > self.slow_request_ms:
+                # NOTE the breakdown is up to the response starting, while the
+                # total includes sending all of it
+                logger.warning(
+                    "Slow request {method} {path}: {status_code} in {total_ms}ms",
+                    method=scope["method"],
+                    path=scope["path"],
+                    status_code=status_code,
+                    total_ms=round(total_ms, 2),
+                    phases=breakdown or timing.breakdown(time.perf_counter()),
+                )
+
+
+def server_timing_options(settings: PhoenixdLNURLSettings) -> dict | None:
+    """
+    Options for `ServerTimingMiddleware`, or None if it's not wanted
+    """
+    if not settings.server_timing and not settings.slow_request_ms:
+        return None
+    return {
+        "header": settings.server_timing,
+        "slow_request_ms": settings.slow_request_ms,
+    }
@@ -0,0 +1,74 @@
+import pytest
+from fastapi.testclient import TestClient
+from loguru import logger
+
+from .main import app_factory
+
+
+def phases(response) -> list[str]:
+    return [
+        entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")
+    ]
+
+
+@pytest.mark.parametrize("fast_path", ["1", "0"])
+def test_server_timing_header(monkeypatch, fast_path):
+    monkeypatch.setenv("SERVER_TIMING", "1")
+    monkeypatch.setenv("FAST_PATH", fast_path)
+    with TestClient(app_factory()) as client:
+        callback = client.get("/lnurlp/satoshi/callback", params={"amount": 1337000})
+        assert callback.status_code == 200
+        assert phases(callback) == [
+            "validate",
+            "settings",
+            "phoenixd",
+            "serialize",
+            "total",
+        ]
+        too_low = client.get("/lnurlp/satoshi/callback", params={"amount": 1000})
+        assert too_low.status_code == 400
+        assert phases(too_low) == ["validate", "serialize", "total"]
+        pay_request = client.get("/.well-known/lnurlp/satoshi")
+        assert phases(pay_request) == ["validate", "settings", "serialize", "total"]
+        assert phases(client.get("/lnurl")) == [
+            "validate",
+            "render",
+            "serialize",
+            "total",
+        ]
+        assert phases(client.get("/wp-login.php")) == ["total"]
+        total = callback.headers["server-timing"].split(", ")[-1]
+        assert float(total.removeprefix("total;dur=")) > 0
+
+
+def test_server_timing_off_by_default():
+    with TestClient(app_factory()) as client:
+        response = client.get("/lnurlp/satoshi/callback", params={"amount": 1337000})
+    assert "server-timing" not in response.headers
+
+
+def test_slow_request_logged(monkeypatch):
+    # Slow requests are logged without sending the header
+    monkeypatch.setenv("SLOW_REQUEST_MS", "0.001")
+    app = app_factory()
+    records = []
+    sink = logger.add(lambda message: records.append(message.record), level="WARNING")
+    try:
+        with TestClient(app) as client:
+            response = client.get(
+                "/lnurlp/satoshi/callback", params={"amount": 1337000}
+            )
+    finally:
+        logger.remove(sink)
+    assert "server-timing" not in response.headers
+    [slow] = [r for r in records if r["message"].startswith("Slow request")]
+    assert slow["extra"]["method"] == "GET"
+    assert slow["extra"]["path"] == "/lnurlp/satoshi/callback"
+    assert slow["extra"]["status_code"] == 200
+    assert list(slow["extra"]["phases"]) == [
+        "validate",
+        "settings",
+        "phoenixd",
+        "serialize",
+        "total",
+    ]
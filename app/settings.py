@@ -1,30 +1,113 @@
 import hashlib
 import json
+import os
+from pathlib import Path
+from typing import Literal
 
 import lnurl
-import qrcode.image.svg
 from pydantic import (
     BaseSettings,
     Field,
     HttpUrl,
     SecretStr,
+    parse_obj_as,
 )
-from qrcode.main import QRCode
 from yarl import URL
 
 MAX_CORN = 21_000_000 * 100_000_000
+TEST_ENV_FILE = Path("test.env")
 
 
 class PhoenixdLNURLSettings(BaseSettings):
     username: str = Field(regex=r"^[a-z0-9-_\.]+$")
     lnurl_hostname: str
     phoenixd_url: SecretStr
+    # More phoenixd instances to spread invoices across along with
+    # `phoenixd_url`, as a JSON list of URLs, see `phoenixd_pool.py`
+    phoenixd_urls: list[SecretStr] = []
+    # How invoices are spread across phoenixd instances: to the one with the
+    # fewest requests in flight, or at random weighted by inbound liquidity
+    phoenixd_pool_strategy: Literal["least_outstanding", "liquidity"] = (
+        "least_outstanding"
+    )
+    # Seconds between `getinfo` health checks of each phoenixd in a pool
+    phoenixd_health_interval: float = Field(default=10.0, gt=0)
 
     min_sats_receivable: int = Field(default=1, ge=1)
     max_sats_receivable: int = Field(default=MAX_CORN, ge=1)
     user_profile_image_url: HttpUrl | None = None
     user_nostr_address: str | None = None
+    # Image (path or URL) to embed a thumbnail of in payRequest metadata, see
+    # `metadata_image.py`
+    metadata_image: str | None = None
+    metadata_image_size: int = Field(default=128, ge=16, le=1024)
+    metadata_image_max_bytes: int = Field(default=32 * 1024, ge=1024)
+    metadata_image_cache: Path = Path("metadata-image.json")
+    # Longest LUD-12 comment accepted with payments, 0 to not accept comments
+    comment_allowed: int = Field(default=0, ge=0, le=2000)
+    # Offer to take LUD-18 payer data (name, pubkey, identifier, email)
+    payer_data: bool = False
+    # How many recent paid comments to show on the tip page, 0 for none
+    tip_page_comments: int = Field(default=0, ge=0, le=100)
+    # Where comments and payer data are kept, see `comments.py`
+    comments_dir: Path = Path("comments")
+    comments_segment_bytes: int = Field(default=16 * 1024 * 1024, ge=4096)
+    comments_max_segments: int = Field(default=8, ge=1)
+    # Currency codes, e.g. ["USD", "EUR"], to show amounts in on the tip page and
+    # in payRequests (LUD-21), see `fiat_rates.py`
+    fiat_currencies: list[str] = []
+    fiat_rate_url: str = "https://api.coingecko.com/api/v3/simple/price"
+    fiat_refresh_interval: float = Field(default=300.0, ge=10)
+    # Rates older than this, in seconds, e.g. as the provider is down, aren't shown
+    fiat_max_age: float = Field(default=3600.0, gt=0)
+    fiat_rates_snapshot: Path = Path("fiat-rates.json")
     log_level: str = "INFO"
+    # "pretty" for humans, "json" for log shippers (one JSON object per line)
+    log_format: Literal["pretty", "json"] = "pretty"
+    # Write logs from a background thread so the event loop never waits on stdout
+    log_enqueue: bool = False
+    # Fraction of high-volume per-request info lines to keep, e.g. 0.01 for 1%
+    log_sample_rate: float = Field(default=1.0, ge=0, le=1)
+    # Answer payRequests and callbacks without going through FastAPI, see `fast_path.py`
+    fast_path: bool = True
+    # Precomputed QR code, encoded LNURL, tip page etc., see `python -m app.artifacts`
+    artifacts_file: Path | None = None
+    # Seconds between checks of the env file for changes to hot reload, 0 to
+    # only reload on SIGHUP, see `reload.py`
+    settings_reload_interval: float = Field(default=5.0, ge=0)
+
+    # Record the shape of traffic to this file, for `python -m app.replay`, see
+    # `capture.py`
+    capture_file: Path | None = None
+    capture_max_bytes: int = Field(default=64 * 1024 * 1024, ge=4096)
+    # Fraction of requests to record, between 0 and 1
+    capture_sample_rate: float = Field(default=1.0, ge=0, le=1)
+    # Send a `Server-Timing` header breaking down where each request's time went,
+    # and log requests slower than this many milliseconds, 0 to not, see
+    # `server_timing.py`
+    server_timing: bool = False
+    slow_request_ms: float = Field(default=0.0, ge=0)
+
+    # State shared with other hosts serving this LNURL, as a redis:// URL, see
+    # `coordination.py`. Unset, it's kept in each process
+    shared_state_url: SecretStr | None = None
+    # Seconds between sending what's changed to, and reading totals from, it
+    shared_state_flush_interval: float = Field(default=0.5, gt=0)
+    # Callbacks (so invoices) allowed per client address per
+    # `callback_rate_window` seconds, across hosts, 0 for no limit
+    callback_rate_limit: int = Field(default=0, ge=0)
+    callback_rate_window: float = Field(default=60.0, gt=0)
+    # Reverse proxies in front that append to X-Forwarded-For, so the client
+    # is that many addresses from its right, 0 to ignore it and use the address
+    # the server reports
+    trusted_proxy_hops: int = Field(default=0, ge=0)
+
+    # Bearer token for the `/admin/...` endpoints, which are off if unset
+    admin_token: SecretStr | None = None
+    # Invoices requested from phoenixd at once by `/admin/invoices/batch`, across
+    # all batches, and the most in one batch, see `batch.py`
+    batch_concurrency: int = Field(default=4, ge=1, le=64)
+    batch_max_invoices: int = Field(default=10_000, ge=1)
 
     # Enable development/debug features. Unsafe on prod.
     debug: bool = False
@@ -49,29 +132,65 @@ class PhoenixdLNURLSettings(BaseSettings):
         return lnurl.encode(str(self.base_url() / "lnurlp" / self.username))
 
     def lnurl_qr(self) -> str:
-        lnurl_qr = QRCode(
-            # NOTE mypy unhappy with passing this class but seems correct
-            image_factory=qrcode.image.svg.SvgPathFillImage,  # type: ignore
-            box_size=15,
-        )
-        lnurl_qr.add_data(self.lnurl_address_encoded())
-        lnurl_qr.make(fit=True)
-        return lnurl_qr.make_image().to_string(encoding="unicode")
-
-    def metadata_for_payrequest(self) -> str:
-        return json.dumps(
-            [
-                ["text/plain", f"Zap {self.username} some sats"],
-                ["text/identifier", self.lnurl_address()],
-                # ["image/jpeg;base64", "TODO optional"],
-            ]
-        )
-
-    def metadata_hash(self) -> str:
+        return qr_svg(self.lnurl_address_encoded())
+
+    def metadata_for_payrequest(self, image: tuple[str, str] | None = None) -> str:
+        """
+        LUD-06 metadata, optionally with an image entry such as
+        `("image/jpeg;base64", data)`, see `metadata_image.py`
+        """
+        metadata = [
+            ["text/plain", f"Zap {self.username} some sats"],
+            ["text/identifier", self.lnurl_address()],
+        ]
+        if image is not None:
+            metadata.append(list(image))
+        return json.dumps(metadata)
+
+    def metadata_hash(self, image: tuple[str, str] | None = None) -> str:
         return hashlib.sha256(
-            self.metadata_for_payrequest().encode("UTF-8")
+            self.metadata_for_payrequest(image).encode("UTF-8")
         ).hexdigest()
 
     class Config:
         env_file = "phoenixd-lnurl.env"
         env_file_encoding = "utf-8"
+
+
+def qr_svg(data: str) -> str:
+    # NOTE qrcode (and PIL, which it pulls in) are slow to import and only
+    # needed for the tip page, so are imported on first use
+    import qrcode.image.svg
+    from qrcode.main import QRCode
+
+    qr = QRCode(
+        # NOTE mypy unhappy with passing this class but seems correct
+        image_factory=qrcode.image.svg.SvgPathFillImage,  # type: ignore
+        box_size=15,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.make_image().to_string(encoding="unicode")
+
+
+def load_settings() -> PhoenixdLNURLSettings:
+    """
+    Load settings from the environment and `phoenixd-lnurl.env`, or from
+    `test.env` when `IS_TEST` is set
+    """
+    if parse_obj_as(bool, os.environ.get("IS_TEST") or False):
+        return PhoenixdLNURLSettings(_env_file=TEST_ENV_FILE)  # type: ignore
+    # Settings are auto-loaded from a `.env` file
+    settings = PhoenixdLNURLSettings()  # type: ignore
+    if settings.is_test:
+        settings = PhoenixdLNURLSettings(_env_file=TEST_ENV_FILE)  # type: ignore
+    return settings
+
+
+def settings_env_file(settings: PhoenixdLNURLSettings) -> Path:
+    """
+    The env file `settings` were loaded from by `load_settings`
+    """
+    if settings.is_test:
+        return TEST_ENV_FILE
+    return Path(PhoenixdLNURLSettings.Config.env_file)
@@ -1,7 +1,26 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import random
+import threading
+import traceback
+import weakref
+from typing import (
+    Any,
+    TextIO,
+)
 
 from loguru import logger
 
+# High-volume, per-request info lines are logged through this, so they can be
+# sampled with `LOG_SAMPLE_RATE` rather than written every time
+sampled_logger = logger.bind(sampled=True)
+
+# stdlib loggers whose records are also subject to sampling
+SAMPLED_STDLIB_LOGGERS = frozenset({"uvicorn.access"})
+
 
 class InterceptHandler(logging.Handler):
     def emit(self, record: logging.LogRecord):
@@ -10,7 +29,8 @@ class InterceptHandler(logging.Handler):
             level = logger.level(record.levelname).name
         except ValueError:
             level = "INFO"
-        logger.opt(exception=record.exc_info).log(level, record.getMessage())
+        target = sampled_logger if record.name in SAMPLED_STDLIB_LOGGERS else logger
+        target.opt(exception=record.exc_info).log(level, record.getMessage())
 
 
 def intercept_logging():
@@ -22,3 +42,120 @@ def intercept_logging():
     for logger_name in logging.root.manager.loggerDict:
         found_logger = logging.getLogger(logger_name)
         found_logger.handlers = [intercept_handler]
+
+
+class QueuedWriter:
+    """
+    A loguru sink that hands formatted messages to a background thread for
+    writing, so a slow or blocked stream can't stall the event loop.
+
+    The queue is bounded: when it is full, messages are dropped and counted
+    in `dropped` rather than making the caller wait, and how many is written
+    out when stopped.
+    """
+
+    _STOP = object()
+
+    def __init__(self, stream: TextIO, maxsize: int = 10_000):
+        self.stream = stream
+        self.dropped = 0
+        self._maxsize = maxsize
+        self._start()
+
+    def _start(self) -> None:
+        self._queue: queue.Queue = queue.Queue(maxsize=self._maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._thread.start()
+        _running.add(self)
+
+    def write(self, message: str):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """
+        Write out what's queued and stop, also called by loguru when the sink
+        is removed
+        """
+        _running.discard(self)
+        if not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout=5)
+        if self.dropped:
+            # NOTE straight to the stream, as this sink is going away
+            self.stream.write(
+                f"{self.dropped} log messages were dropped as writing fell behind\n"
+            )
+            self.stream.flush()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is self._STOP:
+                break
+            self.stream.write(message)
+            if self._queue.empty():
+                self.stream.flush()
+        self.stream.flush()
+
+
+# Writers not stopped yet. Weak, so a writer that's been replaced and
+# forgotten isn't kept around by the hooks below
+_running: "weakref.WeakSet[QueuedWriter]" = weakref.WeakSet()
+
+
+def _stop_running():
+    for writer in list(_running):
+        writer.stop()
+
+
+def _restart_running():
+    # Threads don't survive a fork (e.g. gunicorn `--preload`), so each child
+    # process needs its own
+    for writer in list(_running):
+        writer._start()
+
+
+atexit.register(_stop_running)
+os.register_at_fork(after_in_child=_restart_running)
+
+
+def sampling_filter(sample_rate: float):
+    """
+    Build a loguru filter that keeps only `sample_rate` of the records logged
+    via `sampled_logger`, all other records are kept.
+    """
+
+    def _filter(record: dict[str, Any]) -> bool:
+        if not record["extra"].get("sampled"):
+            return True
+        return sample_rate >= 1.0 or random.random() < sample_rate
+
+    return _filter
+
+
+def json_format(record: dict[str, Any]) -> str:
+    """
+    A loguru format function giving one compact JSON object per line
+    """
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "logger": record["name"],
+        "message": record["message"],
+    }
+    extra = {k: v for k, v in record["extra"].items() if k not in ("sampled", "json")}
+    if extra:
+        entry["extra"] = extra
+    if record["exception"] is not None:
+        exc_type, exc_value, exc_tb = record["exception"]
+        entry["exception"] = "".join(
+            traceback.format_exception(exc_type, exc_value, exc_tb)
+        )
+    record["extra"]["json"] = json.dumps(entry, default=str)
+    return "{extra[json]}\n"
@@ -0,0 +1,106 @@
+import io
+import json
+import os
+import time
+
+from loguru import logger
+
+from . import setup_logging
+from .setup_logging import (
+    QueuedWriter,
+    json_format,
+    sampled_logger,
+    sampling_filter,
+)
+
+
+def _capture(**kwargs) -> tuple[io.StringIO, int]:
+    stream = io.StringIO()
+    handler_id = logger.add(stream, **kwargs)
+    return stream, handler_id
+
+
+def test_queued_writer_writes_in_background():
+    stream = io.StringIO()
+    writer = QueuedWriter(stream)
+    writer.write("one\n")
+    writer.write("two\n")
+    writer.stop()
+    assert stream.getvalue() == "one\ntwo\n"
+    assert writer.dropped == 0
+
+
+def test_queued_writer_drops_when_full():
+    class SlowStream(io.StringIO):
+        def write(self, s):
+            time.sleep(0.2)
+            return super().write(s)
+
+    writer = QueuedWriter(SlowStream(), maxsize=1)
+    for _ in range(10):
+        writer.write("line\n")
+    assert writer.dropped > 0
+    writer.stop()
+    assert writer.stream.getvalue().endswith(
+        f"{writer.dropped} log messages were dropped as writing fell behind\n"
+    )
+
+
+def test_queued_writers_stopped_once():
+    writers = [QueuedWriter(io.StringIO()) for _ in range(3)]
+    assert set(writers) <= set(setup_logging._running)
+    # e.g. as loguru does when `configure_logging` replaces the sink
+    logger.remove(logger.add(writers[0]))
+    assert writers[0] not in setup_logging._running
+    for writer in writers[1:]:
+        writer.stop()
+    assert not set(writers) & set(setup_logging._running)
+
+
+def test_sampling_filter():
+    stream, handler_id = _capture(filter=sampling_filter(0.0), format="{message}")
+    try:
+        sampled_logger.info("dropped")
+        logger.info("kept")
+    finally:
+        logger.remove(handler_id)
+    assert stream.getvalue() == "kept\n"
+
+
+def test_sampling_filter_keeps_all_at_one():
+    stream, handler_id = _capture(filter=sampling_filter(1.0), format="{message}")
+    try:
+        for _ in range(5):
+            sampled_logger.info("kept")
+    finally:
+        logger.remove(handler_id)
+    assert stream.getvalue() == "kept\n" * 5
+
+
+def test_json_format():
+    stream, handler_id = _capture(format=json_format)
+    try:
+        logger.bind(request_id="abc").warning("Hello {name}", name="satoshi")
+        sampled_logger.info("sampled")
+    finally:
+        logger.remove(handler_id)
+    first, second = (json.loads(line) for line in stream.getvalue().splitlines())
+    assert first["level"] == "WARNING"
+    assert first["message"] == "Hello satoshi"
+    assert first["extra"] == {"request_id": "abc", "name": "satoshi"}
+    assert "extra" not in second
+
+
+def test_queued_writer_survives_fork():
+    read_fd, write_fd = os.pipe()
+    writer = QueuedWriter(os.fdopen(write_fd, "w"))
+    pid = os.fork()
+    if pid == 0:
+        writer.write("from child\n")
+        writer.stop()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    writer.stop()
+    writer.stream.close()
+    with os.fdopen(read_fd) as output:
+        assert output.read() == "from child\n"
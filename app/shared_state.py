@@ -0,0 +1,242 @@
+"""
+State shared by every host (and worker) serving this LNURL, for running
+several behind a load balancer, see `coordination.py` for what's shared.
+
+Backends take a batch of operations at a time, so however many requests
+contributed to it, a batch costs one round trip:
+
+- `InProcessSharedState`, the default, a dict in this process, so "shared"
+  only by the requests it serves
+- `RespSharedState`, with `SHARED_STATE_URL=redis://:password@host:6379/0`,
+  any server speaking the Redis protocol (RESP), with the batch sent as one
+  pipeline. `python -m app.kv_standin` is a local stand-in for one
+"""
+
+import asyncio
+import time
+from abc import (
+    ABC,
+    abstractmethod,
+)
+
+from loguru import logger
+from yarl import URL
+
+from .settings import PhoenixdLNURLSettings
+
+
+class SharedStateError(Exception):
+    """
+    The shared state couldn't be reached, or refused a batch
+    """
+
+
+class StateBatch:
+    """
+    Operations sent to the shared state together. Keys expire `ttl` seconds
+    after they're first counted, or after they're last set
+    """
+
+    def __init__(self) -> None:
+        self.increments: dict[str, tuple[int, float]] = {}
+        self.writes: dict[str, tuple[str, float]] = {}
+        self.reads: list[str] = []
+
+    def incr(self, key: str, amount: int, ttl: float):
+        previous, _ = self.increments.get(key, (0, ttl))
+        self.increments[key] = (previous + amount, ttl)
+
+    def set(self, key: str, value: str, ttl: float):
+        self.writes[key] = (value, ttl)
+
+    def get(self, key: str):
+        self.reads.append(key)
+
+
+class StateBatchResult:
+    def __init__(self, counts: dict[str, int], values: dict[str, str | None]):
+        # Totals of the counters incremented, after the increments
+        self.counts = counts
+        # Values read, None for missing keys
+        self.values = values
+
+
+class SharedStateBase(ABC):
+    async def close(self):  # noqa: B027 optional, unlike `execute`
+        """
+        Release connections, if any
+        """
+
+    @abstractmethod
+    async def execute(self, batch: StateBatch) -> StateBatchResult: ...
+
+
+class InProcessSharedState(SharedStateBase):
+    def __init__(self, *, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> (value, when it expires on the monotonic clock), oldest first
+        self._data: dict[str, tuple[int | str, float]] = {}
+
+    def _live(self, key: str, now: float) -> int | str | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry[0]
+
+    def _store(self, key: str, value: int | str, expires: float):
+        self._data.pop(key, None)
+        self._data[key] = (value, expires)
+        while len(self._data) > self.max_keys:
+            # NOTE dicts keep insertion order, so this is the oldest write
+            del self._data[next(iter(self._data))]
+
+    async def execute(self, batch: StateBatch) -> StateBatchResult:
+        now = time.monotonic()
+        counts = {}
+        for key, (amount, ttl) in batch.increments.items():
+            current = self._live(key, now)
+            if isinstance(current, int):
+                total = current + amount
+                # Counted on from where it was, keeping its expiry
+                self._data[key] = (total, self._data[key][1])
+            else:
+                total = amount
+                self._store(key, total, now + ttl)
+            counts[key] = total
+        for key, (value, ttl) in batch.writes.items():
+            self._store(key, value, now + ttl)
+        values: dict[str, str | None] = {}
+        for key in batch.reads:
+            stored = self._live(key, now)
+            values[key] = None if stored is None else str(stored)
+        return StateBatchResult(counts, values)
+
+
+def encode_command(*args: str | bytes | int) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+class RespError(Exception):
+    """
+    An error reply, e.g. to an unknown command
+    """
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2].decode()
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise SharedStateError(f"Unexpected reply {line!r}")
+
+
+def _millis(ttl: float) -> int:
+    # Expiries must be positive, so a whole millisecond at least
+    return max(int(ttl * 1000), 1)
+
+
+class RespSharedState(SharedStateBase):
+    def __init__(self, url: str | URL, *, timeout: float = 2.0):
+        self.url = url if isinstance(url, URL) else URL(url)
+        self.timeout = timeout
+        # Batches sent, each one round trip
+        self.round_trips = 0
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        # One pipeline at a time, so replies are read in the order sent
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.url.host, self.url.port or 6379
+        )
+        setup = []
+        if self.url.password:
+            setup.append(encode_command("AUTH", self.url.password))
+        if (db := self.url.path.strip("/")) not in ("", "0"):
+            setup.append(encode_command("SELECT", db))
+        if setup:
+            await self._pipeline(setup)
+
+    async def _pipeline(self, commands: list[bytes]) -> list:
+        assert self._reader is not None and self._writer is not None
+        self._writer.write(b"".join(commands))
+        await self._writer.drain()
+        replies = [await read_reply(self._reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise SharedStateError(str(reply))
+        return replies
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def execute(self, batch: StateBatch) -> StateBatchResult:
+        commands = []
+        for key, (amount, ttl) in batch.increments.items():
+            # Creates the counter with an expiry only if it's not there already
+            commands.append(encode_command("SET", key, 0, "PX", _millis(ttl), "NX"))
+            commands.append(encode_command("INCRBY", key, amount))
+        for key, (value, ttl) in batch.writes.items():
+            commands.append(encode_command("SET", key, value, "PX", _millis(ttl)))
+        if batch.reads:
+            commands.append(encode_command("MGET", *batch.reads))
+        if not commands:
+            return StateBatchResult({}, {})
+
+        async with self._lock:
+            try:
+                async with asyncio.timeout(self.timeout):
+                    if self._writer is None:
+                        await self._connect()
+                    replies = await self._pipeline(commands)
+            except (OSError, EOFError, TimeoutError, SharedStateError) as exc:
+                # Reconnected on the next batch, rather than reading replies
+                # meant for this one
+                await self.close()
+                if isinstance(exc, SharedStateError):
+                    raise
+                raise SharedStateError(f"{self.url.host}: {exc!r}") from exc
+            self.round_trips += 1
+
+        counts = {key: replies[2 * i + 1] for i, key in enumerate(batch.increments)}
+        values = dict(zip(batch.reads, replies[-1])) if batch.reads else {}
+        return StateBatchResult(counts, values)
+
+
+def shared_state_for(settings: PhoenixdLNURLSettings) -> SharedStateBase:
+    if settings.shared_state_url is None:
+        return InProcessSharedState()
+    url = URL(settings.shared_state_url.get_secret_value())
+    if url.scheme != "redis":
+        raise ValueError("SHARED_STATE_URL must be a redis:// URL")
+    logger.info(
+        "Sharing state through {url}", url=url.with_user(None).with_password(None)
+    )
+    return RespSharedState(url)
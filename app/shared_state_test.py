@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from .kv_standin import KVStandin
+from .shared_state import (
+    InProcessSharedState,
+    RespSharedState,
+    SharedStateError,
+    StateBatch,
+)
+
+
+@contextlib.asynccontextmanager
+async def standin_url(password: str | None = "hunter2"):
+    standin = KVStandin(password=password)
+    server = await standin.serve("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    auth = f":{password}@" if password else ""
+    try:
+        yield standin, f"redis://{auth}127.0.0.1:{port}/1"
+    finally:
+        await standin.close()
+
+
+@contextlib.asynccontextmanager
+async def backend_for(kind: str):
+    if kind == "in_process":
+        yield InProcessSharedState()
+        return
+    async with standin_url() as (_, url):
+        backend = RespSharedState(url)
+        try:
+            yield backend
+        finally:
+            await backend.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["in_process", "resp"])
+async def test_batches(kind):
+    async with backend_for(kind) as backend:
+        batch = StateBatch()
+        batch.incr("hits", 2, ttl=60)
+        batch.incr("hits", 1, ttl=60)
+        batch.incr("brief", 1, ttl=0.05)
+        batch.set("invoice:1", '{"amount_sat": 21}', ttl=60)
+        batch.get("invoice:0")
+        result = await backend.execute(batch)
+        assert result.counts == {"hits": 3, "brief": 1}
+        assert result.values == {"invoice:0": None}
+
+        await asyncio.sleep(0.1)
+        batch = StateBatch()
+        batch.incr("hits", 4, ttl=60)
+        batch.incr("brief", 1, ttl=60)
+        batch.get("invoice:1")
+        result = await backend.execute(batch)
+        # "brief" expired, so counting starts again
+        assert result.counts == {"hits": 7, "brief": 1}
+        assert result.values == {"invoice:1": '{"amount_sat": 21}'}
+
+
+@pytest.mark.asyncio
+async def test_resp_pipelines_and_reconnects():
+    async with standin_url() as (standin, url):
+        backend = RespSharedState(url)
+        batch = StateBatch()
+        for i in range(100):
+            batch.incr(f"counter:{i}", 1, ttl=60)
+            batch.set(f"record:{i}", "x", ttl=60)
+        await backend.execute(batch)
+        assert backend.round_trips == 1
+        assert standin.stats["connections"] == 1
+        # AUTH and SELECT, then 2 commands per counter and 1 per record
+        assert standin.stats["commands"] == 2 + 300
+        # Selected database 1
+        assert ("1", "record:0") in standin.data
+
+        await backend.close()
+        batch = StateBatch()
+        batch.get("record:99")
+        assert (await backend.execute(batch)).values == {"record:99": "x"}
+        assert standin.stats["connections"] == 2
+        await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_resp_errors():
+    async with standin_url() as (_, url):
+        backend = RespSharedState(url.replace("hunter2", "wrong"))
+        batch = StateBatch()
+        batch.get("key")
+        with pytest.raises(SharedStateError, match="WRONGPASS"):
+            await backend.execute(batch)
+    # The stand-in has gone
+    with pytest.raises(SharedStateError):
+        await RespSharedState(url, timeout=0.5).execute(batch)
+
+
+@pytest.mark.parametrize(
+    "args,reply",
+    [
+        (["SET", "key", "v", "PX", "1"], "OK"),
+        (["SET", "key", "v", "PX", "0"], "ERR invalid expire time in 'set' command"),
+        (["SET", "key", "v", "EX", "-1"], "ERR invalid expire time in 'set' command"),
+        (["SET", "key", "v", "EX", "x"], "ERR value is not an integer or out of range"),
+    ],
+)
+def test_standin_expiries(args, reply):
+    # As Redis
+    assert str(KVStandin().command({"db": "0"}, args)) == reply
@@ -0,0 +1,50 @@
+import tracemalloc
+
+import pytest
+
+from .soak import (
+    check_growth,
+    soak,
+    top_allocations,
+)
+
+
+def test_check_growth():
+    baseline = {"rss_mb": 80.0, "traced_mb": None, "fds": 7, "tasks": 4}
+    final = {"rss_mb": 95.5, "traced_mb": 4.0, "fds": 9, "tasks": 4}
+    growth = check_growth(
+        baseline, final, {"rss_mb": 10, "traced_mb": 1, "fds": 5, "tasks": 0}
+    )
+    assert growth == {
+        "rss_mb": {"growth": 15.5, "budget": 10, "ok": False},
+        "fds": {"growth": 2, "budget": 5, "ok": True},
+        "tasks": {"growth": 0, "budget": 0, "ok": True},
+    }
+
+
+def test_top_allocations():
+    tracemalloc.start(2)
+    try:
+        baseline = tracemalloc.take_snapshot()
+        leaked = [bytearray(1024) for _ in range(1000)]
+        (top, *_) = top_allocations(baseline, 5)
+    finally:
+        tracemalloc.stop()
+    assert "soak_test.py" in top
+    assert len(leaked) == 1000
+
+
+@pytest.mark.asyncio
+async def test_soak():
+    report = await soak(
+        duration=1.0,
+        rps=200,
+        warmup=0.2,
+        sample_interval=0.25,
+        reload_interval=0.5,
+        budgets={"fds": 5, "tasks": 5},
+    )
+    assert report["requests"] > 50
+    assert report["errors"] == 0
+    assert report["ok"]
+    assert set(report["growth"]) == {"fds", "tasks"}
@@ -0,0 +1,140 @@
+"""
+Compares gunicorn startup with and without `PRELOAD=1` (see `gunicorn.conf.py`):
+time until every worker is ready, and the memory each worker costs once it has
+served some traffic. Linux only, as memory is read from `/proc`.
+
+    python -m app.worker_bench --workers 4
+"""
+
+import argparse
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+READY_LINE = "Application startup complete"
+WARM_PATHS = ("/lnurl", "/lnurlp/satoshi", "/.well-known/lnurlp/satoshi")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _smaps_rollup_kb(pid: int) -> dict[str, int]:
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1])
+    return values
+
+
+def _children(pid: int) -> list[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as children:
+        return [int(child) for child in children.read().split()]
+
+
+def _pump(stream, lines: queue.Queue):
+    for line in stream:
+        lines.put(line)
+
+
+def run(*, workers: int, preload: bool, requests: int, timeout: float) -> dict:
+    port = _free_port()
+    env = os.environ | {
+        "WORKERS": str(workers),
+        "PRELOAD": "1" if preload else "0",
+        "BIND": f"127.0.0.1:{port}",
+    }
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app.wsgi:app", "-c", "gunicorn.conf.py"],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    lines: queue.Queue[str] = queue.Queue()
+    threading.Thread(target=_pump, args=(process.stdout, lines), daemon=True).start()
+
+    try:
+        ready = 0
+        while ready < workers:
+            remaining = timeout - (time.perf_counter() - started)
+            try:
+                line = lines.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                raise TimeoutError(f"Only {ready}/{workers} workers ready") from None
+            ready += READY_LINE in line
+        time_to_ready = time.perf_counter() - started
+
+        for i in range(requests):
+            path = WARM_PATHS[i % len(WARM_PATHS)]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as response:
+                response.read()
+
+        memory = [_smaps_rollup_kb(pid) for pid in _children(process.pid)]
+        master = _smaps_rollup_kb(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+    def mean_mb(key: str) -> float:
+        return sum(m.get(key, 0) for m in memory) / len(memory) / 1024
+
+    return {
+        "preload": preload,
+        "time_to_ready_s": time_to_ready,
+        "worker_rss_mb": mean_mb("Rss"),
+        "worker_pss_mb": mean_mb("Pss"),
+        # Unique set size: what each additional worker really costs
+        "worker_uss_mb": (mean_mb("Private_Clean") + mean_mb("Private_Dirty")),
+        "master_rss_mb": master.get("Rss", 0) / 1024,
+    }
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.worker_bench",
+        description="Benchmark gunicorn worker startup time and memory, with and without preload",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Requests to serve before measuring memory, so lazy state is built",
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    results = [
+        run(
+            workers=args.workers,
+            preload=preload,
+            requests=args.requests,
+            timeout=args.timeout,
+        )
+        for preload in (False, True)
+    ]
+    columns = list(results[0])
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print(
+            "  ".join(
+                f"{value:>16.3f}" if isinstance(value, float) else f"{value!s:>16}"
+                for value in result.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
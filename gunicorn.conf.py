@@ -0,0 +1,27 @@
+"""
+Gunicorn config used by `run.sh`, see https://docs.gunicorn.org/en/stable/settings.html
+
+Set `PRELOAD=1` to build the app (settings, artifacts, templates, QR code) once
+in the master process before forking, rather than in every worker. Workers then
+share those pages copy-on-write and only create their own aiohttp session.
+"""
+
+import gc
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.environ.get("PRELOAD", "0").lower() in ("1", "true", "yes", "on")
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from app.main import warm_up
+    from app.wsgi import app
+
+    warm_up(app)
+    # Move everything built so far out of the garbage collector's view, so
+    # collections in workers don't write to (and so copy) the shared pages
+    gc.freeze()
@@ -1,6 +1,3 @@
 #!/usr/bin/env bash
-exec gunicorn app.wsgi:app \
-    --workers 4 \
-    --worker-class uvicorn.workers.UvicornWorker \
-    --forwarded-allow-ips='*' \
-    --bind 127.0.0.1:8000;
+# Options (bind address, worker count, PRELOAD=1) are in gunicorn.conf.py
+exec gunicorn app.wsgi:app --config gunicorn.conf.py "$@";